@@ -261,3 +261,154 @@ def test_get_question_answer_attrs():
            == ['http://a/1', 'http://a/2']
     assert AnswerManager.get_question_answer_attrs(test_tid, 'q1', 'aid', 'answerer') \
            == [['a1', 'aer'], ['a2', 'aer2']]
+
+
+@patch('db.BUCKET_SIZE', 2)
+def test_bucketed_events():
+    t = datetime.now().replace(microsecond=0)
+    upvoters = [{'uid': 'up%d' % i, 'time': t + timedelta(i)} for i in range(3)]
+    DB.save_answer(tid=tid, aid=aid, url='http://a/1', qid=qid, time=t,
+                   answerer=author_id, upvoters=upvoters[:1], bucketed=True)
+    DB.add_upvoters(tid, aid, upvoters[1:], bucketed=True)
+    DB.add_commenters(tid, aid, [{'uid': 'cm1', 'cid': 1, 'time': t}],
+                      bucketed=True)
+
+    # answer doc 本身不存 event
+    answer_doc = DB.db[a_col(tid)].find_one({'aid': aid})
+    assert answer_doc['bucketed'] and answer_doc['upvoters'] == []
+    assert [b['count'] for b in DB.db[e_col(tid)].find(
+        {'aid': aid, 'kind': 'upvoters'}).sort('seq', 1)] == [2, 1]
+
+    answer_doc = DB.get_one_answer(tid, aid)
+    assert answer_doc['upvoters'] == upvoters
+    assert answer_doc['commenters'] == [{'uid': 'cm1', 'cid': 1, 'time': t}]
+    assert answer_doc['collectors'] == []
+
+    doc = DB.get_answer_affected_user_with_limit(tid, aid, limit=2)
+    assert [u['uid'] for u in doc['upvoters']] == ['up1', 'up2']
+    doc = DB.get_answer_affecter_num(tid, aid)
+    assert (doc['up_count'], doc['com_count'], doc['col_count']) == (3, 1, 0)
+
+    manager = AnswerManager(tid, aid)
+    assert manager.bucketed and all(
+        u['uid'] in manager.known_upvoters for u in upvoters)
+
+    DB.remove_answer(tid, aid)
+    assert DB.db[e_col(tid)].count() == 0
+
+
+def test_answer_counters():
+    DB.save_answer(tid=tid, aid=aid, url='http://a/1', qid=qid,
+                   time=datetime.now(), answerer=author_id,
+                   upvoters=[{'uid': 'up1', 'time': None}])
+    DB.add_upvoters(tid, aid, deque([{'uid': 'up2', 'time': None}]))
+    DB.add_collectors(tid, aid, [{'uid': 'cl1', 'time': None, 'cid': 1}])
+    answer_doc = DB.db[a_col(tid)].find_one({'aid': aid})
+    assert (answer_doc['upvote_count'], answer_doc['commenter_count'],
+            answer_doc['collector_count']) == (2, 0, 1)
+    assert AnswerManager.get_answer_affecter_num(tid, aid) == (2, 0, 1)
+
+    # 加入计数之前的 answer doc, 读取时补上
+    DB.db[a_col(tid)].update_one({'aid': aid}, {'$unset': {
+        'upvote_count': '', 'commenter_count': '', 'collector_count': ''}})
+    assert AnswerManager.get_answer_affecter_num(tid, aid) == (2, 0, 1)
+    assert DB.db[a_col(tid)].find_one({'aid': aid})['upvote_count'] == 2
+
+
+@patch('huey_tasks.fetch_followers_followees', Mock())
+@patch('task.FetchAnswerInfo.get_upvote_time')
+@patch('task.get_client')
+def test_upvoter_resume(mock_client, mock_upvote_time):
+    t = datetime.now().replace(microsecond=0)
+    mock_upvote_time.return_value = t
+    DB.save_answer(tid=tid, aid=aid, url='http://a/1', qid=qid, time=t,
+                   answerer=author_id,
+                   upvoters=[{'uid': 'up%d' % i, 'time': t} for i in range(10)])
+
+    # 最近的 5 个 upvoter 取消了赞, 新增 6 个 upvoter, 其中 1 个匿名
+    upvoters = [Mock(id='n%d' % i) for i in range(5, 0, -1)] + [zhihu.ANONYMOUS] + \
+               [Mock(id='up%d' % i) for i in range(4, -1, -1)]
+    scanned = []
+
+    def iter_upvoters():
+        for upvoter in upvoters:
+            scanned.append(upvoter)
+            yield upvoter
+
+    mock_answer = Mock(url='http://a/1', id=aid, deleted=False, upvote_num=11,
+                       comment_num=0, collect_num=0)
+    mock_answer.configure_mock(upvoters=iter_upvoters())
+    mock_client.return_value = Mock(answer=Mock(return_value=mock_answer))
+
+    task = FetchAnswerInfo(tid=tid, qid=qid, url='http://a/1')
+    assert 'up9' in task.manager.known_upvoters
+    task.execute()
+    # 连续遇到 up4, up3 两个已记录的 upvoter 就停止, 不再往下翻
+    assert len(scanned) == 8
+    assert [u['uid'] for u in DB.get_upvoters(tid, aid)['upvoters'][10:]] == \
+           ['n1', 'n2', 'n3', 'n4', 'n5']
+    assert 'n5' in task.manager.known_upvoters
+
+
+class StubEngine:
+    """
+    和 engine.TaskEngine 的接口相同, 翻页直接返回给定的 upvoter
+    """
+    def __init__(self, upvoters):
+        self._upvoters = upvoters
+        self.refreshed = []
+
+    async def refresh(self, obj):
+        self.refreshed.append(obj)
+
+    async def upvoters(self, answer):
+        for upvoter in self._upvoters:
+            yield upvoter
+
+    async def run_blocking(self, func, *args):
+        return func(*args)
+
+
+@patch('huey_tasks.fetch_followers_followees', Mock())
+@patch('task.FetchAnswerInfo.get_upvote_time')
+@patch('task.get_client')
+def test_execute_async(mock_client, mock_upvote_time):
+    import asyncio
+    t = datetime.now().replace(microsecond=0)
+    mock_upvote_time.return_value = t
+    DB.save_answer(tid=tid, aid=aid, url='http://a/1', qid=qid, time=t,
+                   answerer=author_id,
+                   upvoters=[{'uid': 'up%d' % i, 'time': t} for i in range(3)])
+    mock_answer = Mock(url='http://a/1', id=aid, deleted=False, upvote_num=5,
+                       comment_num=0, collect_num=0)
+    mock_client.return_value = Mock(answer=Mock(return_value=mock_answer))
+    engine = StubEngine([Mock(id='n2'), Mock(id='n1'), Mock(id='up2'),
+                         Mock(id='up1'), Mock(id='up0')])
+
+    task = FetchAnswerInfo(tid=tid, qid=qid, url='http://a/1')
+    asyncio.new_event_loop().run_until_complete(task.execute_async(engine))
+    assert engine.refreshed == [mock_answer]
+    mock_answer.refresh.assert_not_called()
+    assert [u['uid'] for u in DB.get_upvoters(tid, aid)['upvoters'][3:]] == \
+           ['n1', 'n2']
+    assert task.upvote_num == 5
+    assert task in answer_task_queue
+
+
+def test_migrate_answer_events():
+    t = datetime.now().replace(microsecond=0)
+    upvoters = [{'uid': 'up%d' % i, 'time': t} for i in range(3)]
+    DB.save_answer(tid=tid, aid=aid, url='http://a/1', qid=qid, time=t,
+                   answerer=author_id, upvoters=upvoters[:2])
+    stale_doc = DB.db[a_col(tid)].find_one({'aid': aid})
+    DB.add_upvoters(tid, aid, upvoters[2:])
+
+    # 读取之后有新 event 写入, 不清空
+    assert not DB.migrate_answer_events(tid, stale_doc)
+    assert DB.db[e_col(tid)].count() == 0
+    assert len(DB.db[a_col(tid)].find_one({'aid': aid})['upvoters']) == 3
+
+    assert DB.migrate_answer_events(tid, DB.db[a_col(tid)].find_one({'aid': aid}))
+    answer_doc = DB.get_one_answer(tid, aid)
+    assert answer_doc['bucketed'] and answer_doc['upvoters'] == upvoters
+    assert DB.get_answer_affecter_num(tid, aid)['up_count'] == 3
@@ -0,0 +1,232 @@
+"""
+TaskEngine 测试, 用本地 http server 代替知乎
+"""
+
+import json
+import time
+import asyncio
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from unittest.mock import patch
+
+import requests
+from zhihu import Answer, ANONYMOUS
+
+from engine import TaskEngine
+from common import *
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+ANSWER_HTML = '''
+<input name="_xsrf" value="xsrf-token">
+<div class="zm-item-answer" data-aid="42" data-created="1452297600">
+  <div class="zm-item-vote-info" data-votecount="3"></div>
+  <div class="answer-actions"><a class="toggle-comment">31 条评论</a></div>
+  <a data-za-a="click_answer_collected_count">2</a>
+</div>
+'''
+
+VOTER_HTML = '''
+<a><img src="https://pic.zhimg.com/%(uid)s_m.jpg"></a>
+<div class="body"><div><a title="%(uid)s" href="https://www.zhihu.com/people/%(uid)s/"></a>
+<span>motto</span></div></div>
+<ul><li>1 赞同</li><li>2 感谢</li><li>3 提问</li><li>4 回答</li></ul>
+'''
+
+COLLECTION_HTML = '''
+<div class="zm-item"><h2><a href="/collection/%(cid)d">c%(cid)d</a></h2>
+<div><a href="https://www.zhihu.com/people/%(uid)s/">%(uid)s</a><a>5 人关注</a></div></div>
+'''
+
+
+def comment(i):
+    return {
+        'id': i,
+        'content': 'comment %d' % i,
+        'likesCount': 0,
+        'createdTime': '2016-01-09T00:00:%02d+08:00' % (i % 60),
+        'author': {'url': 'https://www.zhihu.com/people/c%d/' % i, 'name': 'c%d' % i,
+                   'avatar': {'template': '{id}_{size}.jpg', 'id': str(i)}}
+    }
+
+
+class ZhihuHandler(BaseHTTPRequestHandler):
+    """
+    答案页面, upvoter/comment/collection 翻页, 以及每个请求 0.2s 的 /slow
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/slow':
+            time.sleep(0.2)
+            self._send(b'ok')
+        elif url.path == '/question/1/answer/2':
+            self._send(ANSWER_HTML.encode())
+        elif url.path == '/question/1/answer/3':
+            # 被删除的答案跳转到问题页面
+            self.send_response(302)
+            self.send_header('Location', '/question/1')
+            self.end_headers()
+        elif url.path == '/question/1':
+            self._send(b'<html></html>')
+        elif url.path == '/answer/42/voters_profile':
+            self._send_json({'paging': {'next': '/answer/42/voters_profile/2'},
+                             'payload': [VOTER_HTML % {'uid': 'u3'},
+                                         '<div class="body">anonymous</div>']})
+        elif url.path == '/answer/42/voters_profile/2':
+            self._send_json({'paging': {'next': ''},
+                             'payload': [VOTER_HTML % {'uid': 'u1'}]})
+        elif url.path == '/r/answers/42/comments':
+            page = int(parse_qs(url.query)['page'][0])
+            self._send_json({'data': [comment(i) for i in range(
+                (page - 1) * 30, min(page * 30, 31))]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        offset = json.loads(body['params'][0])['offset']
+        assert body['_xsrf'] == ['xsrf-token']
+        # 第一页 10 个, 第二页 2 个
+        count = 10 if offset == 0 else 2
+        self._send_json({'msg': [COLLECTION_HTML % {'cid': offset + i,
+                                                    'uid': 'o%d' % (offset + i)}
+                                 for i in range(count)]})
+
+    def _send(self, content):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_json(self, data):
+        self._send(json.dumps(data).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class StubTask:
+    """
+    和 FetchAnswerInfo 一样, 开始时把自己放回 queue, 用 engine 的 session 请求
+    """
+    concurrent = max_concurrent = 0
+
+    def __init__(self, session, qid='q1', aid='a1'):
+        self.session = session
+        self.qid = qid
+        self.aid = aid
+        self.calls = 0
+
+    async def execute_async(self, engine):
+        answer_task_queue.append(self)
+        StubTask.concurrent += 1
+        StubTask.max_concurrent = max(StubTask.max_concurrent, StubTask.concurrent)
+        try:
+            await engine.client(self.session).get(url + 'slow')
+            self.calls += 1
+        finally:
+            StubTask.concurrent -= 1
+
+
+def setup_module(module):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ZhihuHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    module.__dict__['server'] = server
+    module.__dict__['url'] = 'http://127.0.0.1:%d/' % server.server_port
+
+
+def teardown_module(module):
+    server.shutdown()
+
+
+def teardown_function(function):
+    answer_task_queue.clear()
+    question_task_queue.clear()
+    cancelled_questions.clear()
+    StubTask.concurrent = StubTask.max_concurrent = 0
+
+
+def run(engine, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await engine.close()
+    return engine.loop.run_until_complete(main())
+
+
+def test_answer_round():
+    engine = TaskEngine(threading.Event(), max_concurrency=200)
+    session = requests.Session()
+    tasks = [StubTask(session, aid=str(i)) for i in range(1000)]
+    answer_task_queue.extend(tasks)
+    cancelled = StubTask(session, qid='q2')
+    answer_task_queue.append(cancelled)
+    cancelled_questions.add('q2')
+
+    start = time.time()
+    run(engine, engine.answer_round())
+    # 1000 个请求各 0.2s, 并发上限 200, 共用一个 aiohttp session
+    assert StubTask.max_concurrent == 200
+    assert time.time() - start < 3
+    assert all(task.calls == 1 for task in tasks)
+    assert cancelled.calls == 0 and not cancelled_questions
+    assert len(engine.clients) == 0  # close 之后清空
+    assert len(answer_task_queue) == 1000
+
+
+def test_skip_running_task():
+    engine = TaskEngine(threading.Event(), max_concurrency=10)
+    task = StubTask(requests.Session())
+    answer_task_queue.append(task)
+
+    async def rounds():
+        futures = engine.dispatch(answer_task_queue.pop_due(), answer_task_queue)
+        await asyncio.sleep(0.05)  # task 开始执行, 把自己放回 queue
+        # task 还在执行, 不会再执行一次, 也不会从 queue 中丢失
+        assert engine.dispatch(answer_task_queue.pop_due(), answer_task_queue) == []
+        assert list(answer_task_queue) == [task]
+        await asyncio.wait(futures)
+
+    run(engine, rounds())
+    assert task.calls == 1
+    assert not engine.running
+
+
+def test_refresh_and_pagination():
+    engine = TaskEngine(threading.Event())
+    session = requests.Session()
+    session.cookies.set('z_c0', 'cookie')
+    answer = Answer('https://www.zhihu.com/question/1/answer/2/', session=session)
+    answer._url = url + 'question/1/answer/2/'  # 和 FetchAnswerInfo 一样改写 _url
+
+    async def fetch():
+        await engine.refresh(answer)
+        upvoters = [u async for u in engine.upvoters(answer)]
+        comments = [c async for c in engine.latest_comments(answer)]
+        collections = [c async for c in engine.collections(answer)]
+        return upvoters, comments, collections
+
+    with patch('engine.BASE_URL', url[:-1]):
+        upvoters, comments, collections = run(engine, fetch())
+    assert not answer.deleted
+    assert (answer.upvote_num, answer.comment_num, answer.collect_num) == (3, 31, 2)
+    assert [u if u is ANONYMOUS else u.id for u in upvoters] == ['u3', ANONYMOUS, 'u1']
+    # 从最后一页往前, 较新的先返回
+    assert [c.cid for c in comments] == list(range(30, -1, -1))
+    assert comments[0].author.id == 'c30'
+    assert [c.owner.id for c in collections] == ['o%d' % i for i in range(12)]
+
+
+def test_refresh_deleted():
+    engine = TaskEngine(threading.Event())
+    answer = Answer('https://www.zhihu.com/question/1/answer/3/',
+                    session=requests.Session())
+    answer._url = url + 'question/1/answer/3/'
+    run(engine, engine.refresh(answer))
+    assert answer.deleted
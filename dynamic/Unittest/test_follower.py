@@ -172,3 +172,28 @@ def test_increased_followees(ees, ee_num):
     assert doc['followee'][0]['uids'] == ['a', 'b']
     assert doc['followee'][1]['uids'] == ['c']
     assert doc['followee'][2]['uids'] == ['e', 'd']
+
+
+@pytest.mark.skipif(skip, reason='')
+@patch('huey_tasks.USER_BUCKET_SIZE', 2)
+@patch('huey_tasks.bucket_events', True)
+@patch('huey_tasks.zhihu.Author.follower_num', new_callable=PropertyMock)
+@patch('huey_tasks.zhihu.Author.followers', new_callable=PropertyMock)
+def test_bucketed_followers(ers, er_num):
+    ers.side_effect = [
+        [Mock(id='a'), Mock(id='b'), Mock(id='c')],
+        [Mock(id='d'), Mock(id='a'), Mock(id='b'), Mock(id='c')],
+    ]
+    er_num.side_effect = [3000, 3001]  # 超过 MAX_EMBEDDED_FOLLOW 也抓取
+    now = datetime.now()
+    _fetch_followers(laike9m, now)
+    _fetch_followers(laike9m, now + timedelta(seconds=1))
+
+    doc = huey_tasks.user_coll.find_one({'uid': 'laike9m'})
+    assert [s['count'] for s in doc['follower']] == [3, 1]
+    assert 'uids' not in doc['follower'][0]
+    assert huey_tasks.snapshot_coll.find({'uid': 'laike9m'}).count() == 3
+
+    doc = get_user('laike9m')
+    assert doc['follower'][0]['uids'] == ['a', 'b', 'c']
+    assert doc['follower'][1]['uids'] == ['d']
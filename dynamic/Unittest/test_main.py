@@ -0,0 +1,102 @@
+"""
+run_due_tasks 测试, 用本地 http server 代替知乎
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.request import urlopen
+
+from main import run_due_tasks
+from common import *
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(0.2)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class StubTask:
+    """
+    和 FetchAnswerInfo 一样, execute 开始时把自己放回 queue
+    """
+    lock = threading.Lock()
+    concurrent = max_concurrent = 0
+
+    def __init__(self, url, qid='q1', aid='a1'):
+        self.url = url
+        self.qid = qid
+        self.aid = aid
+        self.calls = 0
+
+    def execute(self):
+        answer_task_queue.append(self)
+        with StubTask.lock:
+            StubTask.concurrent += 1
+            StubTask.max_concurrent = max(StubTask.max_concurrent,
+                                          StubTask.concurrent)
+        try:
+            urlopen(self.url).read()
+            self.calls += 1
+        finally:
+            with StubTask.lock:
+                StubTask.concurrent -= 1
+
+
+def setup_module(module):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    module.__dict__['server'] = server
+    module.__dict__['url'] = 'http://127.0.0.1:%d/' % server.server_port
+
+
+def teardown_module(module):
+    server.shutdown()
+
+
+def teardown_function(function):
+    answer_task_queue.clear()
+    question_task_queue.clear()
+    cancelled_questions.clear()
+    StubTask.concurrent = StubTask.max_concurrent = 0
+
+
+def test_run_due_tasks():
+    executor = ThreadPoolExecutor(max_workers=50)
+    tasks = [StubTask(url, aid=str(i)) for i in range(100)]
+    answer_task_queue.extend(tasks)
+
+    start = time.time()
+    run_due_tasks(executor, answer_task_queue, set(), timeout=5)
+    # 100 个请求各 0.2s, 并发上限 50
+    assert StubTask.max_concurrent == 50
+    assert time.time() - start < 2
+    assert all(task.calls == 1 for task in tasks)
+    assert len(answer_task_queue) == 100
+
+
+def test_skip_running_task():
+    executor = ThreadPoolExecutor(max_workers=10)
+    running = set()
+    task = StubTask(url)
+    answer_task_queue.append(task)
+
+    run_due_tasks(executor, answer_task_queue, running, timeout=0.05)
+    # task 还在执行, 不会再执行一次, 也不会从 queue 中丢失
+    run_due_tasks(executor, answer_task_queue, running, timeout=0.05)
+    assert list(answer_task_queue) == [task]
+    executor.shutdown(wait=True)
+    assert task.calls == 1
+    assert not running
@@ -60,6 +60,36 @@ def test_find_latest():
     assert latest['url'] == 'url3'
     assert latest['qid'] == '3'
     assert latest['asker'] == 'asker3'
+    assert DB.find_latest_question('7654321') is None
+
+
+@pytest.mark.skipif(skip, reason="")
+def test_ensure_indexes():
+    DB.indexed.clear()
+    DB.save_answer(test_tid, '1', 'url', '1', datetime.now(), 'answerer')
+    assert DB.ensure_indexes([test_tid2]) == []
+    assert set(DB.db[a_col(test_tid)].index_information()) >= \
+        {'aid', 'qid_time', 'time'}
+    assert set(DB.db[q_col(test_tid2)].index_information()) >= {'qid', 'time'}
+    assert 'uid' in DB.db.user.index_information()
+
+    # 新的 topic 在第一次写入时建索引
+    DB.save_question('9999', 'url', '1', datetime.now(), 'asker', '')
+    assert 'qid' in DB.db[q_col('9999')].index_information()
+    DB.get_question('9999', '1')
+    assert DB.index_stats()[q_col('9999')]['qid'] >= 1
+
+
+@pytest.mark.skipif(skip, reason="")
+def test_ensure_indexes_existing_name():
+    # 手动建的默认名索引, key 相同时不再建同 key 的另一个名字
+    DB.indexed.clear()
+    DB.db[q_col(test_tid)].create_index('qid')
+    DB.db.user.create_index('uid')
+    assert DB.ensure_indexes([test_tid]) == []
+    assert 'qid_1' in DB.db[q_col(test_tid)].index_information()
+    assert 'qid' not in DB.db[q_col(test_tid)].index_information()
+    assert 'time' in DB.db[q_col(test_tid)].index_information()
 
 
 @pytest.mark.skipif(skip, reason="")
@@ -316,4 +346,97 @@ def test_skip_inactive():
                                   'asker', 'title')
     QuestionManager.set_question_inactive(test_tid, '1')
     _ = TopicMonitor()
-    assert len(question_task_queue) == 0
\ No newline at end of file
+    assert len(question_task_queue) == 0
+
+@patch('db.BUCKET_SIZE', 2)
+@patch.object(DB, 'bucket_events', True)
+def test_bucketed_question_follower():
+    QuestionManager.save_question(test_tid, 'http:/q/1', '1', datetime.now(),
+                                  'asker', 'title')
+    followers = [{'uid': 'f%d' % i, 'time': None} for i in range(5)]
+    QuestionManager.add_question_follower(test_tid, '1', followers[:3], True)
+    QuestionManager.add_question_follower(test_tid, '1', followers[3:], True)
+
+    assert DB.db[q_col(test_tid)].find_one({'qid': '1'})['follower'] == []
+    assert DB.db[e_col(test_tid)].find({'qid': '1'}).count() == 3
+    assert DB.get_question_follower(test_tid, '1') == followers
+    assert QuestionManager.get_question_follower(test_tid, '1', limit=3) == \
+        {'f2', 'f3', 'f4'}
+    assert QuestionManager.get_question_follower_num(test_tid, '1') == 5
+
+    QuestionManager.remove_question(test_tid, '1')
+    assert DB.db[e_col(test_tid)].count() == 0
+
+
+@patch('db.BUCKET_SIZE', 2)
+@patch.object(DB, 'bucket_events', True)
+def test_concurrent_question_follower():
+    import threading
+    QuestionManager.save_question(test_tid, 'http:/q/1', '1', datetime.now(),
+                                  'asker', 'title')
+    # 多个 huey 任务同时写同一个问题的 follower
+    threads = [threading.Thread(target=DB.add_question_follower, args=(
+        test_tid, '1', [{'uid': 'f%d_%d' % (i, j), 'time': None}
+                        for j in range(5)], True)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    buckets = list(DB.db[e_col(test_tid)].find({'qid': '1'}))
+    assert sorted(bucket['seq'] for bucket in buckets) == list(range(len(buckets)))
+    assert all(bucket['count'] == len(bucket['events']) <= 2 for bucket in buckets)
+    assert len(DB.get_question_follower(test_tid, '1')) == 50
+    assert QuestionManager.get_question_follower_num(test_tid, '1') == 50
+
+
+def test_follower_count_backfill():
+    QuestionManager.save_question(test_tid, 'http:/q/1', '1', datetime.now(),
+                                  'asker', 'title')
+    QuestionManager.add_question_follower(test_tid, '1', ['f1', 'f2'])
+    assert QuestionManager.get_question_attrs(test_tid, '1',
+                                              'follower_count') == 2
+
+    # 加入计数之前的 question doc
+    DB.db[q_col(test_tid)].update_one({'qid': '1'},
+                                      {'$unset': {'follower_count': ''}})
+    assert QuestionManager.get_question_follower_num(test_tid, '1') == 2
+    assert QuestionManager.get_question_attrs(test_tid, '1',
+                                              'follower_count') == 2
+
+
+@patch('monitor.fast_restart', True)
+@patch('task.get_client')
+def test_restore_old_question(mock_client):
+    import monitor
+    prefix = 'https://www.zhihu.com/question/'
+    time1 = datetime.now().replace(microsecond=0)
+    for qid in ('1', '2', '3'):
+        QuestionManager.save_question(test_tid, prefix + qid + '/', qid, time1,
+                                      'asker', 'title')
+    QuestionManager.set_question_inactive(test_tid, '3')
+    DB.save_answer(test_tid, 'a1', prefix + '1/answer/a1', '1', time1, 'aer')
+    DB.save_answer(test_tid, 'a2', prefix + '1/answer/a2', '1',
+                   time1 + timedelta(hours=1), 'aer',
+                   upvoters=[{'uid': 'up1', 'time': time1 + timedelta(hours=2)}])
+    DB.save_answer(test_tid, 'a3', prefix + '3/answer/a3', '3', time1, 'aer')
+
+    monitor.TopicMonitor._load_old_question()
+    mock_client.assert_not_called()  # 创建 task 时不访问网络
+    assert [task.qid for task in question_task_queue] == ['1', '2']
+    task = question_task_queue[0]
+    assert task.url == prefix + '1?sort=created'
+    assert task.answer_num == 2 and task.follower_num == 0
+    assert task.last_update_time == time1 + timedelta(hours=1)
+    # 没有答案的问题被删除, 非 active 的问题不加载
+    assert not question_task_queue[1].continue_task
+    assert DB.get_question(test_tid, '2') is None
+    assert [task.aid for task in answer_task_queue] == ['a1', 'a2']
+
+    answer_task = answer_task_queue[1]
+    assert answer_task.upvote_num == 1 and answer_task.answer is None
+    answer_task._load_answer()
+    mock_client.return_value.answer.assert_called_once_with(prefix + '1/answer/a2')
+    assert answer_task.last_update_time == time1 + timedelta(hours=2)
+    assert (answer_task.upvote_num, answer_task.comment_num,
+            answer_task.collect_num) == (1, 0, 0)
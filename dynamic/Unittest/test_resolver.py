@@ -0,0 +1,59 @@
+"""
+UpvoteTimeResolver 测试
+"""
+
+import time
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+from zhihu.acttype import ActType
+
+from resolver import UpvoteTimeResolver
+
+
+class StubUpvoter:
+    """
+    activities 被访问一次算一次请求
+    """
+
+    def __init__(self, uid, urls, delay=0):
+        self.id = uid
+        self.urls = urls
+        self.delay = delay
+        self.requests = 0
+
+    @property
+    def activities(self):
+        self.requests += 1
+        time.sleep(self.delay)
+        t = datetime(2016, 1, 9)
+        return [Mock(type=ActType.UPVOTE_ANSWER, content=Mock(url=url),
+                     time=t + timedelta(i)) for i, url in enumerate(self.urls)]
+
+
+def test_resolve_concurrently():
+    resolver = UpvoteTimeResolver(max_workers=10, timeout=5)
+    upvoters = [StubUpvoter('u%d' % i, ['a1', 'a2'], delay=0.2) for i in range(10)]
+    start = time.time()
+    times = resolver.resolve(upvoters, Mock(url='a1'))
+    assert time.time() - start < 1
+    assert times == [datetime(2016, 1, 9)] * 10
+
+    # 同一个用户点赞的另一个答案从缓存中取
+    assert resolver.resolve(upvoters, Mock(url='a2')) == [datetime(2016, 1, 10)] * 10
+    assert all(upvoter.requests == 1 for upvoter in upvoters)
+
+    # 缓存中没有的答案重新获取
+    assert resolver.resolve(upvoters[:1], Mock(url='a3')) == [None]
+    assert upvoters[0].requests == 2
+
+
+def test_resolve_timeout():
+    resolver = UpvoteTimeResolver(max_workers=1, timeout=0.5, cache_size=1)
+    fast, slow = StubUpvoter('fast', ['a1']), StubUpvoter('slow', ['a1'], delay=1)
+    times = resolver.resolve([fast, slow, StubUpvoter('queued', ['a1'])],
+                             Mock(url='a1'))
+    # 超时的不阻塞, 返回 None 留给插值
+    assert times == [datetime(2016, 1, 9), None, None]
+    time.sleep(1)
+    assert list(resolver.cache) == ['slow']  # 执行中的请求完成后写入缓存
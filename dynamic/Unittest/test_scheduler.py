@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+from scheduler import TaskScheduler
+from task import FetchAnswerInfo, FetchQuestionInfo
+from common import *
+
+
+def test_task_scheduler():
+    scheduler = TaskScheduler()
+    hot, quiet, new = Mock(interval=10), Mock(interval=100), Mock(spec=[])
+    scheduler.append(quiet, now=0)
+    scheduler.append(hot, now=0)
+    scheduler.append(new, now=0)  # 没有 interval, 立即到期
+    assert len(scheduler) == 3
+    assert list(scheduler) == [new, hot, quiet]
+    assert scheduler.pop_due(now=0) == [new]
+    assert scheduler.wait_time(60, now=0) == 10
+    assert scheduler.pop_due(now=10) == [hot]
+
+    # 再次 append 替换之前的时间
+    scheduler.append(quiet, now=10)
+    scheduler.append(hot, now=10)
+    assert scheduler.pop_due(now=100) == [hot]
+    assert len(scheduler) == 1 and scheduler[0] is quiet
+    assert scheduler.pop_due(now=109) == []
+    assert scheduler.remove(lambda task: task is quiet) == [quiet]
+    assert len(scheduler) == 0 and scheduler.pop_due(now=1000) == []
+    assert scheduler.wait_time(60) == 60
+
+
+def test_answer_interval():
+    task = FetchAnswerInfo(test_tid, 'q1')
+    assert task.interval == ANSWER_TASKLOOP_INTERVAL
+
+    # 没有新 event 时间隔逐渐变长, 直到上限
+    intervals = []
+    for _ in range(10):
+        task.last_poll = datetime.now() - timedelta(seconds=task.interval)
+        task._update_interval(0)
+        intervals.append(task.interval)
+    assert intervals == sorted(intervals) and intervals[0] > ANSWER_TASKLOOP_INTERVAL
+    assert intervals[-1] == MAX_ANSWER_INTERVAL
+
+    # 新 event 很多时间隔缩短到下限
+    for _ in range(3):
+        task.last_poll = datetime.now() - timedelta(seconds=task.interval)
+        task._update_interval(100)
+    assert task.interval == MIN_ANSWER_INTERVAL
+
+
+def test_question_interval():
+    question = Mock(id=1, deleted=False, author=Mock(id='asker'), title='t')
+    task = FetchQuestionInfo(test_tid, question)
+    assert task.interval == QUESTION_TASKLOOP_INTERVAL
+
+    # 还没有答案的问题不推迟
+    for _ in range(10):
+        task.last_poll = datetime.now() - timedelta(seconds=task.interval)
+        task._update_interval(0)
+    assert task.interval == QUESTION_TASKLOOP_INTERVAL
+
+    # 新答案多时间隔缩短
+    task.answer_num = 100
+    task.last_update_time = datetime.now()
+    task.last_poll = datetime.now() - timedelta(seconds=task.interval)
+    task._update_interval(100)
+    assert task.interval == MIN_QUESTION_INTERVAL
+
+    # 一直没有新答案, 不超过 QUESTION_TASKLOOP_INTERVAL, 接近 inactive 时才加倍
+    for _ in range(10):
+        task.last_poll = datetime.now() - timedelta(seconds=task.interval)
+        task._update_interval(0)
+    assert task.interval == QUESTION_TASKLOOP_INTERVAL
+    task.last_update_time = datetime.now() - QUESTION_INACTIVE_INTERVAL * 0.3
+    task._update_interval(0)
+    assert task.interval == QUESTION_TASKLOOP_INTERVAL * 2
+    task.last_update_time = datetime.now() - QUESTION_INACTIVE_INTERVAL * 0.9
+    task._update_interval(0)
+    assert task.interval == MAX_QUESTION_INTERVAL
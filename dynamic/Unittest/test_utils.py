@@ -59,3 +59,13 @@ def test_get_datetime_day_month_year():
     time_string = '2016-01-01'
     assert get_datetime_day_month_year(time_string) == \
            datetime(2016, 1, 1, 0, 0, 0)
+
+
+def test_bloom_filter():
+    from bloom import BloomFilter
+    bloom = BloomFilter(1000)
+    bloom.update('u%d' % i for i in range(1000))
+    assert all('u%d' % i in bloom for i in range(1000))
+    assert bloom.full() and len(bloom) == 1000
+    false_positives = sum('x%d' % i in bloom for i in range(10000))
+    assert false_positives < 300
@@ -0,0 +1,48 @@
+# coding: utf-8
+
+"""
+判断 uid 是否见过的 Bloom filter, 用于答案的已知 upvoter
+"""
+
+import math
+import hashlib
+
+
+class BloomFilter:
+    """
+    不会漏判, 误判率在元素个数不超过 capacity 时约为 error_rate
+    每个元素约占 1.2 字节(error_rate=0.01), 比保存 uid 的 set 小得多
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_num = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # 用两个 hash 组合出 hash_num 个位置 (Kirsch-Mitzenmacher)
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_num)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count >= self.capacity
@@ -42,10 +42,14 @@ class _ClientPool:
         if type == 'mesh':
             client.set_proxy_pool(self.proxies_mesh, auth=self.auth_mesh,
                                   https=False)
+            proxy_pool = (self.proxies_mesh, self.auth_mesh, False)
         elif type == 'kunpeng':
             client.set_proxy_pool(self.proxies_kunpeng)
+            proxy_pool = (self.proxies_kunpeng, None, True)
         else:
             raise Exception("no such proxy type" + type)
+        # engine.AsyncClient 用同样的代理
+        client._session.proxy_pool = proxy_pool
         self.clients.append(client)
         self.POOL_SIZE += 1
 
@@ -1,8 +1,8 @@
 import os
 from datetime import timedelta, datetime
-from collections import deque
 
 import ezcf
+import config.dynamic_config as dynamic_config
 from config.dynamic_config import topics, ANSWER_TASKLOOP_INTERVAL, \
                 MAX_ANSWER_TASK_EXECUTION_TIME, FETCH_QUESTION_INTERVAL, restart, \
                 fetch_new, fetch_old, QUESTION_INACTIVE_INTERVAL, \
@@ -11,11 +11,14 @@ from config.dynamic_config import topics, ANSWER_TASKLOOP_INTERVAL, \
 from zhihu import ANONYMOUS
 from zhihu.acttype import ActType
 
+from scheduler import TaskScheduler
+
 FOLLOW_QUESTION = ActType.FOLLOW_QUESTION
 ANSWER_QUESTION = ActType.ANSWER_QUESTION
 
-answer_task_queue = deque()
-question_task_queue = deque()
+# 按每个答案/问题的下次执行时间排序
+answer_task_queue = TaskScheduler()
+question_task_queue = TaskScheduler()
 cancelled_questions = set()
 
 # zhihu-analysis folder
@@ -33,6 +36,22 @@ MAX_NO_ANSWER_INTERVAL = timedelta(minutes=MAX_NO_ANSWER_INTERVAL)
 QUESTION_INACTIVE_INTERVAL = timedelta(hours=QUESTION_INACTIVE_INTERVAL)
 ANSWER_INACTIVE_INTERVAL = timedelta(hours=ANSWER_INACTIVE_INTERVAL)
 epoch = datetime(1970, 1, 1)
+# 新答案的 upvoters/commenters/collectors 和新问题的 follower 存入 <tid>_e 的 bucket,
+# 用户的 follower/followee 快照存入 USER_SNAPSHOT_COLL, 而不是存在一个 doc 里
+# 旧配置文件没有这一项, 默认不开启
+bucket_events = getattr(dynamic_config, 'bucket_events', False)
+EVENT_KINDS = ('upvoters', 'commenters', 'collectors')
+BUCKET_SIZE = 1000  # 每个 bucket 最多存多少个 event
+USER_SNAPSHOT_COLL = 'user_snapshot'
+USER_BUCKET_SIZE = 5000  # 每个快照 bucket 最多存多少个 uid
+# 快照存在 user doc 里时, follower/followee 超过这个数就不抓, 以免 doc 过大
+MAX_EMBEDDED_FOLLOW = 2000
+# 重启时批量读取问题和答案的少数字段, task 第一次执行时才访问网络, 见 TopicMonitor
+fast_restart = getattr(dynamic_config, 'fast_restart', False)
+# 用 engine.TaskEngine 代替 AnswerTaskLoop 和 QuestionTaskLoop
+async_engine = getattr(dynamic_config, 'async_engine', False)
+# 同时执行的 task 上限, TaskEngine 的 Semaphore 或者两个 TaskLoop 各自的线程数
+MAX_CONCURRENT_TASKS = getattr(dynamic_config, 'MAX_CONCURRENT_TASKS', 200)
 
 if hasattr(os, '_called_from_test'):
     ANSWER_TASKLOOP_INTERVAL = 5
@@ -45,6 +64,24 @@ if hasattr(os, '_called_from_test'):
     fetch_old = True
     fetch_new = True
 
+# 每个答案/问题的执行间隔, 根据最近的新增 event/答案速率调整, 见 scheduler.adapt_interval
+MIN_ANSWER_INTERVAL = ANSWER_TASKLOOP_INTERVAL / 4
+MAX_ANSWER_INTERVAL = ANSWER_TASKLOOP_INTERVAL * 8
+TARGET_EVENTS_PER_POLL = 5  # 期望每次执行抓到的新 event 数
+MIN_QUESTION_INTERVAL = QUESTION_TASKLOOP_INTERVAL / 4
+MAX_QUESTION_INTERVAL = QUESTION_TASKLOOP_INTERVAL * 8
+QUESTION_BACKOFF_STEPS = 4  # 没有新答案的时间每过 QUESTION_INACTIVE_INTERVAL 的 1/4, 间隔加倍
+TARGET_ANSWERS_PER_POLL = 1  # 期望每次执行抓到的新答案数
+EVENT_RATE_DECAY = 0.5  # 新速率的权重, 没有新 event 时速率按这个比例衰减
+# 抓 upvoter 时用来判断是否已记录的最近 upvoter 数, 见 AnswerManager.known_upvoters
+KNOWN_UPVOTER_WINDOW = 1000
+KNOWN_UPVOTER_STREAK = 2  # 连续遇到几个已记录的 upvoter 就停止, 防止 Bloom filter 误判
+UPVOTER_SCAN_SLACK = 10  # 最多看 新增赞数+这个数 个 upvoter, 留给取消赞的人
+# 并发获取点赞时间的线程数, 缓存多少个用户的点赞, 以及每个 task 最多等多久, 见 resolver.py
+UPVOTE_TIME_WORKERS = 50
+UPVOTE_CACHE_SIZE = 10000
+UPVOTE_TIME_TIMEOUT = ANSWER_TASKLOOP_INTERVAL / 2
+
 
 if not os.path.exists(os.path.join(ROOT, 'dynamic/logs')):
     os.mkdir(os.path.join(ROOT, 'dynamic/logs'))
@@ -4,9 +4,46 @@
 数据库接口
 """
 
-from pymongo import MongoClient
+import logging
+
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, DuplicateKeyError
 
 from utils import *
+from common import bucket_events, EVENT_KINDS, BUCKET_SIZE, USER_SNAPSHOT_COLL
+
+logger = logging.getLogger(__name__)
+
+# 每种 collection 需要的索引, [(keys, 索引名, 是否 unique)]
+QUESTION_INDEXES = [
+    ([('qid', ASCENDING)], 'qid', False),
+    ([('time', DESCENDING)], 'time', False),
+]
+ANSWER_INDEXES = [
+    ([('aid', ASCENDING)], 'aid', False),
+    ([('qid', ASCENDING), ('time', ASCENDING)], 'qid_time', False),
+    ([('time', DESCENDING)], 'time', False),
+]
+USER_INDEXES = [
+    ([('uid', ASCENDING)], 'uid', False),
+]
+# 同一个 (owner, kind, seq) 只能有一个 bucket, 见 _append_events
+# answer 和 question 的 bucket 在同一个 collection, unique 索引只包含有对应字段的
+EVENT_INDEXES = [
+    ([('aid', ASCENDING), ('kind', ASCENDING), ('seq', ASCENDING)], 'aid_kind_seq', True),
+    ([('qid', ASCENDING), ('kind', ASCENDING), ('seq', ASCENDING)], 'qid_kind_seq', True),
+]
+# 和 event 数组同步 $inc 的计数, 读数量时不再用 $size 遍历数组
+EVENT_COUNTERS = {
+    'upvoters': 'upvote_count',
+    'commenters': 'commenter_count',
+    'collectors': 'collector_count',
+    'follower': 'follower_count',
+}
+USER_SNAPSHOT_INDEXES = [
+    ([('uid', ASCENDING), ('kind', ASCENDING), ('snap', ASCENDING),
+      ('seq', ASCENDING)], 'uid_kind_snap_seq', False),
+]
 
 
 class DB:
@@ -14,6 +51,127 @@ class DB:
     尽可能不对 doc 作处理，直接返回 query 的结果。由 manager 作进一步处理。
     """
     db = MongoClient('127.0.0.1', 27017).zhihu_data
+    indexed = set()  # 已经建好索引的 collection name
+    # 新答案/问题/用户快照是否使用 bucket 存储, 见 common.bucket_events
+    bucket_events = bucket_events
+
+    @classmethod
+    def ensure_indexes(cls, tids=()):
+        """
+        为 tids 以及数据库中已有的所有 question/answer collection 和 user 建索引,
+        已有相同 key 的索引时跳过, 不论索引名是什么. 之后新建的 topic collection
+        在第一次写入时由 _ensure_topic_indexes 建索引
+        :return: 缺少索引的 collection name list, 正常应为空
+        """
+        tids = set(tids)
+        for collection_name in cls.db.collection_names():
+            if is_q_col(collection_name) or is_a_col(collection_name) or \
+                    is_e_col(collection_name):
+                tids.add(collection_name[:-2])
+        cls.indexed.clear()
+        for tid in tids:
+            cls._ensure_topic_indexes(tid)
+        cls._create_indexes('user', USER_INDEXES)
+        if cls.bucket_events or \
+                USER_SNAPSHOT_COLL in cls.db.collection_names():
+            cls._create_indexes(USER_SNAPSHOT_COLL, USER_SNAPSHOT_INDEXES)
+            cls.indexed.add(USER_SNAPSHOT_COLL)
+
+        # 检查索引是否都建好了
+        missing = []
+        for tid in tids:
+            missing.extend(cls._missing_indexes(q_col(tid), QUESTION_INDEXES))
+            missing.extend(cls._missing_indexes(a_col(tid), ANSWER_INDEXES))
+            if e_col(tid) in cls.indexed:
+                missing.extend(cls._missing_indexes(e_col(tid), EVENT_INDEXES))
+        missing.extend(cls._missing_indexes('user', USER_INDEXES))
+        if USER_SNAPSHOT_COLL in cls.indexed:
+            missing.extend(cls._missing_indexes(USER_SNAPSHOT_COLL,
+                                                USER_SNAPSHOT_INDEXES))
+        for collection_name in missing:
+            logger.error("index missing in " + collection_name)
+        return missing
+
+    @classmethod
+    def _ensure_topic_indexes(cls, tid):
+        if tid in cls.indexed:
+            return
+        cls._create_indexes(q_col(tid), QUESTION_INDEXES)
+        cls._create_indexes(a_col(tid), ANSWER_INDEXES)
+        # 不使用 bucket 时不创建空的 event collection
+        if cls.bucket_events or e_col(tid) in cls.db.collection_names():
+            cls._create_indexes(e_col(tid), EVENT_INDEXES)
+            cls.indexed.add(e_col(tid))
+        cls.indexed.add(tid)
+
+    @classmethod
+    def _create_indexes(cls, collection_name, indexes):
+        """
+        只创建还没有的索引. 手动建的索引名通常是默认的 qid_1 之类,
+        用同样的 key 和另一个名字再建会 IndexOptionsConflict
+        已有的同 key 索引不是 unique 时不自动删除重建(可能已经有重复的数据),
+        由 _missing_indexes 报告
+        """
+        existing = cls._existing_keys(collection_name)
+        for keys, name, unique in indexes:
+            if tuple(keys) in existing:
+                if existing[tuple(keys)] != unique:
+                    logger.error("index %s in %s should be unique, drop it and "
+                                 "rerun ensure_indexes" % (name, collection_name))
+                continue
+            options = {'unique': True, 'partialFilterExpression': {
+                keys[0][0]: {'$exists': True}}} if unique else {}
+            cls.db[collection_name].create_index(keys, name=name,
+                                                 background=True, **options)
+
+    @classmethod
+    def _missing_indexes(cls, collection_name, indexes):
+        existing = cls._existing_keys(collection_name)
+        if all(existing.get(tuple(keys)) == unique for keys, _, unique in indexes):
+            return []
+        return [collection_name]
+
+    @classmethod
+    def _existing_keys(cls, collection_name):
+        """
+        :return: {已有索引的 key: 是否 unique}, key 为 ((field, direction), ...)
+        """
+        info = cls.db[collection_name].index_information()
+        return {tuple(tuple(key) for key in index['key']): index.get('unique', False)
+                for index in info.values()}
+
+    @classmethod
+    def index_stats(cls):
+        """
+        各索引从 mongod 启动以来的使用次数, 需要 MongoDB 3.2+
+        :return: {collection_name: {index_name: ops}}
+        """
+        stats = {}
+        for collection_name in cls.db.collection_names():
+            if 'system' in collection_name:
+                continue
+            try:
+                cursor = cls.db[collection_name].aggregate([{'$indexStats': {}}])
+            except OperationFailure:
+                return stats
+            stats[collection_name] = {
+                doc['name']: doc['accesses']['ops'] for doc in cursor
+            }
+        return stats
+
+    @classmethod
+    def report_index_usage(cls):
+        """
+        输出各索引的使用次数, 没有被使用过的索引单独列出
+        """
+        unused = []
+        for collection_name, usage in sorted(cls.index_stats().items()):
+            logger.info("index usage of %s: %s" % (collection_name, usage))
+            unused.extend('%s.%s' % (collection_name, name)
+                          for name, ops in usage.items()
+                          if ops == 0 and name != '_id_')
+        if unused:
+            logger.info("unused indexes: " + ', '.join(unused))
 
     @classmethod
     def find_user(cls):
@@ -25,16 +183,16 @@ class DB:
 
     @classmethod
     def find_latest_question(cls, tid):
-        # TODO: so ask: 如何建索引?
-        cursor = cls.db[q_col(tid)].find().sort('time', -1)
-        if cursor.count() > 0:
-            return cursor[0]
-        else:
-            return None
+        # 使用 time 索引, 不再对整个 collection 排序
+        return cls.db[q_col(tid)].find_one(sort=[('time', DESCENDING)])
 
     @classmethod
-    def save_question(cls, tid, url, qid, time, asker, title):
-        cls.db[q_col(tid)].insert({
+    def save_question(cls, tid, url, qid, time, asker, title, bucketed=False):
+        """
+        :param bucketed: follower 存入 <tid>_e 的 bucket, question doc 中始终为空
+        """
+        cls._ensure_topic_indexes(tid)
+        doc = {
             'topic': str(tid),
             'url': url,
             'qid': str(qid),
@@ -42,41 +200,65 @@ class DB:
             'asker': asker,
             'title': title,
             'follower': [],
+            'follower_count': 0,
             'active': True
-        })
+        }
+        if bucketed:
+            doc['bucketed'] = True
+        cls.db[q_col(tid)].insert(doc)
 
     @classmethod
-    def add_question_follower(cls, tid, qid, new_followers):
-        cls.db[q_col(tid)].update({'qid': str(qid)}, {
-            '$push': {
+    def add_question_follower(cls, tid, qid, new_followers, bucketed=False):
+        new_followers = list(new_followers)
+        update = {'$inc': {'follower_count': len(new_followers)}}
+        if bucketed:
+            cls._append_events(tid, {'qid': str(qid)}, 'follower', new_followers)
+        else:
+            update['$push'] = {
                 'follower': {
-                    '$each': list(new_followers)
+                    '$each': new_followers
                 }
             }
-        })
+        cls.db[q_col(tid)].update_one({'qid': str(qid)}, update)
 
     @classmethod
     def get_question_follower(cls, tid, qid, limit=None):
         if limit is None:
-            return cls.db[q_col(tid)].\
-                find_one({'qid': str(qid)}, {'follower': 1, '_id':0})['follower']
+            projection = {'follower': 1, 'bucketed': 1, '_id': 0}
         else:
-            limit *= -1
-            return cls.db[q_col(tid)]. \
-                find_one({'qid': str(qid)},
-                         {'follower': {'$slice': limit}, '_id':0})['follower']
+            projection = {'follower': {'$slice': -limit}, '_id': 0}
+        doc = cls.db[q_col(tid)].find_one({'qid': str(qid)}, projection)
+        if doc.get('bucketed'):
+            return cls._load_events(tid, {'qid': str(qid)}, 'follower', limit)
+        return doc['follower']
 
     @classmethod
     def get_question_follower_num(cls, tid, qid):
+        doc = cls.db[q_col(tid)].find_one({'qid': str(qid)},
+                                          {'follower_count': 1, '_id': 0})
+        if 'follower_count' in doc:
+            return doc['follower_count']
+        # 加入计数之前的 question doc, 数一次后补上
+        follower_count = cls._count_question_follower(tid, qid)
+        cls.db[q_col(tid)].update_one({'qid': str(qid)},
+                                      {'$set': {'follower_count': follower_count}})
+        return follower_count
+
+    @classmethod
+    def _count_question_follower(cls, tid, qid):
         cursor = cls.db[q_col(tid)].aggregate([
             {'$match': {'qid': str(qid)}},
             {
                 '$project': {
-                    'follower_count': {'$size': "$follower"}
+                    'follower_count': {'$size': "$follower"},
+                    'bucketed': 1,
                 }
             }
         ])
-        return list(cursor)[0]['follower_count']
+        doc = list(cursor)[0]
+        if doc.get('bucketed'):
+            return cls._count_events(tid, {'qid': str(qid)})['follower']
+        return doc['follower_count']
 
     @classmethod
     def set_question_inactive(cls, tid, qid):
@@ -91,12 +273,17 @@ class DB:
 
     @classmethod
     def save_answer(cls, tid, aid, url, qid, time, answerer, upvoters=None,
-                    commenters=None, collectors=None):
+                    commenters=None, collectors=None, bucketed=False):
+        """
+        :param bucketed: upvoters/commenters/collectors 存入 bucket, answer doc 中
+                         这三项始终为空
+        """
         upvoters = [] if upvoters is None else upvoters
         commenters = [] if commenters is None else commenters
         collectors = [] if collectors is None else collectors
 
-        cls.db[a_col(tid)].insert({
+        cls._ensure_topic_indexes(tid)
+        doc = {
             'topic': str(tid),
             'aid': str(aid),
             'url': url,
@@ -105,8 +292,17 @@ class DB:
             'answerer': answerer,
             'upvoters': upvoters,
             'commenters': commenters,
-            'collectors': collectors
-        })
+            'collectors': collectors,
+            'upvote_count': len(upvoters),
+            'commenter_count': len(commenters),
+            'collector_count': len(collectors)
+        }
+        if bucketed:
+            doc.update(upvoters=[], commenters=[], collectors=[], bucketed=True)
+        cls.db[a_col(tid)].insert(doc)
+        if bucketed:
+            for kind, events in zip(EVENT_KINDS, (upvoters, commenters, collectors)):
+                cls._append_events(tid, {'aid': str(aid)}, kind, events)
 
     @classmethod
     def get_question(cls, tid, qid):
@@ -127,6 +323,23 @@ class DB:
 
         return result
 
+    @classmethod
+    def get_stored_topics(cls):
+        return [collection_name[:-2] for collection_name in
+                cls.db.collection_names() if is_q_col(collection_name)]
+
+    @classmethod
+    def get_active_questions(cls, tid, *args):
+        fields = {arg: 1 for arg in args}
+        fields['_id'] = 0
+        return cls.db[q_col(tid)].find({'active': True}, fields)
+
+    @classmethod
+    def get_answers_of_questions(cls, tid, qids, *args):
+        fields = {arg: 1 for arg in args}
+        fields['_id'] = 0
+        return cls.db[a_col(tid)].find({'qid': {'$in': list(qids)}}, fields)
+
     @classmethod
     def get_question_attrs(cls, tid, qid, *args):
         fields = {arg: 1 for arg in args}
@@ -135,6 +348,7 @@ class DB:
     @classmethod
     def remove_question(cls, tid, qid):
         cls.db[q_col(tid)].remove({'qid': str(qid)})
+        cls.db[e_col(tid)].delete_many({'qid': str(qid)})
 
     @classmethod
     def answer_exists(cls, tid, aid):
@@ -143,7 +357,11 @@ class DB:
 
     @classmethod
     def get_one_answer(cls, tid, aid):
-        return cls.db[a_col(tid)].find_one({'aid': str(aid)})
+        answer_doc = cls.db[a_col(tid)].find_one({'aid': str(aid)})
+        if answer_doc and answer_doc.get('bucketed'):
+            for kind in EVENT_KINDS:
+                answer_doc[kind] = cls._load_events(tid, {'aid': str(aid)}, kind)
+        return answer_doc  # None or dict
 
     @classmethod
     def get_answer_affected_user_with_limit(cls, tid, aid, limit=5):
@@ -165,47 +383,157 @@ class DB:
     @classmethod
     def _get_answer_affected_user(cls, tid, aid, fields, limit=None):
         if limit is None:
-            fields = {field: 1 for field in fields}
-            return cls.db[a_col(tid)].find_one({'aid': str(aid)}, fields)
+            projection = {field: 1 for field in fields}
+            projection['bucketed'] = 1
         else:
-            limit *= -1
-            fields = {field: {'$slice': limit} for field in fields}
-            return cls.db[a_col(tid)].find_one({'aid': str(aid)}, fields)
+            projection = {field: {'$slice': -limit} for field in fields}
+        answer_doc = cls.db[a_col(tid)].find_one({'aid': str(aid)}, projection)
+        if answer_doc and answer_doc.get('bucketed'):
+            for field in fields:
+                answer_doc[field] = cls._load_events(tid, {'aid': str(aid)}, field,
+                                                      limit)
+        return answer_doc
 
     @classmethod
-    def add_upvoters(cls, tid, aid, new_upvoters):
-        cls.db[a_col(tid)].update({'aid': str(aid)}, {
-            '$push': {
-                'upvoters': {
-                    '$each': list(new_upvoters)
-                }
-            }
-        })
+    def _load_events(cls, tid, owner, kind, limit=None):
+        """
+        按时间顺序读取 bucket 中的 event
+        :param owner: {'aid': aid} 或 {'qid': qid}
+        :param limit: 只取最后 limit 个, 从最新的 bucket 往前读, 够了就停
+        """
+        query = dict(owner, kind=kind)
+        projection = {'events': 1, '_id': 0}
+        collection = cls.db[e_col(tid)]
+        if limit is None:
+            events = []
+            for bucket in collection.find(query, projection).sort('seq', ASCENDING):
+                events.extend(bucket['events'])
+            return events
+
+        buckets = []
+        count = 0
+        for bucket in collection.find(query, projection).sort('seq', DESCENDING):
+            buckets.append(bucket['events'])
+            count += len(bucket['events'])
+            if count >= limit:
+                break
+        events = [event for bucket in reversed(buckets) for event in bucket]
+        return events[-limit:] if limit > 0 else []
+
+    @classmethod
+    def _append_events(cls, tid, owner, kind, events):
+        """
+        追加到 (owner, kind) 最新的 bucket, 满了就新建一个, 不再改写 answer/question doc
+        同一个问题的 follower 可能有多个 huey 任务同时在写, 所以:
+        1. 追加时用 count 作条件, 放不下说明被别人写过, 重新读取最新的 bucket
+        2. 新 bucket 用 insert, (owner, kind, seq) 是 unique 索引, 被别人抢先时同上
+        """
+        if not events:
+            return
+        collection = cls.db[e_col(tid)]
+        query = dict(owner, kind=kind)
+        events = list(events)
+        i = 0
+        last = None
+        while i < len(events):
+            if last is None:
+                last = collection.find_one(query, {'seq': 1, 'count': 1},
+                                           sort=[('seq', DESCENDING)]) \
+                    or {'seq': -1, 'count': BUCKET_SIZE}
+            seq, count = last['seq'], last['count']
+            if count < BUCKET_SIZE:
+                chunk = events[i:i + BUCKET_SIZE - count]
+                result = collection.update_one(
+                    dict(query, seq=seq,
+                         count={'$lte': BUCKET_SIZE - len(chunk)}),
+                    {
+                        '$push': {'events': {'$each': chunk}},
+                        '$inc': {'count': len(chunk)}
+                    }
+                )
+                if not result.modified_count:
+                    last = None
+                    continue
+                count += len(chunk)
+            else:
+                chunk = events[i:i + BUCKET_SIZE]
+                try:
+                    collection.insert_one(dict(query, seq=seq + 1,
+                                               count=len(chunk), events=chunk))
+                except DuplicateKeyError:
+                    last = None
+                    continue
+                seq, count = seq + 1, len(chunk)
+            last = {'seq': seq, 'count': count}
+            i += len(chunk)
 
     @classmethod
-    def add_commenters(cls, tid, aid, new_commenters):
+    def _count_events(cls, tid, owner):
+        """
+        :return: {kind: event 个数}, 只读 bucket 的 count
+        """
+        counts = {kind: 0 for kind in EVENT_KINDS + ('follower',)}
+        for bucket in cls.db[e_col(tid)].find(owner, {'kind': 1, 'count': 1}):
+            counts[bucket['kind']] += bucket['count']
+        return counts
+
+    @classmethod
+    def add_upvoters(cls, tid, aid, new_upvoters, bucketed=False):
+        cls._add_answer_events(tid, aid, 'upvoters', new_upvoters, bucketed)
+
+    @classmethod
+    def add_commenters(cls, tid, aid, new_commenters, bucketed=False):
+        cls._add_answer_events(tid, aid, 'commenters', new_commenters, bucketed)
+
+    @classmethod
+    def add_collectors(cls, tid, aid, new_collectors, bucketed=False):
+        cls._add_answer_events(tid, aid, 'collectors', new_collectors, bucketed)
+
+    @classmethod
+    def _add_answer_events(cls, tid, aid, kind, events, bucketed):
+        """
+        追加 event, 同一次 update 中 $inc 对应的计数
+        """
         # pymongo不识别deque,只能转为list
-        cls.db[a_col(tid)].update({'aid': str(aid)}, {
-            '$push': {
-                'commenters': {
-                    '$each': list(new_commenters)
+        events = list(events)
+        update = {'$inc': {EVENT_COUNTERS[kind]: len(events)}}
+        if bucketed:
+            cls._append_events(tid, {'aid': str(aid)}, kind, events)
+        else:
+            update['$push'] = {
+                kind: {
+                    '$each': events
                 }
             }
-        })
+        cls.db[a_col(tid)].update_one({'aid': str(aid)}, update)
 
     @classmethod
-    def add_collectors(cls, tid, aid, new_collectors):
-        cls.db[a_col(tid)].update({'aid': str(aid)}, {
-           '$push': {
-               'collectors': {
-                   '$each': list(new_collectors)
-               }
-           }
-       })
+    def migrate_answer_events(cls, tid, answer_doc):
+        """
+        把 answer doc 中的 event 搬到 bucket, 用于旧数据迁移
+        只有 answer doc 中的 event 数和读到的一样时才清空, 中间有新 event 写入时
+        删掉这次写的 bucket 并返回 False, 重新读 answer doc 再迁移即可
+        :return: 是否迁移成功
+        """
+        aid = str(answer_doc['aid'])
+        # 上次迁移到一半的 bucket
+        cls.db[e_col(tid)].delete_many({'aid': aid})
+        for kind in EVENT_KINDS:
+            cls._append_events(tid, {'aid': aid}, kind, answer_doc.get(kind, []))
+        query = {'aid': aid, 'bucketed': {'$ne': True}}
+        query.update({kind: {'$size': len(answer_doc.get(kind, []))}
+                      for kind in EVENT_KINDS})
+        update = {kind: [] for kind in EVENT_KINDS}
+        update['bucketed'] = True
+        if cls.db[a_col(tid)].update_one(query, {'$set': update}).modified_count:
+            return True
+        cls.db[e_col(tid)].delete_many({'aid': aid})
+        return False
 
     @classmethod
     def remove_answer(cls, tid, aid):
         cls.db[a_col(tid)].remove({'aid': str(aid)})
+        cls.db[e_col(tid)].delete_many({'aid': str(aid)})
 
     @classmethod
     def get_question_answerer(cls, tid, qid):
@@ -224,15 +552,38 @@ class DB:
         for collection_name in cls.db.collection_names():
             if 'system' not in collection_name:
                 cls.db[collection_name].drop()
+        cls.indexed.clear()
 
     @classmethod
     def drop_qa_collections(cls):
         for collection_name in cls.db.collection_names():
-            if 'system' not in collection_name and collection_name != 'user':
+            if 'system' not in collection_name and \
+                    collection_name not in ('user', USER_SNAPSHOT_COLL):
                 cls.db[collection_name].drop()
+        cls.indexed.clear()
 
     @classmethod
     def get_answer_affecter_num(cls, tid, aid):
+        counters = [EVENT_COUNTERS[kind] for kind in EVENT_KINDS]
+        doc = cls.db[a_col(tid)].find_one(
+            {'aid': str(aid)}, dict({counter: 1 for counter in counters}, _id=0))
+        if any(counter not in doc for counter in counters):
+            # 加入计数之前的 answer doc, 数一次后补上
+            doc = cls._count_answer_events(tid, aid)
+            cls.db[a_col(tid)].update_one({'aid': str(aid)}, {'$set': {
+                'upvote_count': doc['up_count'],
+                'commenter_count': doc['com_count'],
+                'collector_count': doc['col_count'],
+            }})
+            return doc
+        return {
+            'up_count': doc['upvote_count'],
+            'com_count': doc['commenter_count'],
+            'col_count': doc['collector_count'],
+        }
+
+    @classmethod
+    def _count_answer_events(cls, tid, aid):
         cursor = cls.db[a_col(tid)].aggregate([
             {'$match': {'aid': str(aid)}},
             {
@@ -240,7 +591,13 @@ class DB:
                     'up_count': {'$size': "$upvoters"},
                     'com_count': {'$size': "$commenters"},
                     'col_count': {'$size': "$collectors"},
+                    'bucketed': 1,
                 }
             }
         ])
-        return list(cursor)[0]
+        doc = list(cursor)[0]
+        if doc.get('bucketed'):
+            counts = cls._count_events(tid, {'aid': str(aid)})
+            doc.update(up_count=counts['upvoters'], com_count=counts['commenters'],
+                       col_count=counts['collectors'])
+        return doc
@@ -0,0 +1,284 @@
+# coding: utf-8
+
+"""
+用 asyncio 执行 answer/question task, 代替 AnswerTaskLoop 和 QuestionTaskLoop
+每个 zhihu client 的 requests.Session 对应一个 aiohttp session (AsyncClient),
+共用 cookie, header 和代理. task 的 refresh 和 upvoter/comment/collection 翻页
+在 event loop 中异步请求, 响应仍然交给 zhihu 的对象解析:
+1. 同时执行的 task 数由 Semaphore 限制, 上限为 MAX_CONCURRENT_TASKS, 不受线程数限制
+2. 数据库读写, 点赞/收藏时间, 问题的新答案仍然是阻塞调用, 由 run_blocking 放到线程池
+3. 上一轮没执行完的 task 不会被重复执行, 留到下一轮
+4. 只执行已到期的 task, 见 scheduler.TaskScheduler
+"""
+
+import math
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from zhihu import Answer, Author, Collection, ANONYMOUS
+from zhihu.comment import Comment
+from zhihu.common import BeautifulSoup, Zhihu_URL
+
+from common import *
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = Zhihu_URL  # 请求的地址, 测试时换成本地的 http server
+REQUEST_TIMEOUT = 30  # 单个请求的超时时间(秒)
+COMMENT_PAGE_SIZE = 30
+COLLECTION_PAGE_SIZE = 10  # 一页不足这么多说明是最后一页
+
+
+class AsyncClient:
+    """
+    zhihu client 的 requests.Session 对应的 aiohttp session
+    代理见 client_pool._ClientPool.add_client, 每个请求随机选一个
+    """
+
+    def __init__(self, session, timeout=REQUEST_TIMEOUT):
+        self.session = aiohttp.ClientSession(
+            headers=dict(session.headers),
+            cookies={cookie.name: cookie.value for cookie in session.cookies},
+            timeout=aiohttp.ClientTimeout(total=timeout))
+        proxies, auth, https = getattr(session, 'proxy_pool', ((), None, False))
+        self.proxies = list(proxies)
+        self.proxy_auth = aiohttp.BasicAuth(auth.username, auth.password) \
+            if auth else None
+        self.https_proxy = https
+
+    def _proxy(self, url):
+        if not self.proxies or (url.startswith('https') and not self.https_proxy):
+            return {}
+        return {'proxy': random.choice(self.proxies), 'proxy_auth': self.proxy_auth}
+
+    async def get(self, url, **kwargs):
+        """
+        :return: (status, 跳转后的 url, content)
+        """
+        async with self.session.get(url, **self._proxy(url), **kwargs) as resp:
+            return resp.status, str(resp.url), await resp.read()
+
+    async def get_json(self, url, **kwargs):
+        async with self.session.get(url, **self._proxy(url), **kwargs) as resp:
+            return await resp.json(content_type=None)
+
+    async def post_json(self, url, data):
+        async with self.session.post(url, data=data, **self._proxy(url)) as resp:
+            return await resp.json(content_type=None)
+
+    async def close(self):
+        await self.session.close()
+
+
+class TaskEngine:
+
+    def __init__(self, event, max_concurrency=MAX_CONCURRENT_TASKS):
+        """
+        :param event: stop_fetch_questions_event, 作用和 AnswerTaskLoop 相同
+        """
+        self.event = event
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.semaphore = None  # 第一次 dispatch 时在 loop 中创建
+        self.running = set()  # 正在执行的 task 的 id
+        self.clients = {}  # {id(requests.Session): AsyncClient}
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+
+    async def _main(self):
+        await asyncio.gather(self._answer_loop(), self._question_loop())
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients.clear()
+
+    def client(self, session):
+        """
+        :param session: zhihu 对象的 _session, 同一个 zhihu client 共用一个 AsyncClient
+        """
+        client = self.clients.get(id(session))
+        if client is None:
+            client = self.clients[id(session)] = AsyncClient(session)
+        return client
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def refresh(self, obj):
+        """
+        异步版本的 obj.refresh(), obj 为 zhihu.Answer 或 zhihu.Question
+        和 BaseZhihu._get_content 一样判断是否被删除
+        """
+        url = obj._url if hasattr(obj, '_url') else obj.url
+        status, final_url, content = \
+            await self.client(obj._session).get(url.rstrip('/'))
+        obj._get_content = lambda: content  # 让 refresh 解析已经下载的内容
+        try:
+            obj.refresh()
+        finally:
+            del obj._get_content
+        if isinstance(obj, Answer):
+            obj._deleted = 'answer' not in final_url
+        else:
+            obj._deleted = status == 404
+
+    async def upvoters(self, answer):
+        """
+        同 answer.upvoters, 从新到旧
+        """
+        client = self.client(answer._session)
+        next_req = '/answer/%s/voters_profile' % answer.aid
+        while next_req != '':
+            data = await client.get_json(BASE_URL + next_req)
+            next_req = data['paging']['next']
+            for html in data['payload']:
+                yield answer._parse_author_soup(BeautifulSoup(html))
+
+    async def latest_comments(self, answer):
+        """
+        同 answer.latest_comments, 从最后一页往前读, 较新的先返回
+        """
+        if answer.comment_num == 0:
+            return
+        client = self.client(answer._session)
+        url = BASE_URL + '/r/answers/%s/comments' % answer.aid
+        for page in range(math.ceil(answer.comment_num / COMMENT_PAGE_SIZE), 0, -1):
+            data = await client.get_json(url, params={'page': page})
+            for item in reversed(data['data']):
+                yield self._parse_comment(answer, item)
+
+    @staticmethod
+    def _parse_comment(answer, item):
+        author = item['author']
+        if author.get('url') is not None:
+            avatar = author['avatar']
+            photo_url = avatar['template'].replace(
+                '{id}', avatar['id']).replace('_{size}', '')
+            author = Author(author['url'], author['name'], photo_url=photo_url,
+                            session=answer._session)
+        else:
+            author = ANONYMOUS
+        creation_time = datetime.strptime(item['createdTime'][:19],
+                                          "%Y-%m-%dT%H:%M:%S")
+        return Comment(item['id'], answer, author, item['likesCount'],
+                       item['content'], creation_time)
+
+    async def collections(self, answer):
+        """
+        同 answer.collections, 收藏时间由调用方在线程池中获取
+        """
+        client = self.client(answer._session)
+        offset = 0
+        count = COLLECTION_PAGE_SIZE
+        while count >= COLLECTION_PAGE_SIZE:
+            data = {
+                'method': 'next',
+                '_xsrf': answer.xsrf,
+                'params': '{"answer_url": %d,"offset": %d}' % (answer.id, offset)
+            }
+            msg = (await client.post_json(BASE_URL + '/node/AnswerFavlists',
+                                          data))['msg']
+            count = len(msg)
+            offset += count
+            soup = BeautifulSoup(''.join(msg))
+            for zm_item in soup.find_all('div', class_='zm-item'):
+                links = zm_item.div.find_all('a')
+                owner = Author(links[0]['href'], session=answer._session)
+                yield Collection(Zhihu_URL + zm_item.h2.a['href'], owner=owner,
+                                 name=zm_item.h2.a.text,
+                                 follower_num=int(links[1].text.split()[0]),
+                                 session=answer._session)
+            if count >= COLLECTION_PAGE_SIZE:
+                await asyncio.sleep(0.2)  # prevent from posting too quickly
+
+    async def _execute(self, task):
+        try:
+            async with self.semaphore:
+                if hasattr(task, 'execute_async'):
+                    await task.execute_async(self)
+                else:
+                    await self.run_blocking(task.execute)
+        except Exception:
+            logger.warning("task %s failed" % getattr(task, 'aid', task.qid),
+                           exc_info=True)
+        finally:
+            self.running.discard(id(task))
+
+    def dispatch(self, tasks, queue):
+        """
+        开始执行 tasks
+        :param queue: tasks 所在的队列, 还在执行的 task 放回这里
+        :return: futures
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        futures = []
+        unfinished = []
+        for task in tasks:
+            if id(task) in self.running:
+                # 上一轮还没执行完, 放回 queue 留到下一轮
+                unfinished.append(task)
+                continue
+            self.running.add(id(task))
+            futures.append(self.loop.create_task(self._execute(task)))
+        queue.extend(unfinished)
+        return futures
+
+    async def answer_round(self):
+        """
+        :return: 执行时间
+        """
+        start = time.time()
+        # 一次移除 inactive 问题的所有答案, 不论是否到期
+        cancelled = set(cancelled_questions)
+        for task in answer_task_queue.remove(lambda t: t.qid in cancelled):
+            logger.info("answer " + task.aid + " cancelled with inactive q")
+        cancelled_questions.difference_update(cancelled)
+
+        futures = self.dispatch(answer_task_queue.pop_due(), answer_task_queue)
+        # 即使用时超过也尽可能让它执行完, 没执行完的下一轮不会重复执行
+        if futures:
+            await asyncio.wait(futures, timeout=ANSWER_TASKLOOP_INTERVAL)
+        return time.time() - start
+
+    async def question_round(self):
+        start = time.time()
+        futures = self.dispatch(question_task_queue.pop_due(), question_task_queue)
+        if futures:
+            await asyncio.wait(futures, timeout=QUESTION_TASKLOOP_INTERVAL)
+        return time.time() - start
+
+    async def _answer_loop(self):
+        while True:
+            task_execution_time = await self.answer_round()
+            logger.info("Answer tasks execution time is %d" % task_execution_time)
+
+            if task_execution_time > MAX_ANSWER_TASK_EXECUTION_TIME:
+                if not self.event.is_set():
+                    self.event.set()  # set stop_fetch_questions_event
+                    logger.warning("Stop fetching new questions")
+            elif fetch_new and self.event.is_set():
+                self.event.clear()  # unset stop_fetch_questions_event
+                logger.info("Start fetching new questions")
+            await asyncio.sleep(answer_task_queue.wait_time(MIN_ANSWER_INTERVAL))
+
+    async def _question_loop(self):
+        while True:
+            task_execution_time = await self.question_round()
+            logger.info("Question tasks execution time is %d" % task_execution_time)
+            await asyncio.sleep(question_task_queue.wait_time(MIN_QUESTION_INTERVAL))
@@ -6,7 +6,7 @@ import logging
 import os
 import json
 import logging.handlers
-from functools import reduce, wraps
+from functools import wraps
 from pprint import pprint
 from datetime import datetime
 from collections import deque
@@ -49,6 +49,7 @@ if os.path.isfile(logging_config_file):
 
 db = MongoClient('127.0.0.1', 27017).zhihu_data
 user_coll = db.user
+snapshot_coll = db[USER_SNAPSHOT_COLL]
 
 # 1. 防止两个线程同时抓取一个用户
 # 2. 保证在 retries 用完时才输出错误
@@ -57,10 +58,12 @@ task_info = {}
 
 
 def _replace_database(db_name=None):
-    global user_coll
+    global user_coll, snapshot_coll
     if db_name is not None:
         print("replace called")
-        user_coll = MongoClient('127.0.0.1', 27017).get_database(db_name).user
+        new_db = MongoClient('127.0.0.1', 27017).get_database(db_name)
+        user_coll = new_db.user
+        snapshot_coll = new_db[USER_SNAPSHOT_COLL]
         print(user_coll.full_name)
 
 
@@ -127,119 +130,103 @@ def _fetch_followers_followees(uid, time=None, db_name=None, limit_to=None):
 
 def _fetch_followers(user, time, db_name=None):
     _replace_database(db_name)
-    follower_num = user.follower_num
-    if follower_num > 2000:
-        return
-    doc = user_coll.find_one({'uid': user.id}, {'follower':1, '_id':0})
-    if doc is None:
-        # new user
-        uids = [follower.id for follower in user.followers if follower is not ANONYMOUS]
-        user_coll.insert({
-            'uid': user.id,
-            "follower": [{
-                'time': time,
-                'uids': uids
-            }]
-        })
-    else:
-        # user exists
-        try:
-            if 'follower' in doc:
-                old_followers = set(reduce(lambda x,y: x + y,
-                                    [f['uids'] for f in doc['follower']]))
-                old_follower_num = len(old_followers)
-            else:
-                old_followers = set()
-                old_follower_num = 0
-            # 至少有这么多新的 follower, 考虑取关则可能更多
-            min_follower_increase = follower_num - old_follower_num
-            if min_follower_increase <= 0:
-                # 实际上这个时候也有可能有新follower,无视之,因为概率较小
-                return
-
-            new_followers = []
-            for follower in user.followers:
-                if follower is ANONYMOUS:
-                    min_follower_increase -= 1
-                else:
-                    if follower.id not in old_followers:
-                        new_followers.append(follower.id)
-                    elif min_follower_increase <= 0:
-                        break
-                    min_follower_increase -= 1
-
-            if new_followers:
-                user_coll.update({'uid': user.id}, {
-                    '$push': {
-                        'follower': {
-                            'time': time,
-                            'uids': new_followers
-                        }
-                    }
-                })
-        except Exception as e:
-            raise e
+    _fetch_follow(user.id, 'follower', user.follower_num,
+                  lambda: user.followers, time)
 
 
 def _fetch_followees(user, time, db_name=None):
     _replace_database(db_name)
-    followee_num = user.followee_num
-    if followee_num > 2000:
+    _fetch_follow(user.id, 'followee', user.followee_num,
+                  lambda: user.followees, time)
+
+
+def _fetch_follow(uid, field, num, get_users, time):
+    """
+    抓取新增的 follower 或 followee, 作为一个新快照存入数据库
+    :param field: 'follower' 或 'followee'
+    :param num: 当前的 follower_num 或 followee_num
+    :param get_users: 返回 user.followers 或 user.followees, 需要时才访问
+    """
+    if num > MAX_EMBEDDED_FOLLOW and not bucket_events:
         return
-    doc = user_coll.find_one({'uid': user.id}, {'followee':1, '_id':0})
+    doc = user_coll.find_one({'uid': uid}, {field: 1, '_id': 0})
+    snapshots = doc.get(field, []) if doc is not None else []
     if doc is None:
         # new user
-        uids = [followee.id for followee in user.followees if followee is not ANONYMOUS]
-        user_coll.insert({
-            'uid': user.id,
-            "followee": [{
-                'time': time,
-                'uids': uids
-            }]
-        })
+        new_uids = [u.id for u in get_users() if u is not ANONYMOUS]
     else:
         # user exists
-        try:
-            if 'followee' in doc:
-                old_followees = set(reduce(lambda x,y: x + y,
-                                    [f['uids'] for f in doc['followee']]))
-                old_followee_num = len(old_followees)
+        old_uids = _load_follow_uids(uid, field, snapshots)
+        # 至少有这么多新的 follower, 考虑取关则可能更多
+        min_increase = num - len(old_uids)
+        if min_increase <= 0:
+            # 实际上这个时候也有可能有新follower,无视之,因为概率较小
+            return
+
+        new_uids = []
+        for u in get_users():
+            if u is ANONYMOUS:
+                min_increase -= 1
             else:
-                old_followees = set()
-                old_followee_num = 0
-            # 至少有这么多新的 followee, 考虑取关则可能更多
-            min_followee_increase = followee_num - old_followee_num
-            if min_followee_increase <= 0:
-                # 实际上这个时候也有可能有新followee,无视之,因为概率较小
-                return
-
-            new_followees = []
-            for followee in user.followees:
-                if followee is ANONYMOUS:
-                    min_followee_increase -= 1
-                else:
-                    if followee.id not in old_followees:
-                        new_followees.append(followee.id)
-                    elif min_followee_increase <= 0:
-                        break
-                    min_followee_increase -= 1
-
-            if new_followees:
-                user_coll.update({'uid': user.id}, {
-                    '$push': {
-                        'followee': {
-                            'time': time,
-                            'uids': new_followees
-                        }
-                    }
-                })
-        except Exception as e:
-            raise e
+                if u.id not in old_uids:
+                    new_uids.append(u.id)
+                elif min_increase <= 0:
+                    break
+                min_increase -= 1
+        if not new_uids:
+            return
+
+    _add_snapshot(uid, field, len(snapshots), time, new_uids)
+
+
+def _load_follow_uids(uid, field, snapshots):
+    """
+    :param snapshots: user doc 中的 follower 或 followee
+    :return: 所有快照中的 uid
+    """
+    uids = set()
+    for snapshot in snapshots:
+        uids.update(snapshot.get('uids', []))
+    if any(snapshot.get('bucketed') for snapshot in snapshots):
+        for bucket in snapshot_coll.find(
+                {'uid': uid, 'kind': field, 'snap': {'$lt': len(snapshots)}},
+                {'uids': 1, '_id': 0}):
+            uids.update(bucket['uids'])
+    return uids
+
+
+def _add_snapshot(uid, field, snap, time, uids):
+    """
+    user doc 中只追加 {'time', 'count', 'bucketed'}, uid 按 USER_BUCKET_SIZE
+    分段存入 snapshot_coll: {uid, kind, snap, seq, time, uids}
+    不使用 bucket 时和原来一样把 {'time', 'uids'} 追加到 user doc
+    :param snap: 新快照的下标, 即已有快照个数
+    """
+    if not bucket_events:
+        user_coll.update_one({'uid': uid}, {
+            '$push': {field: {'time': time, 'uids': uids}}
+        }, upsert=True)
+        return
+
+    # 上次写到一半的 bucket
+    snapshot_coll.delete_many({'uid': uid, 'kind': field, 'snap': {'$gte': snap}})
+    buckets = [
+        {'uid': uid, 'kind': field, 'snap': snap, 'seq': seq, 'time': time,
+         'uids': uids[i:i+USER_BUCKET_SIZE]}
+        for seq, i in enumerate(range(0, len(uids), USER_BUCKET_SIZE))
+    ]
+    if buckets:
+        snapshot_coll.insert_many(buckets)
+    # bucket 写完后才追加快照, 读的时候忽略 snap 超出快照个数的 bucket
+    user_coll.update_one({'uid': uid}, {
+        '$push': {field: {'time': time, 'count': len(uids), 'bucketed': True}}
+    }, upsert=True)
 
 
 def remove_all_users(db_name=None):
     _replace_database(db_name)
     user_coll.remove({})
+    snapshot_coll.remove({})
 
 
 def show_users(db_name=None):
@@ -249,11 +236,26 @@ def show_users(db_name=None):
 
 
 def get_user(uid, db_name=None):
+    """
+    bucket 中的快照也填入 uids, 返回的 doc 和不使用 bucket 时格式相同
+    """
     _replace_database(db_name)
-    return user_coll.find_one({'uid': uid})
-
-
-def _fetch_question_follower(tid, qid, asker, db_name=None):
+    doc = user_coll.find_one({'uid': uid})
+    if doc is None:
+        return None
+    for field in ('follower', 'followee'):
+        for snap, snapshot in enumerate(doc.get(field, [])):
+            if snapshot.get('bucketed'):
+                snapshot['uids'] = [
+                    u for bucket in snapshot_coll.find(
+                        {'uid': uid, 'kind': field, 'snap': snap},
+                        {'uids': 1, '_id': 0}).sort('seq', 1)
+                    for u in bucket['uids']
+                ]
+    return doc
+
+
+def _fetch_question_follower(tid, qid, asker, bucketed=False, db_name=None):
     logger.info("fetch question %s follower by asker %s" % (qid, asker))
     from manager import AnswerManager, QuestionManager
     _replace_database(db_name)
@@ -297,7 +299,7 @@ def _fetch_question_follower(tid, qid, asker, db_name=None):
                 })
                 new_follower_uids.add(follower.id)
 
-    QuestionManager.add_question_follower(tid, qid, new_followers)
+    QuestionManager.add_question_follower(tid, qid, new_followers, bucketed)
 
 fetch_followers = huey.task(retries=3, retry_delay=2)(_fetch_followers)
 fetch_followees = huey.task(retries=3, retry_delay=2)(_fetch_followees)
@@ -11,11 +11,13 @@ import logging
 import logging.config
 import concurrent.futures as cf
 from datetime import datetime
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 
 import zhihu
 
 from monitor import TopicMonitor
+from engine import TaskEngine
 from utils import *
 from common import *
 from db import DB
@@ -40,16 +42,48 @@ def install_threadExcepthook():
     threading.Thread.__init__ = init
 
 
+def _task_done(running, key, future):
+    running.discard(key)
+    if future.exception() is not None:
+        logging.getLogger(__name__).warning("task failed",
+                                            exc_info=future.exception())
+
+
+def run_due_tasks(executor, queue, running, timeout):
+    """
+    执行 queue 中已到期的 task, 最多等 timeout 秒, 即使用时超过也让它执行完
+    上一轮还没执行完的 task 不重复执行, 放回 queue 留到下一轮
+    :param running: 正在执行的 task 的 id, 在多轮之间共用
+    """
+    futures = []
+    unfinished = []
+    for task in queue.pop_due():
+        if id(task) in running:
+            unfinished.append(task)
+            continue
+        running.add(id(task))
+        future = executor.submit(task.execute)
+        future.add_done_callback(partial(_task_done, running, id(task)))
+        futures.append(future)
+    queue.extend(unfinished)
+    cf.wait(futures, timeout=timeout, return_when=cf.ALL_COMPLETED)
+
+
 class AnswerTaskLoop(threading.Thread):
 
-    def __init__(self, event, routine=None, *args, **kwargs):
+    def __init__(self, event, routine=None, max_workers=MAX_CONCURRENT_TASKS,
+                 *args, **kwargs):
         self.routine = routine
-        self.executor = ThreadPoolExecutor(max_workers=20)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.running = set()
         self.event = event
-        self.multiple = 0   # ANSWER_TASKLOOP_INTERVAL 翻倍次数
         super().__init__(*args, **kwargs)
 
     def run(self):
+        """
+        每轮只执行已到期的 task, 每个答案的间隔由 FetchAnswerInfo 自己调整.
+        执行超时时 task 的下次执行时间自然推后, 不再统一加倍间隔
+        """
         global cancelled_questions
         while True:
             start = time.time()
@@ -57,54 +91,34 @@ class AnswerTaskLoop(threading.Thread):
             if self.routine and callable(self.routine):
                 self.routine()
 
-            futures = []
-            count = len(answer_task_queue)
-            lst = set()
-            for _ in range(count):
-                task = answer_task_queue.popleft()
-                if task.qid in cancelled_questions:
-                    logger.info(task.answer.url + " cancelled with inactive q")
-                    lst.add(task.qid)
-                else:
-                    futures.append(self.executor.submit(task.execute))
-
-            cancelled_questions -= lst
-            # wait for all tasks to complet
-            # 即使用时超过也尽可能让它执行完
-            cf.wait(futures, timeout=ANSWER_TASKLOOP_INTERVAL,
-                    return_when=cf.ALL_COMPLETED)
+            # 一次移除 inactive 问题的所有答案, 不论是否到期
+            cancelled = set(cancelled_questions)
+            for task in answer_task_queue.remove(lambda t: t.qid in cancelled):
+                logger.info("answer " + task.aid + " cancelled with inactive q")
+            cancelled_questions -= cancelled
+
+            run_due_tasks(self.executor, answer_task_queue, self.running,
+                          ANSWER_TASKLOOP_INTERVAL)
             task_execution_time = time.time() - start
             logger.info("Answer tasks execution time is %d" % task_execution_time)
 
             if task_execution_time > MAX_ANSWER_TASK_EXECUTION_TIME:
-                self.increase_interval()
                 if not self.event.is_set():
                     self.event.set()  # set stop_fetch_questions_event
                     logger.warning("Stop fetching new questions")
-            else:
-                if self.multiple > 0:
-                    self.decrease_interval()
-                time.sleep(ANSWER_TASKLOOP_INTERVAL - task_execution_time)
-                if fetch_new and self.event.is_set():
-                    self.event.clear()  # unset stop_fetch_questions_event
-                    logger.info("Start fetching new questions")
-
-    def increase_interval(self):
-        global ANSWER_TASKLOOP_INTERVAL
-        ANSWER_TASKLOOP_INTERVAL *= 2
-        self.multiple += 1
-
-    def decrease_interval(self):
-        global ANSWER_TASKLOOP_INTERVAL
-        ANSWER_TASKLOOP_INTERVAL /= 2
-        self.multiple -= 1
+            elif fetch_new and self.event.is_set():
+                self.event.clear()  # unset stop_fetch_questions_event
+                logger.info("Start fetching new questions")
+            time.sleep(answer_task_queue.wait_time(MIN_ANSWER_INTERVAL))
 
 
 class QuestionTaskLoop(threading.Thread):
 
-    def __init__(self, routine=None, *args, **kwargs):
+    def __init__(self, routine=None, max_workers=MAX_CONCURRENT_TASKS,
+                 *args, **kwargs):
         self.routine = routine
-        self.executor = ThreadPoolExecutor(max_workers=20)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.running = set()
         super().__init__(*args, **kwargs)
 
     def run(self):
@@ -113,18 +127,11 @@ class QuestionTaskLoop(threading.Thread):
             if self.routine and callable(self.routine):
                 self.routine()
 
-            futures = []
-            count = len(question_task_queue)
-            for _ in range(count):
-                task = question_task_queue.popleft()
-                futures.append(self.executor.submit(task.execute))
-
-            cf.wait(futures, timeout=QUESTION_TASKLOOP_INTERVAL,
-                    return_when=cf.ALL_COMPLETED)
+            run_due_tasks(self.executor, question_task_queue, self.running,
+                          QUESTION_TASKLOOP_INTERVAL)
             task_execution_time = time.time() - start
             logger.info("Question tasks execution time is %d" % task_execution_time)
-            if task_execution_time < QUESTION_TASKLOOP_INTERVAL:
-                time.sleep(QUESTION_TASKLOOP_INTERVAL - task_execution_time)
+            time.sleep(question_task_queue.wait_time(MIN_QUESTION_INTERVAL))
 
 
 def configure():
@@ -146,6 +153,8 @@ def configure():
         DB.drop_qa_collections()
 
     validate_config()
+    DB.ensure_indexes(topics)
+    DB.report_index_usage()
 
     if not validate_cookie(test_cookie):
         logger.error("invalid cookie")
@@ -167,8 +176,11 @@ def main(preroutine=None, postroutine=None):
     stop_fetch_questions_event = threading.Event()
     if not fetch_new:
         stop_fetch_questions_event.set()
-    AnswerTaskLoop(stop_fetch_questions_event, daemon=True).start()
-    QuestionTaskLoop(daemon=True).start()
+    if async_engine:
+        TaskEngine(stop_fetch_questions_event).start()
+    else:
+        AnswerTaskLoop(stop_fetch_questions_event, daemon=True).start()
+        QuestionTaskLoop(daemon=True).start()
     m = TopicMonitor()
 
     while True:
@@ -191,6 +203,7 @@ def main(preroutine=None, postroutine=None):
 
 
 def cleaning():
+    DB.report_index_usage()
     DB.db.client.close()
     logger.info("PROGRAM EXIT\n\n\n")
 
@@ -7,12 +7,13 @@ not aware of zhihu.XXX object
 
 import logging
 from datetime import datetime
-from collections import deque
 
 import zhihu
 
-from common import FETCH_FOLLOWEE, FETCH_FOLLOWER, topics, epoch
+from common import FETCH_FOLLOWEE, FETCH_FOLLOWER, KNOWN_UPVOTER_WINDOW, \
+    topics, epoch
 from db import DB
+from bloom import BloomFilter
 import huey_tasks
 
 logger = logging.getLogger(__name__)
@@ -37,7 +38,15 @@ class QuestionManager:
 
     @classmethod
     def save_question(cls, tid, url, qid, time, asker, title):
-        DB.save_question(tid, url, qid, time, asker, title)
+        DB.save_question(tid, url, qid, time, asker, title,
+                         bucketed=DB.bucket_events)
+
+    @classmethod
+    def new_question_bucketed(cls):
+        """
+        :return: 新问题的 follower 是否存入 bucket
+        """
+        return DB.bucket_events
 
     @classmethod
     def get_all_questions(cls, *args):
@@ -47,13 +56,21 @@ class QuestionManager:
     def get_all_questions_one_topic(cls, tid):
         return list(DB.get_questions(tid))
 
+    @classmethod
+    def get_stored_topics(cls):
+        return DB.get_stored_topics()
+
+    @classmethod
+    def get_active_questions(cls, tid, *args):
+        return list(DB.get_active_questions(tid, *args))
+
     @classmethod
     def remove_question(cls, tid, qid):
         DB.remove_question(tid, qid)
 
     @classmethod
-    def add_question_follower(cls, tid, qid, new_followers):
-        DB.add_question_follower(tid, qid, new_followers)
+    def add_question_follower(cls, tid, qid, new_followers, bucketed=False):
+        DB.add_question_follower(tid, qid, new_followers, bucketed)
 
     @classmethod
     def get_question_follower(cls, tid, qid, limit=None):
@@ -83,29 +100,46 @@ class AnswerManager:
     def __init__(self, tid, aid):
         self.tid = tid
         self.aid = aid
-        answer_doc = DB.get_answer_affected_user_with_limit(tid, aid)
+        recent = 5  # 只读最近几个 upvoter/commenter/collector
+        answer_doc = DB.get_answer_affected_user_with_limit(tid, aid, recent)
+        # 已有的答案保持原来的存储方式, 新答案由配置决定
+        self.bucketed = answer_doc.get('bucketed', False) if answer_doc \
+            else DB.bucket_events
         if answer_doc:
-            self.upvoters = deque([u['uid'] for u in answer_doc['upvoters']],
-                                  maxlen=5)
             self.commenters = set(u['uid'] for u in answer_doc['commenters'])
             self.collectors = set(u['uid'] for u in answer_doc['collectors'])
             self.lastest_comment_time = answer_doc['commenters'][-1]['time'] \
                 if len(answer_doc['commenters']) > 0 else epoch
             self.lastest_upvote_time = answer_doc['upvoters'][-1]['time'] \
                 if len(answer_doc['upvoters']) > 0 else answer_doc['time']
+            if len(answer_doc['upvoters']) < recent:
+                # 已经是全部 upvoter, 不用再查
+                self.known_upvoters = BloomFilter(2 * KNOWN_UPVOTER_WINDOW)
+                self.known_upvoters.update(u['uid'] for u in answer_doc['upvoters'])
+            else:
+                self._load_known_upvoters()
         else:
-            self.upvoters = deque()
             self.commenters = set()
             self.collectors = set()
             self.lastest_comment_time = epoch
             self.lastest_upvote_time = epoch
+            self.known_upvoters = BloomFilter(2 * KNOWN_UPVOTER_WINDOW)
 
     def __eq__(self, other):
         return self.aid == other.aid
 
+    def _load_known_upvoters(self):
+        """
+        用最近 KNOWN_UPVOTER_WINDOW 个 upvoter 重建 Bloom filter,
+        容量是 window 的两倍, 满了再重建, 保证误判率不会越来越高
+        """
+        self.known_upvoters = BloomFilter(2 * KNOWN_UPVOTER_WINDOW)
+        doc = DB.get_upvoters(self.tid, self.aid, KNOWN_UPVOTER_WINDOW)
+        self.known_upvoters.update(u['uid'] for u in doc['upvoters'])
+
     def save_answer(self, qid, url, answerer, time):
         DB.save_answer(tid=self.tid, aid=self.aid, url=url, qid=qid,
-                       time=time, answerer=answerer)
+                       time=time, answerer=answerer, bucketed=self.bucketed)
         huey_tasks.fetch_followers_followees(answerer, time, limit_to=FETCH_FOLLOWER)
 
     def sync_affected_users(self, new_upvoters=None, new_commenters=None,
@@ -117,12 +151,14 @@ class AnswerManager:
         :return:
         """
         if new_upvoters:
-            # deque maxlen=5, 防止 upvoters 过多占用大量内存
-            self.upvoters.extend([upvoter['uid'] for upvoter in new_upvoters])
             for upvoter in new_upvoters:
                 huey_tasks.fetch_followers_followees(upvoter['uid'],
                                                      upvoter['time'])
-            DB.add_upvoters(self.tid, self.aid, new_upvoters)
+            DB.add_upvoters(self.tid, self.aid, new_upvoters, self.bucketed)
+            if self.known_upvoters.full():
+                self._load_known_upvoters()
+            else:
+                self.known_upvoters.update(u['uid'] for u in new_upvoters)
 
         if new_commenters:
             for commenter in new_commenters:
@@ -130,7 +166,7 @@ class AnswerManager:
                 huey_tasks.fetch_followers_followees(commenter['uid'],
                                                      commenter['time'],
                                                      limit_to=FETCH_FOLLOWEE)
-            DB.add_commenters(self.tid, self.aid, new_commenters)
+            DB.add_commenters(self.tid, self.aid, new_commenters, self.bucketed)
             self.lastest_comment_time = new_commenters[-1]['time']
 
         if new_collectors:
@@ -139,7 +175,7 @@ class AnswerManager:
                 huey_tasks.fetch_followers_followees(collector['uid'],
                                                      collector['time'],
                                                      limit_to=FETCH_FOLLOWEE)
-            DB.add_collectors(self.tid, self.aid, new_collectors)
+            DB.add_collectors(self.tid, self.aid, new_collectors, self.bucketed)
 
     def remove_answer(self):
         DB.remove_answer(self.tid, self.aid)
@@ -168,6 +204,17 @@ class AnswerManager:
         else:
             return [doc[args[0]] for doc in cursor]
 
+    @classmethod
+    def get_answers_of_questions(cls, tid, qids, *args):
+        """
+        一次查询取出多个问题的答案
+        :return: {qid: [answer_doc]}, 只包含 args 中的字段
+        """
+        answers = {qid: [] for qid in qids}
+        for doc in DB.get_answers_of_questions(tid, qids, 'qid', *args):
+            answers[doc['qid']].append(doc)
+        return answers
+
     @classmethod
     def get_answer_affecter_num(cls, tid, aid):
         """ 获取 upvoter, commenter, collector 数量
@@ -12,7 +12,7 @@ import requests
 from zhihu.question import Question
 
 from task import *
-from manager import QuestionManager
+from manager import QuestionManager, AnswerManager
 from utils import answer_task_queue
 from common import *
 if hasattr(os, '_called_from_test'):
@@ -37,6 +37,8 @@ class TopicMonitor:
     @staticmethod
     def _load_old_question():
         # 数据库中已有的 question 加入 task queue, answer 不用管
+        if fast_restart:
+            return TopicMonitor._restore_old_question()
         logger.info('Loading old questions from database............')
 
         for question_doc in QuestionManager.get_all_questions():
@@ -51,6 +53,37 @@ class TopicMonitor:
 
         logger.info('Loading old questions from database succeed :)')
 
+    @staticmethod
+    def _restore_old_question():
+        """
+        快速重启, 每个 topic 一次查询取 active 问题, 一次查询取这些问题的答案,
+        都只取创建 task 需要的字段. 创建 task 时不访问网络, 第一次 execute 时
+        才获取 zhihu 对象和 AnswerManager
+        """
+        logger.info('Restoring old questions from database............')
+        question_num = answer_num = 0
+        for tid in QuestionManager.get_stored_topics():
+            question_docs = QuestionManager.get_active_questions(
+                tid, 'topic', 'url', 'qid', 'asker', 'follower_count', 'bucketed')
+            answers = AnswerManager.get_answers_of_questions(
+                tid, [doc['qid'] for doc in question_docs],
+                'aid', 'url', 'time', 'upvote_count', 'commenter_count',
+                'collector_count')
+            for question_doc in question_docs:
+                if question_doc['url'].endswith('/'):
+                    question_doc['url'] = question_doc['url'][:-1] + '?sort=created'
+                answer_docs = answers[question_doc['qid']]
+                question_task_queue.append(
+                    FetchQuestionInfo(tid=question_doc['topic'],
+                                      question_doc=question_doc,
+                                      answer_docs=answer_docs)
+                )
+                question_num += 1
+                answer_num += len(answer_docs)
+
+        logger.info('Restored %d questions and %d answers :)' %
+                    (question_num, answer_num))
+
     def detect_new_question(self):
         """
         爬取话题页面，寻找新问题
@@ -0,0 +1,106 @@
+# coding: utf-8
+
+"""
+获取 upvoter 的点赞时间
+每个新 upvoter 都要翻他的 activities, 是最多的请求, 所以:
+1. 同一批 upvoter 在线程池中并发获取, 线程数有上限
+2. 缓存每个用户最近的点赞, 同一个用户常常给多个追踪的答案点赞
+3. 超时的返回 None, 不阻塞 task, 由 iutils.interpolate 补全时间
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from zhihu.acttype import ActType
+
+from common import UPVOTE_TIME_WORKERS, UPVOTE_CACHE_SIZE, UPVOTE_TIME_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class UpvoteTimeResolver:
+
+    def __init__(self, max_workers=UPVOTE_TIME_WORKERS,
+                 cache_size=UPVOTE_CACHE_SIZE, timeout=UPVOTE_TIME_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.cache = OrderedDict()  # {uid: {answer_url: upvote_time}}, LRU
+        self.lock = threading.Lock()
+
+    def _cached_time(self, uid, url):
+        with self.lock:
+            upvotes = self.cache.get(uid)
+            if upvotes is None or url not in upvotes:
+                return None
+            self.cache.move_to_end(uid)
+            return upvotes[url]
+
+    def _fetch(self, upvoter):
+        """
+        看用户最近 20 条 activity, 记下其中所有的点赞
+        """
+        upvotes = {}
+        for i, act in enumerate(upvoter.activities, 1):
+            if act.type == ActType.UPVOTE_ANSWER:
+                upvotes[act.content.url] = act.time
+            if i >= 20:
+                break
+
+        with self.lock:
+            self.cache.setdefault(upvoter.id, {}).update(upvotes)
+            self.cache.move_to_end(upvoter.id)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return upvotes
+
+    def get_upvote_time(self, upvoter, answer):
+        """
+        :param upvoter: zhihu.Author
+        :param answer: zhihu.Answer
+        :return: datatime.datetime, 找不到时为 None
+        """
+        upvote_time = self._cached_time(upvoter.id, answer.url)
+        if upvote_time is not None:
+            return upvote_time
+
+        upvote_time = self._fetch(upvoter).get(answer.url)
+        if upvote_time is None:
+            logger.warning("Can't find upvote activity")
+            logger.warning("%s upvotes %s" % (upvoter.id, answer.url))
+        return upvote_time
+
+    def resolve(self, upvoters, answer, lookup=None):
+        """
+        并发获取多个 upvoter 的点赞时间, 最多等 self.timeout 秒
+        没完成的结果为 None, 还在执行的请求继续完成并写入缓存
+        :param lookup: 获取单个时间的函数, 默认为 self.get_upvote_time
+        :return: [upvote_time], 和 upvoters 顺序相同
+        """
+        lookup = lookup or self.get_upvote_time
+        futures = [self.executor.submit(lookup, upvoter, answer)
+                   for upvoter in upvoters]
+        if not futures:
+            return []
+        _, not_done = wait(futures, timeout=self.timeout)
+        if not_done:
+            logger.warning("Get upvote time timeout: %d upvoters of %s"
+                           % (len(not_done), answer.url))
+
+        times = []
+        for future in futures:
+            if future in not_done:
+                future.cancel()  # 还没开始的不再执行
+                times.append(None)
+            elif future.exception() is not None:
+                logger.warning("Get upvote time failed: " + answer.url,
+                               exc_info=future.exception())
+                times.append(None)
+            else:
+                times.append(future.result())
+        return times
+
+
+upvote_time_resolver = UpvoteTimeResolver()
@@ -0,0 +1,124 @@
+# coding: utf-8
+
+"""
+answer/question task 调度队列
+"""
+
+import time
+import heapq
+import itertools
+import threading
+
+
+def adapt_interval(rate, new_events, elapsed, target, min_interval,
+                   max_interval, decay):
+    """
+    rate 取新增 event 速率(个/秒)的指数加权平均, 间隔取预计能抓到 target 个
+    新 event 的时间. 新 event 多时间隔变短, 没有新 event 时速率按 decay 衰减,
+    间隔指数增长, 直到 max_interval
+    :param elapsed: 距上次执行的秒数
+    :return: (新的 rate, 新的间隔)
+    """
+    if elapsed > 0:
+        rate = decay * new_events / elapsed + (1 - decay) * rate
+    interval = target / rate if rate > 0 else max_interval
+    return rate, min(max_interval, max(min_interval, interval))
+
+
+class TaskScheduler:
+    """
+    按下次执行时间排序的 task 队列, 代替 deque
+    append 时按 task.interval 算出下次执行时间, 没有 interval 的 task 立即到期
+    同一个 task 再次 append 会替换之前的时间, 旧的 heap 项在取出时跳过
+    保留 deque 的 append/popleft/len/迭代/下标, 迭代顺序为执行时间顺序
+    """
+
+    def __init__(self):
+        self.heap = []  # [(due, seq, task)]
+        self.entries = {}  # {id(task): seq}, 每个 task 最新的一项
+        self.counter = itertools.count()
+        self.lock = threading.Lock()  # 多个线程同时 append
+
+    def append(self, task, now=None):
+        now = time.time() if now is None else now
+        due = now + getattr(task, 'interval', 0)
+        with self.lock:
+            seq = next(self.counter)
+            self.entries[id(task)] = seq
+            heapq.heappush(self.heap, (due, seq, task))
+
+    def extend(self, tasks):
+        for task in tasks:
+            self.append(task)
+
+    def _pop(self):
+        """
+        :return: 最早到期的 (due, task), 调用时需持有 self.lock
+        """
+        while self.heap:
+            due, seq, task = heapq.heappop(self.heap)
+            if self.entries.get(id(task)) == seq:
+                del self.entries[id(task)]
+                return due, task
+        raise IndexError('pop from an empty scheduler')
+
+    def popleft(self):
+        with self.lock:
+            return self._pop()[1]
+
+    def pop_due(self, now=None):
+        """
+        :return: 所有已到期的 task, 按执行时间顺序
+        """
+        now = time.time() if now is None else now
+        tasks = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, seq, task = heapq.heappop(self.heap)
+                if self.entries.get(id(task)) == seq:
+                    del self.entries[id(task)]
+                    tasks.append(task)
+        return tasks
+
+    def remove(self, predicate):
+        """
+        移除所有 predicate(task) 为 True 的 task
+        :return: 移除的 task
+        """
+        removed = []
+        with self.lock:
+            for _, seq, task in self.heap:
+                if self.entries.get(id(task)) == seq and predicate(task):
+                    del self.entries[id(task)]
+                    removed.append(task)
+        return removed
+
+    def wait_time(self, max_wait, now=None):
+        """
+        :return: 距最早到期的 task 的秒数, 不超过 max_wait
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.heap and \
+                    self.entries.get(id(self.heap[0][2])) != self.heap[0][1]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return max_wait
+            return min(max_wait, max(0, self.heap[0][0] - now))
+
+    def clear(self):
+        with self.lock:
+            self.heap.clear()
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            items = sorted(item for item in self.heap
+                           if self.entries.get(id(item[2])) == item[1])
+        return iter([task for _, _, task in items])
+
+    def __getitem__(self, index):
+        return list(self)[index]
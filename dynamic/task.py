@@ -13,6 +13,8 @@ from requests.adapters import HTTPAdapter
 
 from utils import *
 from common import *
+from scheduler import adapt_interval
+from resolver import upvote_time_resolver
 from manager import QuestionManager, AnswerManager
 if hasattr(os, '_called_from_test'):
     from client_pool import get_client_test as get_client  # don't use proxy
@@ -24,13 +26,19 @@ logger = logging.getLogger(__name__)
 
 
 class FetchQuestionInfo():
-    def __init__(self, tid, question=None, question_doc=None):
+    def __init__(self, tid, question=None, question_doc=None, answer_docs=None):
         """
         :param question: zhihu.Question object
+        :param answer_docs: 和 question_doc 一起给出时为快速重启,
+                            见 TopicMonitor._restore_old_question
         :return:
         """
         self.tid = tid
         self.continue_task = True  # 是否继续执行 task
+        # 执行间隔和新增答案的速率(个/秒), 见 _update_interval
+        self.interval = QUESTION_TASKLOOP_INTERVAL
+        self.answer_rate = TARGET_ANSWERS_PER_POLL / QUESTION_TASKLOOP_INTERVAL
+        self.last_poll = datetime.now()
         if question:
             self.question = question
             self.qid = str(question.id)
@@ -40,10 +48,33 @@ class FetchQuestionInfo():
                 return
 
             self.asker = question.author.id if question.author is not ANONYMOUS else ''
+            self.bucketed = QuestionManager.new_question_bucketed()
             self.answer_num = 0
             self.follower_num = 1  # 初始提问者
             self.last_update_time = datetime.now()  # 最后一次增加新答案的时间
             logger.info("New Question %s: %s" % (self.qid, self.question.title))
+        elif question_doc and answer_docs is not None:
+            # 只用数据库中的数据, 第一次 execute 时才获取 question
+            self.question = None
+            self.url = question_doc['url']
+            self.qid = question_doc['qid']
+            self.asker = question_doc['asker']
+            self.bucketed = question_doc.get('bucketed', False)
+            self.answer_num = len(answer_docs)
+            if self.answer_num == 0:
+                # 数据库中的问题没有答案, 删除
+                self._delete_question("Remove 0 answer question: " + self.qid)
+                return
+
+            self.last_update_time = max(doc['time'] for doc in answer_docs)
+            for answer_doc in answer_docs:
+                answer_task_queue.append(
+                    FetchAnswerInfo(self.tid, self.qid, answer_doc=answer_doc))
+            if 'follower_count' in question_doc:
+                self.follower_num = question_doc['follower_count']
+            else:
+                self.follower_num = QuestionManager.get_question_follower_num(
+                    self.tid, self.qid)
         elif question_doc:
             self.question = get_client().question(question_doc['url'])
             self.qid = str(self.question.id)
@@ -54,6 +85,7 @@ class FetchQuestionInfo():
                 return
 
             self.asker = question_doc['asker']
+            self.bucketed = question_doc.get('bucketed', False)
             self.last_update_time = epoch  # 最后一次增加新答案的时间
             for url, ctime in AnswerManager.get_question_answer_attrs(
                             self.tid, self.qid, 'url', 'time'):
@@ -74,13 +106,35 @@ class FetchQuestionInfo():
             raise Exception("FetchQuestionInfo needs question or question_doc")
 
     def execute(self):
+        if not self._begin():
+            return
+        self.question.refresh()
+        self._check_new_answers()
+
+    async def execute_async(self, engine):
+        """
+        同 execute, refresh 用 engine 的 aiohttp session, 新答案在线程池中获取
+        """
+        if not self._begin():
+            return
+        await engine.refresh(self.question)
+        await engine.run_blocking(self._check_new_answers)
+
+    def _begin(self):
+        """
+        :return: 是否继续执行
+        """
         if self.continue_task:
             question_task_queue.append(self)
         else:
-            return
+            return False
 
-        self.question.refresh()
+        if self.question is None:
+            self.question = get_client().question(self.url)
+            self._mount_pool()  # 快速重启的问题都有答案
+        return True
 
+    def _check_new_answers(self):
         if self.question.deleted:
             self._delete_question('Question deleted:' + self.qid)
             return
@@ -108,7 +162,8 @@ class FetchQuestionInfo():
         if self.answer_num > answer_num_old:
             self.last_update_time = latest_answer.creation_time
             if self.question.follower_num > self.follower_num:
-                huey_tasks.fetch_question_follower(self.tid, self.qid, self.asker)
+                huey_tasks.fetch_question_follower(self.tid, self.qid, self.asker,
+                                                   self.bucketed)
                 # 注意 follower_num 多于数据库中的 follower, 只有纯follower会入库
                 self.follower_num = self.question.follower_num
             if answer_num_old == 0:
@@ -117,7 +172,31 @@ class FetchQuestionInfo():
                                                      self.last_update_time,
                                                      limit_to=FETCH_FOLLOWER)
 
-        self._check_question_activation()
+        self._update_interval(self.answer_num - answer_num_old)
+        if self._check_question_activation():
+            question_task_queue.append(self)  # 按新的间隔重新排
+
+    def _update_interval(self, new_answers):
+        """
+        还没有答案的问题保持 QUESTION_TASKLOOP_INTERVAL, 不推迟第一个答案的发现
+        新答案多的问题间隔变短, 最长 QUESTION_TASKLOOP_INTERVAL; 距上一个新答案
+        越接近 QUESTION_INACTIVE_INTERVAL, 间隔按 QUESTION_BACKOFF_STEPS 段加倍
+        """
+        now = datetime.now()
+        elapsed = (now - self.last_poll).total_seconds()
+        self.last_poll = now
+        self.answer_rate, interval = adapt_interval(
+            self.answer_rate, new_answers, elapsed, TARGET_ANSWERS_PER_POLL,
+            MIN_QUESTION_INTERVAL, QUESTION_TASKLOOP_INTERVAL, EVENT_RATE_DECAY)
+        if self.answer_num == 0:
+            self.interval = QUESTION_TASKLOOP_INTERVAL
+            return
+        steps = int((now - self.last_update_time) /
+                    (QUESTION_INACTIVE_INTERVAL / QUESTION_BACKOFF_STEPS))
+        if steps > 0:
+            interval = min(MAX_QUESTION_INTERVAL,
+                           QUESTION_TASKLOOP_INTERVAL * 2 ** steps)
+        self.interval = interval
 
     def _check_question_activation(self):
         active_interval = datetime.now() - self.last_update_time
@@ -150,11 +229,55 @@ class FetchQuestionInfo():
                                                  pool_maxsize=10))
 
 
+class UpvoterScan:
+    """
+    upvoter 从新到旧返回, 只能顺序翻页. 有人取消赞或匿名时, 最近几个已记录的
+    upvoter 可能不在列表里, 所以用最近 KNOWN_UPVOTER_WINDOW 个判断是否已记录,
+    并且最多看 新增赞数 + UPVOTER_SCAN_SLACK 个, 不会把整个列表翻一遍
+    同步和异步翻页共用
+    """
+
+    def __init__(self, aid, known_upvoters, max_scan):
+        self.aid = aid
+        self.known_upvoters = known_upvoters
+        self.max_scan = max_scan
+        self.scanned = 0
+        self.known = 0  # 连续遇到的已记录 upvoter 数
+        self.upvoters = []  # 新 upvoter, 从新到旧
+
+    def add(self, upvoter):
+        """
+        :return: 是否继续翻页
+        """
+        self.scanned += 1
+        if self.scanned > self.max_scan:
+            # 取消赞的人多于 UPVOTER_SCAN_SLACK 时, 更早的新 upvoter 会漏掉
+            logger.warning("Stop scanning upvoters of %s at %d without "
+                           "reaching known upvoters" % (self.aid, self.max_scan))
+            return False
+        if upvoter is ANONYMOUS:
+            return True
+        if upvoter.id in self.known_upvoters:
+            self.known += 1
+            return self.known < KNOWN_UPVOTER_STREAK
+        self.known = 0
+        self.upvoters.append(upvoter)
+        return True
+
+
 class FetchAnswerInfo():
-    def __init__(self, tid, qid, answer=None, url=None):
+    def __init__(self, tid, qid, answer=None, url=None, answer_doc=None):
+        """
+        :param answer_doc: 快速重启时使用, 包含 aid, url 和计数,
+                           第一次 execute 时才获取 answer 和 AnswerManager
+        """
         self.tid = tid
         self.qid = qid
         self.continue_task = True  # 是否继续执行 task
+        # 执行间隔和新增 event 的速率(个/秒), 见 _update_interval
+        self.interval = ANSWER_TASKLOOP_INTERVAL
+        self.event_rate = TARGET_EVENTS_PER_POLL / ANSWER_TASKLOOP_INTERVAL
+        self.last_poll = datetime.now()
         if answer:
             self.answer = answer
             if answer.url.startswith('https'):
@@ -182,6 +305,33 @@ class FetchAnswerInfo():
             # 这里的 comment_num 是 commenter_num, 实际可能更多
             self.upvote_num, self.comment_num, self.collect_num = \
                 self.manager.get_answer_affecter_num(tid, self.aid)
+        elif answer_doc:
+            self.answer = self.manager = None
+            self.aid = answer_doc['aid']
+            self.url = answer_doc['url']
+            # 加入计数之前的 answer doc 没有这几项, 等 _load_answer 再读
+            self.upvote_num = answer_doc.get('upvote_count')
+            self.comment_num = answer_doc.get('commenter_count')
+            self.collect_num = answer_doc.get('collector_count')
+
+    def _load_answer(self):
+        self.answer = get_client().answer(self.url)
+        self.manager = AnswerManager(self.tid, self.aid)
+        self.last_update_time = self.manager.lastest_upvote_time
+        if None in (self.upvote_num, self.comment_num, self.collect_num):
+            self.upvote_num, self.comment_num, self.collect_num = \
+                self.manager.get_answer_affecter_num(self.tid, self.aid)
+
+    def _update_interval(self, new_events):
+        """
+        热门答案间隔变短, 没有新 event 时速率衰减, 间隔逐渐变长
+        """
+        now = datetime.now()
+        elapsed = (now - self.last_poll).total_seconds()
+        self.last_poll = now
+        self.event_rate, self.interval = adapt_interval(
+            self.event_rate, new_events, elapsed, TARGET_EVENTS_PER_POLL,
+            MIN_ANSWER_INTERVAL, MAX_ANSWER_INTERVAL, EVENT_RATE_DECAY)
 
     def _check_answer_activation(self):
         active_interval = datetime.now() - self.last_update_time
@@ -200,80 +350,168 @@ class FetchAnswerInfo():
         self.manager.remove_answer()
 
     def execute(self):
-        # 保证不会因为下面卡住导致task 不加入queue
-        if self.continue_task:
-            answer_task_queue.append(self)
-        else:
+        if not self._begin():
             return
-
-        new_upvoters = deque()
-        new_commenters = OrderedDict()
-        new_collectors = []
+        if self.answer is None:
+            self._load_answer()
         self.answer.refresh()
-
         if self.answer.deleted:
             self._delete_answer()
             return
 
         # Note: put older event in lower index
-
-        # add upvoters, 匿名用户不记录
-        if self.answer.upvote_num > self.upvote_num:
-            self.upvote_num = self.answer.upvote_num
+        scan = self._upvoter_scan()
+        if scan is not None:
             for upvoter in self.answer.upvoters:
-                if upvoter is ANONYMOUS:
-                    continue
-                if upvoter.id in self.manager.upvoters:
+                if not scan.add(upvoter):
                     break
-                else:
-                    new_upvoters.appendleft({
-                        'uid': upvoter.id,
-                        'time': self.get_upvote_time(upvoter, self.answer)
-                    })
-            if new_upvoters:
-                self.last_update_time = new_upvoters[-1]['time']
-
+        new_upvoters = self._resolve_upvoters(scan)
         if not self._check_answer_activation():
             return  # 不删除回答!!
 
-        # add commenters, 匿名用户不记录
-        # 同一个人可能发表多条评论, 所以还得 check 不是同一个 commenter
-        # 注意, 一次新增的评论中也会有同一个人发表多条评论的情况, 需要收集最早的那个
-        # 下面的逻辑保证了同一个 commenter 的更早的 comment 会替代新的
+        new_commenters = OrderedDict()
+        if self._has_new_comments():
+            for comment in self.answer.latest_comments:
+                if not self._add_commenter(comment, new_commenters):
+                    break
+
+        collections = []
+        if self._has_new_collections():
+            collections = [collection for collection in self.answer.collections
+                           if collection.owner.id not in self.manager.collectors]
+        self._finish(new_upvoters, new_commenters, collections)
+
+    async def execute_async(self, engine):
+        """
+        同 execute, refresh 和翻页用 engine 的 aiohttp session,
+        数据库和点赞/收藏时间在线程池中执行
+        """
+        if not self._begin():
+            return
+        if self.answer is None:
+            await engine.run_blocking(self._load_answer)
+        await engine.refresh(self.answer)
+        if self.answer.deleted:
+            await engine.run_blocking(self._delete_answer)
+            return
+
+        scan = self._upvoter_scan()
+        if scan is not None:
+            async for upvoter in engine.upvoters(self.answer):
+                if not scan.add(upvoter):
+                    break
+        new_upvoters = await engine.run_blocking(self._resolve_upvoters, scan)
+        if not self._check_answer_activation():
+            return
+
+        new_commenters = OrderedDict()
+        if self._has_new_comments():
+            async for comment in engine.latest_comments(self.answer):
+                if not self._add_commenter(comment, new_commenters):
+                    break
+
+        collections = []
+        if self._has_new_collections():
+            async for collection in engine.collections(self.answer):
+                if collection.owner.id not in self.manager.collectors:
+                    collections.append(collection)
+        await engine.run_blocking(self._finish, new_upvoters, new_commenters,
+                                  collections)
+
+    def _begin(self):
+        """
+        :return: 是否继续执行
+        """
+        # 保证不会因为下面卡住导致task 不加入queue
+        if self.continue_task:
+            answer_task_queue.append(self)
+            return True
+        return False
+
+    def _upvoter_scan(self):
+        """
+        add upvoters, 匿名用户不记录
+        :return: 有新的赞时返回 UpvoterScan, 否则返回 None
+        """
+        if self.answer.upvote_num <= self.upvote_num:
+            return None
+        max_scan = self.answer.upvote_num - self.upvote_num + UPVOTER_SCAN_SLACK
+        self.upvote_num = self.answer.upvote_num
+        return UpvoterScan(self.aid, self.manager.known_upvoters, max_scan)
+
+    def _resolve_upvoters(self, scan):
+        """
+        点赞时间并发获取, 没拿到的为 None, 分析时插值
+        :return: deque, 旧的在前
+        """
+        new_upvoters = deque()
+        if scan is None:
+            return new_upvoters
+        times = upvote_time_resolver.resolve(scan.upvoters, self.answer,
+                                             self.get_upvote_time)
+        for upvoter, upvote_time in zip(scan.upvoters, times):
+            new_upvoters.appendleft({'uid': upvoter.id, 'time': upvote_time})
+        if new_upvoters:
+            # 最新的 upvoter 可能没拿到时间, 取已知的最新时间
+            self.last_update_time = next(
+                (u['time'] for u in reversed(new_upvoters) if u['time']),
+                datetime.now())
+        return new_upvoters
+
+    def _has_new_comments(self):
         if self.answer.comment_num > self.comment_num:
             self.comment_num = self.answer.comment_num
-            for comment in self.answer.latest_comments:
-                if comment.author is ANONYMOUS:
-                    continue
-                if comment.author.id in self.manager.commenters:
-                    if comment.creation_time <= self.manager.lastest_comment_time:
-                        break
-                else:
-                    new_commenters[comment.author.id] = {
-                        'uid': comment.author.id,
-                        'time': comment.creation_time,
-                        'cid': comment.cid
-                    }
-            if new_commenters:
-                new_commenters = list(new_commenters.values())
-                new_commenters.sort(key=lambda x: x['time'])
-
-        # add collectors
+            return True
+        return False
+
+    def _add_commenter(self, comment, new_commenters):
+        """
+        add commenters, 匿名用户不记录
+        同一个人可能发表多条评论, 所以还得 check 不是同一个 commenter
+        注意, 一次新增的评论中也会有同一个人发表多条评论的情况, 需要收集最早的那个
+        下面的逻辑保证了同一个 commenter 的更早的 comment 会替代新的
+        :return: 是否继续翻页
+        """
+        if comment.author is ANONYMOUS:
+            return True
+        if comment.author.id in self.manager.commenters:
+            if comment.creation_time <= self.manager.lastest_comment_time:
+                return False
+        else:
+            new_commenters[comment.author.id] = {
+                'uid': comment.author.id,
+                'time': comment.creation_time,
+                'cid': comment.cid
+            }
+        return True
+
+    def _has_new_collections(self):
         # 收藏夹不是按时间返回, 所以只能全部扫一遍
         if self.answer.collect_num > self.collect_num:
             self.collect_num = self.answer.collect_num
-            for collection in self.answer.collections:
-                if collection.owner.id not in self.manager.collectors:
-                    new_collectors.append({
-                        'uid': collection.owner.id,
-                        'time': self.get_collect_time(self.answer, collection),
-                        'cid': collection.id
-                    })
-            new_collectors.sort(key=lambda x: x['time'])
+            return True
+        return False
+
+    def _finish(self, new_upvoters, new_commenters, collections):
+        """
+        :param collections: 新 collector 的收藏夹, 在这里获取收藏时间
+        """
+        if new_commenters:
+            new_commenters = list(new_commenters.values())
+            new_commenters.sort(key=lambda x: x['time'])
+        new_collectors = [{
+            'uid': collection.owner.id,
+            'time': self.get_collect_time(self.answer, collection),
+            'cid': collection.id
+        } for collection in collections]
+        new_collectors.sort(key=lambda x: x['time'])
 
         self.manager.sync_affected_users(new_upvoters=new_upvoters,
                                          new_commenters=new_commenters,
                                          new_collectors=new_collectors)
+        self._update_interval(len(new_upvoters) + len(new_commenters) +
+                              len(new_collectors))
+        answer_task_queue.append(self)  # 按新的间隔重新排
 
     @staticmethod
     def get_upvote_time(upvoter, answer):
@@ -282,14 +520,7 @@ class FetchAnswerInfo():
         :param answer: zhihu.Answer
         :return: datatime.datetime
         """
-        for i, act in enumerate(upvoter.activities, 1):
-            if act.type == ActType.UPVOTE_ANSWER:
-                if act.content.url == answer.url:
-                    return act.time
-            if i >= 20:
-                logger.warning("Can't find upvote activity")
-                logger.warning("%s upvotes %s" % (upvoter.id, answer.url))
-                return None
+        return upvote_time_resolver.get_upvote_time(upvoter, answer)
 
     @staticmethod
     def get_collect_time(answer, collection):
@@ -312,5 +543,6 @@ class FetchAnswerInfo():
 
 __all__ = [
     'FetchQuestionInfo',
-    'FetchAnswerInfo'
+    'FetchAnswerInfo',
+    'UpvoterScan'
 ]
\ No newline at end of file
@@ -26,6 +26,15 @@ def a_col(tid):
     return tid + '_a'
 
 
+def is_e_col(collection_name):
+    return collection_name.endswith('_e')
+
+
+def e_col(tid):
+    # get answer event bucket collection name
+    return tid + '_e'
+
+
 def get_time_string(t):
     return t.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -149,5 +158,6 @@ __all__ = [
     'a_col', 'q_col', 'get_time_string', 'now_string',
     'get_datetime_day_month_year', 'get_datetime_hour_min_sec',
     'get_datetime_full_string', 'validate_config', 'validate_cookie',
-    'dict_equal', 'is_a_col', 'is_q_col', 'config_smtp_handler'
+    'dict_equal', 'is_a_col', 'is_q_col', 'config_smtp_handler', 'is_e_col',
+    'e_col'
 ]
\ No newline at end of file
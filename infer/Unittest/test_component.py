@@ -1,10 +1,15 @@
 from copy import deepcopy
 import pytest
 
-from component import DynamicQuestionWithAnswer, DynamicAnswer, UserAction
+from unittest.mock import Mock
+
+from component import DynamicQuestionWithAnswer, DynamicAnswer, UserAction, \
+    PropagatorIndex, FollowerIndex
+from user import UserManager
 from datetime import datetime, timedelta
 from iutils import *
-from icommon import action_table, db2, RelationType
+from icommon import action_table, db2, RelationType, FOLLOW_QUESTION, \
+    ANSWER_QUESTION, UPVOTE_ANSWER
 
 
 skip = True
@@ -189,3 +194,98 @@ def test_transform():
     ]}
     db2.dynamic_train.insert(deepcopy(data))
     assert db2.dynamic_train.find_one({'some': 2}, {'_id': 0}) == data
+
+
+def test_propagator_index():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    index = PropagatorIndex()
+    index.add([
+        UserAction(t, '', 'q1', FOLLOW_QUESTION),
+        UserAction(t+timedelta(seconds=4), '', 'q2', FOLLOW_QUESTION),
+    ])
+    index.add([
+        UserAction(t+timedelta(seconds=1), 'a1', 'u1', ANSWER_QUESTION),
+        UserAction(t+timedelta(seconds=5), 'a1', 'u2', UPVOTE_ANSWER),
+        UserAction(t+timedelta(seconds=4), 'a1', 'u3', UPVOTE_ANSWER),
+    ])
+    assert [action.uid for action in index] == ['q1', 'u1', 'q2', 'u3', 'u2']
+    assert index.times == [action.time for action in index]
+
+    before = index.before(t+timedelta(seconds=5), 'a1')
+    assert [action.uid for action in before] == ['q2', 'q1']
+    assert list(index.before(t+timedelta(seconds=4), 'a2')) == [index[1], index[0]]
+
+    # 插入后直接反映在扫描中
+    index.add([UserAction(t+timedelta(seconds=2), 'a2', 'u4', ANSWER_QUESTION)])
+    before = index.before(t+timedelta(seconds=5), 'a1')
+    assert [action.uid for action in before] == ['q2', 'u4', 'q1']
+    assert len(index) == 6
+
+
+def test_follower_index():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    docs = {
+        'p1': {'follower': [{'time': t, 'uids': ['u1']}]},
+        'p2': {'follower': [{'time': t, 'uids': ['u1', 'u2']}]},
+        'p3': {'follower': [{'time': t, 'uids': []}]},
+        'u3': {'followee': [{'time': t, 'uids': ['p1', 'p2']}]},
+    }
+
+    def find_one(query, projection):
+        doc = docs.get(query['uid'])
+        if doc is None:
+            return None
+        return {k: v for k, v in doc.items() if k in projection}
+
+    manager = UserManager(Mock(find_one=find_one))
+    index = FollowerIndex([
+        UserAction(t, 'a1', 'p1', ANSWER_QUESTION),
+        UserAction(t+timedelta(seconds=1), 'a2', 'p2', ANSWER_QUESTION),
+        UserAction(t+timedelta(seconds=2), 'a2', 'p3', UPVOTE_ANSWER),
+        UserAction(t+timedelta(seconds=3), 'a2', 'p4', UPVOTE_ANSWER),
+        UserAction(t+timedelta(seconds=3), 'a2', '', UPVOTE_ANSWER),
+    ], manager)
+    assert index.unknown == {'p4'}
+
+    def action(uid, seconds):
+        return UserAction(t+timedelta(seconds=seconds), 'a3', uid, UPVOTE_ANSWER)
+
+    # 用 propagator 的 follower 判断
+    assert index.qlink(action('u1', 1), None, 'a3')
+    assert not index.qlink(action('u1', 1), None, 'a1')  # 排除本答案
+    assert not index.qlink(action('u2', 1), None, 'a3')  # p2 不早于 action
+    assert index.qlink(action('u2', 2), None, 'a3')
+    assert not index.qlink(action('u4', 10), None, 'a3')
+
+    # 有 followee 时以 followee 为准
+    followees = manager.get_user_followee('u3', t)
+    assert index.qlink(action('u3', 1), followees, 'a3')
+    assert not index.qlink(action('u3', 1), followees, 'a1')  # p2 不早于 action
+    assert index.qlink(action('u3', 2), followees, 'a1')
+
+    # 抓取到缺失的 follower 之后加入索引
+    index.add_followers('p4', manager.get_user_follower('p1'))
+    assert index.unknown == set()
+    assert not index.qlink(action('u1', 1), None, 'a1')
+    assert index.qlink(action('u1', 4), None, 'a1')
+
+
+def test_follow_edge():
+    from copy import copy
+    from icommon import FollowEdge, TimeRange
+
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    head = UserAction(t, 'a1', 'u1', ANSWER_QUESTION)
+    tail = UserAction(TimeRange(t), 'a1', 'u2', UPVOTE_ANSWER)
+    assert not hasattr(head, '__dict__')
+    assert copy(tail) == tail
+
+    edges = {FollowEdge(head, tail)}
+    assert FollowEdge(copy(head), copy(tail)) in edges
+    assert FollowEdge(tail, head) not in edges
+    # uid 拼接相同但不是同一条边
+    assert hash(FollowEdge(UserAction(t, 'a1', 'ab', UPVOTE_ANSWER),
+                           UserAction(t, 'a1', 'c', UPVOTE_ANSWER))) != \
+        hash(FollowEdge(UserAction(t, 'a1', 'a', UPVOTE_ANSWER),
+                        UserAction(t, 'a1', 'bc', UPVOTE_ANSWER)))
+    assert head != UserAction(t, 'a1', 'u1', UPVOTE_ANSWER)
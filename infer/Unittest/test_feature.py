@@ -4,6 +4,7 @@ from unittest.mock import patch, Mock
 from pprint import pprint
 
 import pytest
+import numpy as np
 
 from icommon import *
 from feature import StaticAnswer, TimeRange, FeatureContainer
@@ -18,8 +19,7 @@ def test_gen_edges():
     t4 = datetime(1970,1,4)
     t5 = datetime(1970,1,5)
     t6 = datetime(1970,1,6)
-    sys.modules['feature'].__dict__['db'] = {
-        '111_a': Mock(find_one=lambda x: {
+    a_coll = Mock(find_one=lambda query, projection: {
                     'aid': aid,
                     'time': t1,
                     'answerer': 'u1',
@@ -39,7 +39,9 @@ def test_gen_edges():
                         {'uid': 'u2', 'time': t6}
                     ]
                 }
-    )}
+    )
+    a_coll.with_options.return_value = a_coll
+    sys.modules['feature'].__dict__['db'] = {'111_a': a_coll}
 
     sa = StaticAnswer('111', aid)
     sa.load_from_raw()
@@ -123,12 +125,56 @@ def test_gen_edges():
     pprint(sa.gen_features())
 
 
-def test_feature_container():
-    fc = FeatureContainer()
-    fc.features = [[1,2,3,4,5,6]]
+def test_feature_container(tmpdir):
+    dirname = str(tmpdir.join('feature'))
+    fc = FeatureContainer(dirname)
+    fc.append([[1,2,3,4,5,6]], [1])
+    fc.dump(collection='111_a')
     F = fc.get_features(('h_rank','is_upvote','is_comment',
                          'is_collect', 'r_order'))
-    assert F == [(1,3,4,5,6)]
+    assert F.tolist() == [[1,3,4,5,6]]
     F = fc.get_features(('h_rank', 'is_comment', 'is_upvote',
                         'is_collect', 'r_order'))
-    assert F == [(1,3,4,5,6)]
+    assert F.tolist() == [[1,3,4,5,6]]
+
+    # 追加, 重新 load 后是 memmap
+    fc.append(np.array([[7,8,9,10,11,12], [13,14,15,16,17,18]]), [0, 1])
+    fc.dump(collection='222_a')
+    fc = FeatureContainer(dirname)
+    fc.load()
+    assert len(fc) == 3
+    assert fc.collections == ['111_a', '222_a']
+    assert isinstance(fc.get_column('h_rank'), np.memmap)
+    assert fc.get_column('r_order').tolist() == [6, 12, 18]
+    assert fc.target.tolist() == [1, 0, 1]
+
+
+def test_gen_features():
+    aid = '222'
+    t1 = datetime(1970, 1, 1)
+    t2 = datetime(1970, 1, 2)
+    answer = UserAction(t1, aid, 'u1', ANSWER_QUESTION)
+    up2 = UserAction(TimeRange(t1, t2), aid, 'u2', UPVOTE_ANSWER)
+    up3 = UserAction(TimeRange(t1, t2), aid, 'u3', UPVOTE_ANSWER)
+    cm4 = UserAction(t2, aid, 'u4', COMMENT_ANSWER | COLLECT_ANSWER)
+
+    sa = StaticAnswer('111', aid)
+    sa.upvote_ids = ['u2', 'u3']
+    sa.cand_follow_edges = [
+        FollowEdge(answer, up3),
+        FollowEdge(answer, cm4),
+        FollowEdge(up2, up3),
+        FollowEdge(up3, cm4),
+        FollowEdge(up3, up2),
+    ]
+    assert sa.gen_features().tolist() == [
+        [0, 1, 1, 0, 0, -1],
+        [0, 1, 0, 1, 1, -1],
+        [1, 0, 1, 0, 0, -1],
+        [1, 0, 0, 1, 1, -1],
+        [0, 0, 1, 0, 0, 1],
+    ]
+    assert sa.gen_features_without_isanswer().shape == (5, 5)
+
+    sa.cand_follow_edges = []
+    assert sa.gen_features().shape == (0, 6)
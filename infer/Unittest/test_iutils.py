@@ -12,3 +12,125 @@ nums = [2, 5, 3, 7, 11, 8, 10, 13, 6]
 lis, index_list = longestIncreasingSubsequence(nums)
 assert lis == [2, 3, 7, 8, 10, 13]
 assert index_list == [0, 2, 3, 5, 6, 7]
+
+
+def test_bulk_writer():
+    from unittest.mock import Mock
+    from iutils import BulkWriter
+
+    collection = Mock()
+    writer = BulkWriter(collection, flush_size=2, flush_interval=3600)
+    writer.replace('a1', {'aid': 'a1', 'v': 1})
+    writer.replace('a1', {'aid': 'a1', 'v': 2})  # 同一个 aid 只保留最后一次
+    collection.bulk_write.assert_not_called()
+    writer.replace('a2', {'aid': 'a2'})
+    assert collection.bulk_write.call_count == 1
+    requests = collection.bulk_write.call_args[0][0]
+    assert len(requests) == 2
+    assert collection.bulk_write.call_args[1] == {'ordered': False}
+
+    with writer:
+        writer.replace('a3', {'aid': 'a3'})
+    assert collection.bulk_write.call_count == 2
+    assert writer.written == 3
+
+
+def test_merge_by_time():
+    from datetime import datetime
+    from icommon import UserAction, UPVOTE_ANSWER, COMMENT_ANSWER, COLLECT_ANSWER
+    from iutils import merge_by_time
+
+    def actions(acttype, *days):
+        return [UserAction(datetime(2016, 1, d), 'a', str(d), acttype) for d in days]
+
+    upvoters = actions(UPVOTE_ANSWER, 1, 3, 5)
+    commenters = actions(COMMENT_ANSWER, 2, 3)
+    collectors = actions(COLLECT_ANSWER, 6)
+    merged = list(merge_by_time(upvoters, commenters, collectors))
+    assert [a.time.day for a in merged] == [1, 2, 3, 3, 5, 6]
+    # 时间相同时按参数顺序
+    assert merged[2].acttype == UPVOTE_ANSWER
+    assert merged[3].acttype == COMMENT_ANSWER
+    assert list(merge_by_time([], [])) == []
+
+
+def test_find_answer_and_load_actions():
+    from datetime import datetime
+    from unittest.mock import Mock
+    from icommon import TimeRange, UPVOTE_ANSWER
+    from iutils import find_answer, load_actions
+
+    t = datetime(2016, 1, 1)
+    collection = Mock()
+    raw = collection.with_options.return_value
+    raw.find_one.return_value = {
+        'time': t, 'answerer': 'u0',
+        'upvoters': [{'uid': 'u1', 'time': t}, {'uid': 'u2', 'time': None}],
+    }
+    doc = find_answer(collection, 'a1', upvote_time=False)
+    query, projection = raw.find_one.call_args[0]
+    assert query == {'aid': 'a1'}
+    assert 'upvoters.uid' in projection and 'upvoters.time' not in projection
+    assert '_id' in projection and projection['_id'] == 0
+
+    actions = load_actions(doc['upvoters'], 'a1', UPVOTE_ANSWER)
+    assert [(a.uid, a.time) for a in actions] == [('u1', t), ('u2', None)]
+    actions = load_actions(doc['upvoters'], 'a1', UPVOTE_ANSWER, TimeRange)
+    assert all(isinstance(a.time, TimeRange) for a in actions)
+    assert actions[0].time is not actions[1].time
+
+
+def test_find_bucketed_answer():
+    from datetime import datetime
+    from unittest.mock import Mock, MagicMock
+    from iutils import find_answer
+
+    t = datetime(2016, 1, 1)
+    buckets = {
+        'upvoters': [{'events': [{'uid': 'u1', 'time': t}]},
+                     {'events': [{'uid': 'u2', 'time': t}]}],
+        'commenters': [{'events': [{'uid': 'c1', 'time': t}]}],
+        'collectors': [],
+    }
+    e_coll = Mock()
+    e_coll.with_options.return_value = e_coll
+    e_coll.find.side_effect = lambda query, projection: Mock(
+        sort=Mock(return_value=buckets[query['kind']]))
+    collection = Mock()
+    collection.name = '123_a'
+    collection.database = MagicMock()
+    collection.database.__getitem__.return_value = e_coll
+    raw = collection.with_options.return_value
+    raw.find_one.return_value = {'time': t, 'answerer': 'u0', 'bucketed': True,
+                                 'upvoters': [], 'commenters': [], 'collectors': []}
+
+    doc = find_answer(collection, 'a1', upvote_time=False)
+    collection.database.__getitem__.assert_called_with('123_e')
+    assert [u['uid'] for u in doc['upvoters']] == ['u1', 'u2']
+    assert [u['uid'] for u in doc['commenters']] == ['c1']
+    assert doc['collectors'] == [] and doc['answerer'] == 'u0'
+    projections = {call[0][0]['kind']: call[0][1]
+                   for call in e_coll.find.call_args_list}
+    assert 'events.time' not in projections['upvoters']
+    assert 'events.time' in projections['commenters']
+
+
+def test_iter_question_followers():
+    from unittest.mock import Mock, MagicMock
+    from iutils import iter_question_followers
+
+    q_doc = {'qid': 'q1', 'follower': [{'uid': 'f1'}]}
+    assert list(iter_question_followers(Mock(), q_doc)) == [{'uid': 'f1'}]
+
+    e_coll = Mock()
+    e_coll.find.return_value.sort.return_value = [
+        {'events': [{'uid': 'f1'}, {'uid': 'f2'}]}, {'events': [{'uid': 'f3'}]}]
+    collection = Mock()
+    collection.name = '123_q'
+    collection.database = MagicMock()
+    collection.database.__getitem__.return_value = e_coll
+    q_doc = {'qid': 'q1', 'follower': [], 'bucketed': True}
+    followers = iter_question_followers(collection, q_doc)
+    assert [f['uid'] for f in followers] == ['f1', 'f2', 'f3']
+    collection.database.__getitem__.assert_called_with('123_e')
+    assert e_coll.find.call_args[0][0] == {'qid': 'q1', 'kind': 'follower'}
@@ -0,0 +1,301 @@
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+from user import UserManager, FollowList, FollowView, LRUCache
+
+
+def test_follow_view():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    flist = [
+        {'time': t-timedelta(seconds=2), 'uids': ['u1', 'u2']},
+        {'time': t-timedelta(seconds=1), 'uids': ['u3', 'u4']},
+        {'time': t+timedelta(seconds=0.5), 'uids': ['u5', 'u6']},
+        {'time': t+timedelta(seconds=3), 'uids': ['u7', 'u8']}
+    ]
+    follow_list = FollowList(flist)
+    for time in (t, None, t-timedelta(seconds=10), t+timedelta(seconds=10)):
+        view = FollowView(follow_list, time)
+        expected = UserManager.get_closest_users(flist, time)
+        assert sorted(view) == sorted(expected)
+        assert len(view) == len(expected)
+        for uid in ('u1', 'u4', 'u5', 'u8', 'non-exist'):
+            assert (uid in view) == (uid in expected)
+
+    assert list(FollowView(FollowList([]))) == []
+
+
+def test_follow_view_intersect():
+    from array import array
+    from user import interner
+
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    follow_list = FollowList([
+        {'time': t, 'uids': ['i%d' % i for i in range(0, 40, 2)]},
+        {'time': t+timedelta(seconds=10), 'uids': ['i1', 'i3']},
+    ])
+    for time in (t, None):
+        view = FollowView(follow_list, time)
+        assert list(view.ids()) == sorted(interner.get(uid) for uid in view)
+        for uids in (['i2', 'i3', 'x'], ['i%d' % i for i in range(40)]):
+            ids = array('i', sorted(interner.intern(uid) for uid in uids))
+            expected = sorted(interner.get(uid) for uid in uids if uid in view)
+            assert view.intersect(ids) == expected
+
+
+def test_follows():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    docs = {
+        'u1': {'follower': [{'time': t, 'uids': ['u2']}]},
+        'u3': {'followee': [{'time': t, 'uids': ['u1']}]},
+    }
+
+    def find_one(query, projection):
+        doc = docs.get(query['uid'])
+        if doc is None:
+            return None
+        return {k: v for k, v in doc.items() if k in projection}
+
+    manager = UserManager(Mock(find_one=find_one))
+    assert manager.follows('u2', 'u1', t) is True
+    assert manager.follows('u3', 'u1', t) is False  # 以 u1 的 follower 为准
+    assert manager.follows('u3', 'u4', t) is False
+    assert manager.follows('u4', 'u5', t) is None
+
+
+def test_lru_cache():
+    lru = LRUCache(3, max_bytes=100)
+    lru.set('a', 1, 10)
+    lru.set('b', 2, 10)
+    lru.set('c', 3, 10)
+    assert lru.get('a') == 1  # a 变成最新
+    lru.set('d', 4, 10)  # 超过 cap, 淘汰 b
+    assert 'b' not in lru and lru.get('b') is None
+    lru.set('e', 5, 75)  # 超过 max_bytes, 淘汰 c
+    assert list(lru.table) == ['a', 'd', 'e']
+    assert lru.nbytes == 95
+    lru.reset_capacity(1)
+    assert list(lru.table) == ['e']
+    assert lru.stats() == {'entries': 1, 'nbytes': 75, 'hits': 1,
+                           'misses': 1, 'evictions': 4}
+
+
+def test_user_manager_eviction():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    coll = Mock(find_one=Mock(return_value={
+        'follower': [{'time': t, 'uids': ['u1']}],
+        'followee': [{'time': t, 'uids': ['u2']}]
+    }))
+    manager = UserManager(coll, capacity=2)
+    manager.get_user_follower('a')
+    manager.get_user_followee('a')
+    manager.get_user_follower('b')
+    assert coll.find_one.call_count == 3
+    manager.get_user_follower('c')  # 淘汰 a 的 follower 和 followee
+    assert 'a' not in manager.lru
+    assert 'u2' in manager.get_user_followee('a')
+    assert coll.find_one.call_count == 5
+
+
+def test_prefetch():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    coll = Mock(find=Mock(return_value=[
+        {'uid': 'a', 'follower': [{'time': t, 'uids': ['u1']}]},
+        {'uid': 'b', 'followee': [{'time': t, 'uids': ['u2']}]},
+    ]))
+    manager = UserManager(coll)
+    assert manager.prefetch(['a', 'b', 'c', '', 'a']) == 3
+    assert coll.find.call_count == 1
+    assert sorted(coll.find.call_args[0][0]['uid']['$in']) == ['a', 'b', 'c']
+
+    # 之后的查询都不访问数据库
+    assert 'u1' in manager.get_user_follower('a', t)
+    assert manager.get_user_followee('a', t) is None
+    assert 'u2' in manager.get_user_followee('b', t)
+    assert manager.get_user_follower('c', t) is None
+    coll.find_one.assert_not_called()
+    assert manager.prefetch(['a', 'b']) == 0
+
+
+def test_interner_bounded():
+    from user import interner
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    max_bytes = 200 * 1024
+
+    def find(query, projection):
+        # 每个用户有 100 个不同的 follower, 问题之间没有重复
+        return [{'uid': uid, 'follower': [{'time': t, 'uids': [
+            '%s_f%d' % (uid, i) for i in range(100)]}]}
+                for uid in query['uid']['$in']]
+
+    interner.reset()
+    manager = UserManager(Mock(find=Mock(side_effect=find)), max_bytes=max_bytes)
+    peak = 0
+    for q in range(100):
+        uids = ['q%d_u%d' % (q, i) for i in range(10)]
+        manager.prefetch(uids, fields=('follower',))
+        assert 'q%d_u0_f5' % q in manager.get_user_follower(uids[0], t)
+        peak = max(peak, interner.nbytes + manager.lru.nbytes)
+    # 10000 个用户的 follower 远超上限, interner 和缓存加起来仍然有界
+    assert len(interner) < 10000 * 100
+    assert peak < max_bytes * 1.5
+    assert interner.generation > 1
+
+
+def test_follow_memo():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    docs = {
+        'u1': {'follower': [
+            {'time': t, 'uids': ['u2']},
+            {'time': t+timedelta(days=10), 'uids': ['u3']},
+        ]},
+        'u4': {'followee': [{'time': t, 'uids': ['u1']}]},
+    }
+
+    def find_one(query, projection):
+        doc = docs.get(query['uid'])
+        if doc is None:
+            return None
+        return {k: v for k, v in doc.items() if k in projection}
+
+    coll = Mock(find_one=Mock(side_effect=find_one))
+    manager = UserManager(coll, capacity=1, memo_capacity=2)
+    assert manager.follows('u3', 'u1', t) is False
+    assert manager.follows('u3', 'u1', t+timedelta(days=9)) is True  # 同一项, 不同快照
+    assert manager.follows('u4', 'u1', t, prefer_followee=True) is True
+    assert manager.follows('u5', 'u6', t) is None
+    assert manager.memo.stats()['hits'] == 1
+    assert len(manager.memo) == 2
+
+    # u1 的 follower 被 lru 淘汰后仍然命中 memo
+    find_one_calls = coll.find_one.call_count
+    assert manager.follows('u3', 'u1', t) is False
+    assert coll.find_one.call_count == find_one_calls
+
+    # 不同来源的记录分开: u1 的 follower 中没有 u4
+    assert manager.follows('u4', 'u1', t) is False
+    assert manager.follows('u4', 'u1', t, prefer_followee=True) is True
+    assert len(manager.memo) == 2  # 超过上限时淘汰最旧的
+
+    # 重新抓取后以它为来源的记录失效
+    manager.fetch_user_follower(Mock(id='u1', followers=[Mock(id='u4')]))
+    assert manager.follows('u4', 'u1', t) is True
+
+
+def test_follow_memo_persist(tmpdir, monkeypatch):
+    import os
+    from user import FollowMemo
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    prefix = str(tmpdir.join('follow_memo_test'))
+
+    # 两个进程各写自己的文件, 互不覆盖
+    monkeypatch.setattr(os, 'getpid', lambda: 1)
+    memo1 = FollowMemo(prefix=prefix)
+    memo1.set('follower', 'u2', 'u1', [t], 0)
+    memo1.set('followee', 'u3', 'u4', [t], -1)
+    monkeypatch.setattr(os, 'getpid', lambda: 2)
+    memo2 = FollowMemo(prefix=prefix)
+    memo2.invalidate('followee', 'u3')  # 进程 2 重新抓取了 u3 的 followee
+    memo2.set('follower', 'u5', 'u1', [t], 0)
+    memo1.save()
+    memo2.save()
+    assert len(tmpdir.listdir()) == 2
+
+    monkeypatch.setattr(os, 'getpid', lambda: 3)
+    memo = FollowMemo(prefix=prefix)
+    assert len(memo) == 2
+    assert memo.get('follower', 'u2', 'u1', t) is True
+    assert memo.get('follower', 'u5', 'u1', t) is True
+    assert memo.get('followee', 'u3', 'u4', t) is None  # generation 较旧
+    # 快照个数不同说明之后有新快照, 记录失效
+    assert memo.get('follower', 'u2', 'u1', t, snapshots=2) is None
+
+    # 合并过的文件在写回后删除
+    memo.save()
+    assert [f.basename for f in tmpdir.listdir()] == ['follow_memo_test.3.pkl']
+    assert len(FollowMemo(prefix=prefix)) == 2
+
+
+def test_fetch_follows():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    u1 = Mock(id='u1', followee_num=1, followees=[Mock(id='u2')])
+    u2 = Mock(id='u2', follower_num=10)
+    client = Mock(author=lambda url: u1 if url.endswith('u1') else u2)
+    coll = Mock(find_one=Mock(return_value=None))
+    manager = UserManager(coll)
+    assert manager.follows('u1', 'u2', t) is None
+    assert manager.fetch_follows('u1', 'u2', lambda: client) is True
+    coll.update_one.assert_called_once()
+    assert manager.follows('u1', 'u2', t) is True
+
+
+def test_deferred_fetch(tmpdir):
+    filename = str(tmpdir.join('tobe_fetch.txt'))
+    coll = Mock(find_one=Mock(return_value=None))
+    manager = UserManager(coll, defer_file=filename, defer_default=False)
+    get_client = Mock()
+    assert manager.fetch_follows('u1', 'u2', get_client, 'a1') is False
+    assert manager.fetch_follows('u1', 'u2', get_client, 'a1') is False
+    assert manager.fetch_follows('u3', 'u2', get_client, 'a2') is False
+    get_client.assert_not_called()
+    coll.update_one.assert_not_called()
+    with open(filename) as f:
+        assert f.read() == 'u2 lacks follower,u1 lacks followee,a1\n' \
+                           'u2 lacks follower,u3 lacks followee,a2\n'
+
+    manager = UserManager(coll, defer_file=filename, defer_default=True)
+    assert manager.fetch_follows('u1', 'u2', get_client) is True
+
+
+def test_bucketed_follow_list():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    snapshots = [
+        {'time': t, 'uids': ['u1']},
+        {'time': t+timedelta(days=1), 'count': 3, 'bucketed': True},
+        {'time': t+timedelta(days=2), 'count': 1, 'bucketed': True},
+    ]
+    buckets = [
+        {'snap': 1, 'uids': ['u2', 'u3']},
+        {'snap': 1, 'uids': ['u1', 'u4']},  # 同一快照的第二段
+        {'snap': 2, 'uids': ['u5']},
+    ]
+    snapshot_coll = Mock()
+    snapshot_coll.find.return_value.sort.return_value = iter(buckets)
+    coll = Mock(find_one=Mock(return_value={'follower': snapshots}))
+    manager = UserManager(coll, snapshot_coll=snapshot_coll)
+
+    view = manager.get_user_follower('a', t+timedelta(days=1))
+    assert sorted(view) == ['u1', 'u2', 'u3', 'u4']
+    assert sorted(manager.get_user_follower('a')) == ['u1', 'u2', 'u3', 'u4', 'u5']
+    assert manager.follows('u1', 'a', t) is True
+    assert manager.follows('u4', 'a', t) is False
+    query = snapshot_coll.find.call_args[0][0]
+    assert query == {'uid': 'a', 'kind': 'follower', 'snap': {'$lt': 3}}
+    snapshot_coll.find.assert_called_once()
+
+
+def test_prefetch_bucketed():
+    t = datetime(1999, 1, 1, 12, 0, 0)
+    snapshot = {'time': t, 'count': 1, 'bucketed': True}
+    coll = Mock(find=Mock(return_value=[
+        {'uid': 'a', 'follower': [snapshot]},
+        {'uid': 'b', 'follower': [snapshot], 'followee': [snapshot]},
+        {'uid': 'c', 'follower': [{'time': t, 'uids': ['u9']}]},
+    ]))
+    snapshot_coll = Mock()
+    snapshot_coll.find.return_value.sort.return_value = iter([
+        {'uid': 'a', 'kind': 'follower', 'snap': 0, 'uids': ['u1']},
+        {'uid': 'a', 'kind': 'follower', 'snap': 1, 'uids': ['u8']},  # 写到一半
+        {'uid': 'b', 'kind': 'followee', 'snap': 0, 'uids': ['u3']},
+        {'uid': 'b', 'kind': 'follower', 'snap': 0, 'uids': ['u2']},
+    ])
+    manager = UserManager(coll, snapshot_coll=snapshot_coll)
+    assert manager.prefetch(['a', 'b', 'c']) == 3
+
+    # 整批只查一次 bucket
+    snapshot_coll.find.assert_called_once()
+    assert sorted(snapshot_coll.find.call_args[0][0]['uid']['$in']) == ['a', 'b']
+    assert list(manager.get_user_follower('a')) == ['u1']
+    assert list(manager.get_user_follower('b')) == ['u2']
+    assert list(manager.get_user_followee('b')) == ['u3']
+    assert list(manager.get_user_follower('c')) == ['u9']
+    snapshot_coll.find.assert_called_once()
@@ -1,10 +1,14 @@
 """
 抓取没有follower or followee的
-fetch_from_file: 从当前目录下的 tobe_fetch.txt 提取
+fetch_from_file: 从当前目录下的 tobe_fetch.txt 提取, 也可以是推断离线模式记录的文件
+affected_questions: 补抓之后, 列出离线模式记录中受影响的问题, 用于重新推断
+离线模式的记录按推断用的数据库分文件(user.DEFER_FETCH_FILE % db_name),
+补抓和查找受影响的问题都要用同一个 db_name
 """
 import re
+from collections import defaultdict, OrderedDict
 from client import client
-from user import UserManager
+from user import UserManager, PREFETCH_BATCH_SIZE
 import pymongo
 
 
@@ -13,38 +17,89 @@ user_col = db.user
 user_manager = UserManager(db.user)
 
 
-def fetch_from_file():
-    with open('tobe_fetch.txt') as f:
+def get_database(db_name):
+    return pymongo.MongoClient('127.0.0.1', 27017).get_database(db_name)
+
+
+def stored_users(user_col, uids, field):
+    """
+    :return: uids 中数据库里已经有 field 的, 每 PREFETCH_BATCH_SIZE 个一次 $in 查询
+    """
+    uids = list(uids)
+    stored = set()
+    for i in range(0, len(uids), PREFETCH_BATCH_SIZE):
+        stored.update(doc['uid'] for doc in user_col.find(
+            {'uid': {'$in': uids[i:i+PREFETCH_BATCH_SIZE]},
+             field: {'$exists': True}}, {'uid': 1}))
+    return stored
+
+
+def fetch_from_file(filename='tobe_fetch.txt', db_name='analysis'):
+    with open(filename) as f:
         lines = f.readlines()
 
-    user_lack_follower = []
-    user_lack_followee = []
+    # 离线模式下同一对用户可能被多个答案记录, 只抓一次
+    pairs = OrderedDict()  # {(user_lack_follower, user_lack_followee): None}
 
-    pattern = re.compile(r'([^\s]+)\slacks follower,([^\s]+)\s')
+    pattern = re.compile(r'([^\s]+)\slacks follower,([^\s,]+)[\s,]')
     for line in lines:
         obj = pattern.search(line)
-        user_lack_follower.append(obj.group(1))
-        user_lack_followee.append(obj.group(2))
+        pairs[(obj.group(1), obj.group(2))] = None
+
+    user_col = get_database(db_name).user
+    user_manager = UserManager(user_col)
+    # 先查数据库, 已经有数据的用户对不访问网络; 按用户去重, 每个用户只抓一次
+    has_follower = stored_users(user_col, {er for er, _ in pairs}, 'follower')
+    has_followee = stored_users(user_col, {ee for _, ee in pairs}, 'followee')
+    people = {}
+
+    def get_people(uid):
+        if uid not in people:
+            people[uid] = client.People('https://www.zhihu.com/people/' + uid)
+        return people[uid]
 
-    for er, ee in zip(user_lack_follower, user_lack_followee):
-        u1 = client.People('https://www.zhihu.com/people/' + ee)
-        u2 = client.People('https://www.zhihu.com/people/' + er)
+    for er, ee in pairs:
+        if er in has_follower or ee in has_followee:
+            print("skip %s,%s" % (er, ee))
+            continue
+        u1, u2 = get_people(ee), get_people(er)
         if u1.followee_num < u2.follower_num:
-            udoc = user_col.find_one({'uid': ee})
-            assert udoc is not None
-            if 'followee' in udoc:
-                print("skip " + ee)
-                continue
             print("fetch " + ee)
             user_manager.fetch_user_followee(u1)
+            has_followee.add(ee)
         else:
-            udoc = user_col.find_one({'uid': er})
-            assert udoc is not None
-            if 'follower' in udoc:
-                print("skip " + er)
-                continue
             print("fetch " + er)
             user_manager.fetch_user_follower(u2)
+            has_follower.add(er)
+
+
+def affected_questions(filename, out_filename, db_name):
+    """
+    :param filename: 离线模式记录的文件, 每行最后是 aid
+    :param out_filename: 每行 tid,qid,q_coll_name, 可直接用于
+                         dynamic_infer.infer_many 和 static_infer.infer_many
+    :param db_name: 推断用的数据库, 和记录文件对应
+    """
+    with open(filename) as f:
+        aids = {line.strip().rsplit(',', 1)[1] for line in f
+                if line.count(',') == 2}
+    aids.discard('')
+
+    db = get_database(db_name)
+    questions = defaultdict(set)  # {q_coll_name: {qid}}
+    for collection_name in db.collection_names():
+        if not collection_name.endswith('_a'):
+            continue
+        q_coll_name = collection_name[:-1] + 'q'
+        for a_doc in db[collection_name].find({'aid': {'$in': list(aids)}},
+                                              {'qid': 1}):
+            questions[q_coll_name].add(a_doc['qid'])
+
+    with open(out_filename, 'w') as f:
+        for q_coll_name, qids in questions.items():
+            for qid in qids:
+                f.write('%s,%s,%s\n' % (q_coll_name[:-2], qid, q_coll_name))
+    return sum(len(qids) for qids in questions.values())
 
 
 def fetch_followee_from_list(uid_list):
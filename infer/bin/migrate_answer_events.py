@@ -0,0 +1,45 @@
+"""
+把 answer doc 中的 upvoters/commenters/collectors 迁移到 bucket 存储
+用 dynamic/db.py 的 DB.migrate_answer_events, bucket 格式和 crawler 完全一致
+中途中断可以直接重新运行, 已经迁移的答案跳过, 迁移一半的答案重新迁移
+
+运行前必须停止 crawler: 运行中的 AnswerManager 缓存了 bucketed=False,
+迁移后还会往 answer doc 的数组里写, 而读取时会忽略这些 event.
+迁移时有新 event 写入的答案不会被清空, 重新读取后再迁移
+需要 dynamic 的运行环境(配置文件等)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'dynamic'))
+
+from db import DB, EVENT_INDEXES
+
+MAX_RETRY = 3
+
+
+def migrate_collection(a_coll):
+    tid = a_coll[:-2]
+    DB._create_indexes(a_coll[:-1] + 'e', EVENT_INDEXES)
+    a_collection = DB.db.get_collection(a_coll)
+    count = failed = 0
+    for adoc in a_collection.find({'bucketed': {'$ne': True}}, {'aid': 1}):
+        for _ in range(MAX_RETRY):
+            answer_doc = a_collection.find_one({'aid': adoc['aid']})
+            if answer_doc is None or answer_doc.get('bucketed'):
+                break
+            if DB.migrate_answer_events(tid, answer_doc):
+                count += 1
+                break
+        else:
+            failed += 1
+    print("%s: %d answers migrated, %d failed" % (a_coll, count, failed))
+
+
+if __name__ == '__main__':
+    if input("crawler 已经停止? [y/N] ").strip().lower() != 'y':
+        sys.exit("先停止 crawler 再迁移")
+    for collection_name in DB.db.collection_names():
+        if collection_name.endswith('_a'):
+            migrate_collection(collection_name)
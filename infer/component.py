@@ -8,12 +8,13 @@ import bisect
 import logging
 import json
 import shutil
-from queue import PriorityQueue
 from datetime import datetime
 from os import path
 from threading import Thread
 from time import sleep
-from itertools import groupby
+from itertools import chain
+from array import array
+from collections import defaultdict
 
 
 import networkx
@@ -21,15 +22,133 @@ from networkx.readwrite import json_graph
 
 from icommon import *
 from iutils import *
-from user import UserManager
+from user import UserManager, interner
 
 logger = logging.getLogger(__name__)
 
+db = user_manager = None  # 由 load_database 设置
 
-def load_database(mongoclient, db_name):
+
+def load_database(mongoclient, db_name, **kwargs):
+    """
+    :param kwargs: 传给 UserManager, 如 memo_capacity, defer_file
+    """
     global db, user_manager
     db = mongoclient.get_database(db_name)
-    user_manager = UserManager(db.user)
+    user_manager = UserManager(db.user, **kwargs)
+
+
+class PropagatorIndex:
+    """
+    按时间排序的 propagator 索引, 同时维护平行的时间序列供 bisect 使用.
+    插入时先对新加入的一批排序, 再和已有序列归并, 不再整体重排.
+    所有答案共用一份序列, 排除某个答案时在扫描中跳过, 不复制
+    """
+    def __init__(self):
+        self.actions = []  # [UserAction], 按时间排序
+        self.times = []  # 和 actions 平行的时间序列
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def __getitem__(self, index):
+        return self.actions[index]
+
+    def add(self, actions):
+        """
+        :param actions: List of UserAction, 不要求有序
+        时间相同时已有的排在前面, 和之前 append 后 sort 的结果一致
+        """
+        if not actions:
+            return
+        new_actions = sorted(actions)
+        if self.actions and new_actions[0].time < self.actions[-1].time:
+            self.actions = list(merge_by_time(self.actions, new_actions))
+            self.times = [action.time for action in self.actions]
+        else:
+            self.actions.extend(new_actions)
+            self.times.extend(action.time for action in new_actions)
+
+    def before(self, time, aid):
+        """
+        :return: 早于 time 且不属于 aid 的 propagator, 从最接近 time 的开始
+        """
+        actions = self.actions
+        for i in range(bisect.bisect_left(self.times, time) - 1, -1, -1):
+            if actions[i].aid != aid:
+                yield actions[i]
+
+
+class FollowerIndex:
+    """
+    一个问题内的反向 follower 索引, 推断 qlink 用.
+    由每个 propagator 的 follower 一次性建立 {follower id: [propagator id]},
+    之后判断某用户是否关注了更早的 propagator 只需查一次索引, 不再逐个扫描.
+    follower 缺失的 propagator 记在 unknown 中, 由调用方抓取后 add_followers
+    """
+    def __init__(self, propagators, user_manager):
+        self.user_manager = user_manager
+        self.actions = {}  # {uid: [(time, aid)]}, 按时间排序
+        for action in propagators:
+            if action.uid != '':  # 排除匿名
+                self.actions.setdefault(action.uid, []).append(
+                    (action.time, action.aid))
+        self.generation = interner.generation  # interner reset 后 id 作废, 需要重建
+        self.ids = array('i', sorted(interner.intern(uid) for uid in self.actions))
+        self.reverse = defaultdict(list)  # {follower id: [propagator id]}
+        self.unknown = set()  # follower 缺失的 propagator uid
+        for uid in self.actions:
+            self.add_followers(uid, user_manager.get_user_follower(uid))
+
+    def add_followers(self, uid, followers):
+        """
+        :param followers: FollowView, 包含所有快照; None 表示 follower 缺失
+        """
+        if followers is None:
+            self.unknown.add(uid)
+            return
+        self.unknown.discard(uid)
+        pid = interner.intern(uid)
+        for id_ in followers.ids():
+            self.reverse[id_].append(pid)
+
+    def first_time(self, uid, aid):
+        """
+        :return: uid 不属于 aid 的最早一次传播时间, 没有返回 None
+        """
+        for time, aid_ in self.actions[uid]:
+            if aid_ != aid:
+                return time
+        return None
+
+    def qlink(self, action, followees, aid) -> bool:
+        """
+        action.uid 是否关注了某个早于 action 且不属于 aid 的 propagator
+        :param followees: action.uid 在 action.time 的 followee, 有则以它为准,
+                          否则用 propagator 的 follower 判断, 不包括 unknown 中的
+        """
+        if followees is not None:
+            cands = followees.intersect(self.ids)
+        else:
+            id_ = interner.get(action.uid)
+            cands = self.reverse.get(id_, ()) if id_ is not None else ()
+
+        uids = interner.uids
+        for pid in cands:
+            uid = uids[pid]
+            time = self.first_time(uid, aid)
+            if time is None or not time < action.time:
+                continue
+            if followees is None:
+                # 索引按所有快照建立, 还要确认 action.time 时的 follower
+                followers = self.user_manager.get_user_follower(uid, action.time)
+                if followers is None or action.uid not in followers:
+                    continue
+            return True
+        return False
 
 
 class DynamicQuestionWithAnswer:
@@ -43,7 +162,8 @@ class DynamicQuestionWithAnswer:
         self.question_followers = []  # [UserAction]
         self.question_follower_dict = {}  # {uid->UserAction}
         self.answers = {}  # {uid: UserAction(acttype=ANSWER_QUESTION)}
-        self.propagators = []
+        self.propagators = PropagatorIndex()
+        self._follower_index = None
         self.load_question_followers()
         self.user_actions = {}  # 记录所有 user action for qlink match
 
@@ -51,21 +171,21 @@ class DynamicQuestionWithAnswer:
         """
         load question followers from database. 同时加入 propagators
         """
-        q_doc = db[q_col(self.tid)].find_one({'qid': self.qid})
+        q_coll = db[q_col(self.tid)]
+        q_doc = q_coll.find_one({'qid': self.qid})
         assert q_doc is not None
         self.question_followers.append(
             UserAction(q_doc['time'], '', q_doc['asker'], ASK_QUESTION)
         )
         # follower 是从老到新, 顺序遍历可保证 question_followers 从老到新
-        for f in q_doc['follower']:
+        for f in iter_question_followers(q_coll, q_doc):
             follow_action = UserAction(f['time'], '', f['uid'], FOLLOW_QUESTION)
             self.question_followers.append(follow_action)
 
         interpolate(self.question_followers)
         for follower in self.question_followers:
             self.question_follower_dict[follower.uid] = follower
-        list(map(self.propagators.append, self.question_followers))
-        self.propagators.sort()
+        self.propagators.add(self.question_followers)
 
     def add_answer_propagator(self, aid, propagators):
         """
@@ -74,14 +194,31 @@ class DynamicQuestionWithAnswer:
         """
         answer_act = propagators[0]
         self.answers[answer_act.uid] = answer_act
-        list(map(self.propagators.append, propagators))
-        self.propagators.sort()
+        self.propagators.add(propagators)
+        self._follower_index = None
 
     def add_user_actions(self, user_actions: dict):
         for key, value in user_actions.items():
             self.user_actions[key] = self.user_actions.get(key, []) + value
             self.user_actions[key].sort(key=lambda x: x.time)
 
+    def prefetch_users(self):
+        """
+        在所有答案加载完之后调用, 一次性加载问题涉及的所有用户的 follower/followee
+        """
+        uids = set(self.question_follower_dict)
+        uids.update(self.user_actions)
+        return user_manager.prefetch(uids)
+
+    def follower_index(self) -> FollowerIndex:
+        """
+        在所有答案加载完之后第一次调用时建立, 加入新答案或 interner reset 后重建
+        """
+        if self._follower_index is None or \
+                self._follower_index.generation != interner.generation:
+            self._follower_index = FollowerIndex(self.propagators, user_manager)
+        return self._follower_index
+
 
 class DynamicAnswer:
     def __init__(self, tid, aid, dqa):
@@ -101,83 +238,46 @@ class DynamicAnswer:
         """
         从数据库加载答案, 填充 up/com/col, InfoStorage.propagators
         """
-        answer_doc = db[a_col(self.tid)].find_one({'aid': self.aid})
+        answer_doc = find_answer(db[a_col(self.tid)], self.aid)
         assert answer_doc is not None
         self.answer_time = answer_doc['time']
         uid = answer_doc['answerer']
         self.root = UserAction(self.answer_time, self.aid, uid, ANSWER_QUESTION)
         self.add_node(self.root)
-        self.upvoters = [
-            UserAction(time=u['time'], aid=self.aid, uid=u['uid'], acttype=UPVOTE_ANSWER)
-            for u in answer_doc['upvoters']
-        ]
-        self.commenters = [
-            UserAction(time=u['time'], aid=self.aid, uid=u['uid'], acttype=COMMENT_ANSWER)
-            for u in answer_doc['commenters']
-        ]
-        self.collectors = [
-            UserAction(time=u['time'], aid=self.aid, uid=u['uid'], acttype=COLLECT_ANSWER)
-            for u in answer_doc['collectors']
-        ]
+        self.upvoters = load_actions(answer_doc['upvoters'], self.aid, UPVOTE_ANSWER)
+        self.commenters = load_actions(answer_doc['commenters'], self.aid,
+                                       COMMENT_ANSWER)
+        self.collectors = load_actions(answer_doc['collectors'], self.aid,
+                                       COLLECT_ANSWER)
         # 插值. comment 肯定有时间信息, 不处理
         interpolate(self.upvoters)
         interpolate(self.collectors)
 
-        propagators = self.upvoters.copy()
-        propagators.insert(0, self.root)
-        self.dqa.add_answer_propagator(self.aid, propagators)
-
-        # fill user_actions
-        all_user_actions = [self.root] + self.upvoters + self.commenters + self.collectors
-        key = lambda x: x.uid
-        all_user_actions.sort(key=key)
-        user_actions = {}
-        for key, group in groupby(all_user_actions, key=key):
-            if key != '':  # 排除匿名
-                user_actions[key] = list(group)
+        self.dqa.add_answer_propagator(self.aid, [self.root] + self.upvoters)
+
+        # fill user_actions, 每个 uid 的 action 保持 root, up, com, col 的顺序
+        user_actions = defaultdict(list)
+        for action in chain([self.root], self.upvoters, self.commenters,
+                            self.collectors):
+            if action.uid != '':  # 排除匿名
+                user_actions[action.uid].append(action)
         self.dqa.add_user_actions(user_actions)
 
     def infer(self, save_to_db):
-        propagators = self.dqa.propagators
-        # bisect 不支持 key, 故只能再记录一个时间序列
-        # 排除本答案的回答/点赞者
-        times = [action.time for action in propagators if action.aid != self.aid]
         upvoters_added = [self.root]  # 记录已经加入图中的点赞者
         # 按时间顺序一起处理
-        pq = PriorityQueue()
-        i1 = i2 = i3 = 0
-
-        if self.upvoters:
-            pq.put(self.upvoters[0])
-            i1 += 1
-        if self.commenters:
-            pq.put(self.commenters[0])
-            i2 += 1
-        if self.collectors:
-            pq.put(self.collectors[0])
-            i3 += 1
-        l1, l2, l3 = len(self.upvoters), len(self.commenters), len(self.collectors)
-        while not pq.empty():
-            action = pq.get()
+        for action in merge_by_time(self.upvoters, self.commenters, self.collectors):
             if self.graph.has_node(action.uid):
                 # 融合 uid 相同的点
                 self.graph.node[action.uid]['acttype'] = \
                     action.acttype | self.graph.node[action.uid]['acttype']
             else:
-                relation = self._infer_node(action, propagators, times, upvoters_added)
+                relation = self._infer_node(action, upvoters_added)
                 self.add_node(relation.tail)
                 self.add_edge(*relation)
 
-            if action.acttype == UPVOTE_ANSWER and i1 < l1:
-                pq.put(self.upvoters[i1])
+            if action.acttype == UPVOTE_ANSWER:
                 upvoters_added.append(action)
-                i1 += 1
-            elif action.acttype == COMMENT_ANSWER and i2 < l2:
-                pq.put(self.commenters[i2])
-                i2 += 1
-            elif action.acttype == COLLECT_ANSWER and i3 < l3:
-                pq.put(self.collectors[i3])
-                i3 += 1
 
         for node in self.graph.nodes():
             self.graph.node[node]['acttype'] = acttype2str(self.graph.node[node]['acttype'])
@@ -195,42 +295,30 @@ class DynamicAnswer:
         tree_data['links'] = links
 
         if save_to_db:
-            self.dynamic_collection.replace_one({'aid': self.aid},
-                                    transform_incoming(tree_data),
-                                    upsert=True)
+            writer = get_bulk_writer(self.dynamic_collection)
+            writer.replace(self.aid, transform_incoming(tree_data))
         else:
             with open('data/dump.json', 'w') as f:
                 json.dump(tree_data, f, cls=MyEncoder, indent='\t')
 
-    def _infer_node(self, action, propagators, times, upvoters_added):
+    def _infer_node(self, action, upvoters_added):
         from client_pool2 import get_client2 as get_client
-        followees = user_manager.get_user_followee(action.uid, action.time)
-        followees = set(followees) if followees is not None else None
-
         # 从已经添加的 upvoter 推断 follow 关系, 注意要逆序扫
         for cand in reversed(upvoters_added):
             if cand.uid == '':  # 匿名回答者
                 continue
-            followers = user_manager.get_user_follower(cand.uid, action.time)
-            if followees is not None:
-                if cand.uid in followees:
-                    return Relation(cand, action, RelationType.follow)
-            elif followers is not None:
-                if action.uid in followers:
-                    return Relation(cand, action, RelationType.follow)
-            else:
+            follows = user_manager.follows(action.uid, cand.uid, action.time,
+                                           prefer_followee=True)
+            if follows is None:
                 logger.warning("%s lacks follower,%s lacks followee" %
                                (cand.uid, action.uid))
-                u2 = get_client().author(USER_PREFIX + cand.uid)
-                u1 = get_client().author(USER_PREFIX + action.uid)
-                if u1.followee_num < u2.follower_num:
-                    followees = user_manager.fetch_user_followee(u1)
-                    if cand.uid in followees:
-                        return Relation(cand, action, RelationType.follow)
-                else:
-                    followers = user_manager.fetch_user_follower(u2)
-                    if action.uid in followers:
-                        return Relation(cand, action, RelationType.follow)
+                follows = user_manager.fetch_follows(action.uid, cand.uid, get_client,
+                                                     self.aid)
+            if follows:
+                return Relation(cand, action, RelationType.follow)
+
+        # 上面可能抓取了 action.uid 的 followee, 之后再取
+        followees = user_manager.get_user_followee(action.uid, action.time)
 
         # 如果不是follow 关系, 推断 qlink+notification, 优先级 noti > qlink
         # 推断 notification
@@ -257,40 +345,39 @@ class DynamicAnswer:
             else:
                 break
 
-        # 使用 copy 出来的 propagators
-        # 取最靠近 time 的那个propagator，因为在时间线上新的东西会先被看见
-        # 为了确定最接近的，使用 bisect_left 找到插入位置，左边的那个就是目标propagator
-        pos = bisect.bisect_left(times, action.time)
-        if pos > 0:
-            for i in range(pos-1, -1, -1):
-                cand = propagators[i]
-                if cand.uid == '':  # 匿名回答者
+        # 取所有早于 action 的 propagator, 因为在时间线上它们都可能被看见
+        # 用反向 follower 索引一次判断 action.uid 是否关注了其中某一个
+        index = self.dqa.follower_index()
+        if index.qlink(action, followees, self.aid):
+            return Relation(self.root, action, RelationType.qlink)
+
+        # 剩下 follower 缺失的 propagator, 从最接近 time 的开始抓取
+        # 在共用的时间序列上 bisect, 跳过本答案的回答/点赞者
+        if followees is None and index.unknown:
+            for cand in self.dqa.propagators.before(action.time, self.aid):
+                if cand.uid not in index.unknown:
                     continue
-                # 逻辑和推断follow完全一样,为了不重复生成followees,不单独写成函数
-                followers = user_manager.get_user_follower(cand.uid, action.time)
-                if followees is not None:
-                    if cand.uid in followees:
-                        # cand is action.uid's followee
+                if user_manager.deferred is not None:
+                    # 离线模式, 和在线一样只记录最接近的一个, 补抓后重新推断时再看其余的
+                    if user_manager.deferred.record(action.uid, cand.uid, self.aid):
                         return Relation(self.root, action, RelationType.qlink)
-                elif followers is not None:
+                    break
+                logger.warning("%s lacks follower,%s lacks followee" %
+                               (cand.uid, action.uid))
+                u1 = get_client().author(USER_PREFIX + action.uid)
+                u2 = get_client().author(USER_PREFIX + cand.uid)
+                if u1.followee_num < u2.follower_num:
+                    followees = user_manager.fetch_user_followee(u1)
+                    # 有了 followee, 剩下的 propagator 都可以直接判断
+                    if index.qlink(action, followees, self.aid):
+                        return Relation(self.root, action, RelationType.qlink)
+                    break
+                else:
+                    followers = user_manager.fetch_user_follower(u2)
+                    index.add_followers(cand.uid, followers)
                     if action.uid in followers:
                         # action.uid is cand's follower
                         return Relation(self.root, action, RelationType.qlink)
-                else:
-                    logger.warning("%s lacks follower,%s lacks followee" %
-                                   (cand.uid, action.uid))
-                    u1 = get_client().author(USER_PREFIX + action.uid)
-                    u2 = get_client().author(USER_PREFIX + cand.uid)
-                    if u1.followee_num < u2.follower_num:
-                        followees = user_manager.fetch_user_followee(u1)
-                        if cand.uid in followees:
-                            # cand is action.uid's followee
-                            return Relation(self.root, action, RelationType.qlink)
-                    else:
-                        followers = user_manager.fetch_user_follower(u2)
-                        if action.uid in followers:
-                            # action.uid is cand's follower
-                            return Relation(self.root, action, RelationType.qlink)
 
         # 之前都不是, 只能是 recommendation 了
         return Relation(self.root, action, RelationType.recommendation)
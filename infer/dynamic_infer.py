@@ -1,13 +1,26 @@
+"""
+动态传播网络推断
+每个问题是一个任务, 用进程池并行. 同时提交的任务数有上限, 答案多的问题先提交,
+避免最后只剩一个大问题在跑. 每个进程只建立一次数据库连接, user_manager 的缓存
+在同一进程的问题之间共用. 失败的问题记录到文件, 可以用 infer_many 重新推断
+"""
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import pymongo
 from iutils import *
 from icommon import db2
 import component
 from component import DynamicQuestionWithAnswer, DynamicAnswer, load_database
-from user import UserManager
+from user import UserManager, FOLLOW_MEMO_FILE, DEFER_FETCH_FILE
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 60  # 每隔多少秒输出一次进度
 
 
 def infer_one_question(tid, qid, aid, db_name):
@@ -21,60 +34,134 @@ def infer_one_question(tid, qid, aid, db_name):
     for answer_doc in collection.find({'qid': qid}, {'aid': 1}):
         answers.append(DynamicAnswer(tid, answer_doc['aid'], info_storage))
 
+    info_storage.prefetch_users()
     for answer in answers:
         if answer.aid == aid:
             answer.infer(save_to_db=False)
 
 
-def infer_all(db_name):
+def init_worker(db_name, defer_fetch=False, defer_default=False):
+    """
+    ProcessPoolExecutor 的 initializer, 每个进程只建立一次数据库连接
+    关注关系备忘表在进程退出时写回本进程的文件
+    :param defer_fetch: 离线模式, 缺少关注关系时不实时抓取, 记录到 DEFER_FETCH_FILE,
+                        当作 defer_default 处理
+    """
+    kwargs = {'memo_file': FOLLOW_MEMO_FILE % db_name}
+    if defer_fetch:
+        kwargs.update(defer_file=DEFER_FETCH_FILE % db_name,
+                      defer_default=defer_default)
+    load_database(pymongo.MongoClient('127.0.0.1', 27017), db_name, **kwargs)
+
+
+def infer_all(db_name, max_workers=10, max_in_flight=None, failed_file=None,
+              defer_fetch=False, defer_default=False):
+    """
+    推断 db 中所有问题的所有答案
+    """
     db = pymongo.MongoClient('127.0.0.1', 27017, connect=False).get_database(db_name)
-    executor = ProcessPoolExecutor(max_workers=10)
 
-    futures = []
+    tasks = []
     for collection_name in db.collection_names():
         if not is_q_col(collection_name):
             continue
         tid = collection_name[:-2]
-        q_collection = db[collection_name]
-        a_collection = db[q_to_a(collection_name)]
-        for q_doc in q_collection.find({}, {'qid':1, 'topic':1}):
+        # 一次查询取出整个 topic 的 aid, 不再每个问题查一次
+        question_aids = defaultdict(list)
+        for a_doc in db[q_to_a(collection_name)].find({}, {'qid': 1, 'aid': 1}):
+            question_aids[a_doc['qid']].append(a_doc['aid'])
+        for q_doc in db[collection_name].find({}, {'qid': 1}):
             qid = q_doc['qid']
-            aids = [a_doc['aid'] for a_doc in
-                    a_collection.find({'qid': qid}, {'aid': 1})]
-            futures.append(
-                executor.submit(infer_question_task(db_name, tid, qid, aids))
-            )
+            tasks.append((tid, qid, question_aids.get(qid, [])))
 
-    executor.shutdown()
+    db.client.close()
+    run_tasks(db_name, tasks, max_workers, max_in_flight, failed_file,
+              defer_fetch, defer_default)
 
 
-def infer_many(db_name, filename):
+def infer_many(db_name, filename, max_workers=5, max_in_flight=None,
+               failed_file=None, defer_fetch=False, defer_default=False):
     """
     推断一些问题的回答, 读取文件, 每一行格式为
     topic,qid,...(后面是什么无所谓)
+    失败记录和 bin/fetch_fo.py 生成的受影响问题列表都是这个格式
     """
     db = pymongo.MongoClient('127.0.0.1', 27017, connect=False).get_database(db_name)
-    executor = ProcessPoolExecutor(max_workers=5)
 
-    count = 0
-    futures = []
+    tasks = []
     with open(filename) as f:
         for line in f:
             tid, qid, _ = line.split(',', maxsplit=2)
             a_collection = db[a_col(tid)]
             aids = [a_doc['aid'] for a_doc in
                     a_collection.find({'qid': qid}, {'aid': 1})]
-            futures.append(
-                executor.submit(infer_question_task, db_name, tid, qid, aids)
-            )
-            count += len(aids)
+            tasks.append((tid, qid, aids))
+
+    db.client.close()
+    run_tasks(db_name, tasks, max_workers, max_in_flight, failed_file,
+              defer_fetch, defer_default)
 
-    print(count)
-    executor.shutdown()
+
+def run_tasks(db_name, tasks, max_workers, max_in_flight=None, failed_file=None,
+              defer_fetch=False, defer_default=False):
+    """
+    :param tasks: [(tid, qid, aids)]
+    :param max_in_flight: 同时提交到进程池的任务数上限, 默认是 max_workers 的两倍
+    :param failed_file: 记录失败的问题, 每行 tid,qid,error, 可直接用于 infer_many
+    :param defer_fetch, defer_default: 见 init_worker
+    :return: 推断的答案数量
+    """
+    max_in_flight = max_in_flight or max_workers * 2
+    failed_file = failed_file or 'data/dynamic_infer_failed_%s.txt' % db_name
+    # 答案多的问题先推断, 减少最后等待单个大问题的时间
+    tasks = sorted(tasks, key=lambda task: len(task[2]), reverse=True)
+    total_answers = sum(len(task[2]) for task in tasks)
+    logger.info("%d questions, %d answers to infer" % (len(tasks), total_answers))
+
+    start = last_report = time.time()
+    done_questions = done_answers = failed = 0
+    it = iter(tasks)
+    pending = {}  # {future: task}
+    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                   initargs=(db_name, defer_fetch, defer_default))
+    with executor, open(failed_file, 'a') as f:
+        while True:
+            for task in it:
+                pending[executor.submit(infer_question_task, db_name, *task)] = task
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tid, qid, aids = pending.pop(future)
+                try:
+                    done_answers += future.result()
+                except Exception as e:
+                    # 一个问题失败不影响其它问题
+                    logger.exception("fail to infer question %s" % qid)
+                    f.write('%s,%s,%r\n' % (tid, qid, e))
+                    f.flush()
+                    failed += 1
+                done_questions += 1
+
+            now = time.time()
+            if now - last_report >= REPORT_INTERVAL or not pending:
+                last_report = now
+                logger.info("%d/%d questions, %d/%d answers, %d failed, "
+                            "%.1f answers/s" %
+                            (done_questions, len(tasks), done_answers,
+                             total_answers, failed,
+                             done_answers / max(now - start, 1e-6)))
+
+    return done_answers
 
 
 def infer_question_task(db_name, tid, qid, aids):
-    load_database(pymongo.MongoClient('127.0.0.1', 27017), db_name)
+    if component.db is None or component.db.name != db_name:
+        # 不是通过 run_tasks 的进程池调用
+        init_worker(db_name)
     info_storage = DynamicQuestionWithAnswer(tid, qid)
     answers = []
 
@@ -83,13 +170,19 @@ def infer_question_task(db_name, tid, qid, aids):
         # print("infer " + aid)
         answers.append(DynamicAnswer(tid, aid, info_storage))
 
+    info_storage.prefetch_users()
     for answer in answers:
         answer.infer(save_to_db=True)
+    # 返回之前写完, 失败记录中不会漏掉已经算完但没写入的问题
+    if answers:
+        get_bulk_writer(answers[0].dynamic_collection).flush()
+    logger.debug("follow memo: %s" % component.user_manager.memo.stats())
 
     return len(aids)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     # infer_one_question(tid='19551147', qid='40554112', aid='87120100',db_name='zhihu_data_0219')
     # infer_one_question(tid='19551147', qid="40611516", aid="87420652",db_name='test')
     # infer_many(db_name='test', filename='data/alltime.txt')
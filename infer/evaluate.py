@@ -33,6 +33,7 @@ def evaluate_follow():
         for answer_doc in db2.static_test.find({}, {'aid': 1, 'tid': 1}):
             answer = StaticAnswer(answer_doc['tid'], answer_doc['aid'])
             answer.load_from_raw()
+            answer.prefetch_users()
             answer.build_cand_edges()
             result, target = answer.evaluate_follow()
             all_result.extend(result)
@@ -34,10 +34,10 @@ from itertools import chain
 from typing import Union
 from copy import copy
 from collections import defaultdict
-from operator import itemgetter
 import pickle
 from pprint import pprint
 
+import numpy as np
 import networkx
 from networkx.readwrite import json_graph
 
@@ -72,31 +72,31 @@ class StaticAnswer:
             a_coll = db[a_col(self.tid)]
         else:
             a_coll = db[coll_name]
-        answer_doc = a_coll.find_one({'aid': self.aid})
+        answer_doc = find_answer(a_coll, self.aid, upvote_time=False)
         assert answer_doc is not None
         self.root = UserAction(answer_doc['time'], self.aid,
                                answer_doc['answerer'], ANSWER_QUESTION)
         self.answer_time = answer_doc['time']
 
         # 和 dynamic 不同, upvote time 设置成 None
-        self.upvote_ids = [u['uid'] for u in answer_doc['upvoters']]
-        self.upvoters = [
-            UserAction(TimeRange(), self.aid, u['uid'], UPVOTE_ANSWER)
-            for u in answer_doc['upvoters']
-        ]
-        self.commenters = [
-            UserAction(u['time'], self.aid, u['uid'], COMMENT_ANSWER)
-            for u in answer_doc['commenters']
-        ]
-        self.collectors = [
-            UserAction(u['time'], self.aid, u['uid'], COLLECT_ANSWER)
-            for u in answer_doc['collectors']
-        ]
+        self.upvoters = load_actions(answer_doc['upvoters'], self.aid,
+                                     UPVOTE_ANSWER, time_factory=TimeRange)
+        self.upvote_ids = [u.uid for u in self.upvoters]
+        self.commenters = load_actions(answer_doc['commenters'], self.aid,
+                                       COMMENT_ANSWER)
+        self.collectors = load_actions(answer_doc['collectors'], self.aid,
+                                       COLLECT_ANSWER)
         # 插值. comment 肯定有时间信息, 不处理
         interpolate(self.collectors)
         self.affecters = list(chain(
             [self.root], self.upvoters, self.commenters, self.collectors))
 
+    def prefetch_users(self):
+        """
+        load_from_raw 之后调用, 一次性加载所有 affecter 的 follower/followee
+        """
+        return user_manager.prefetch(action.uid for action in self.affecters)
+
     def load_from_dynamic(self):
         """
         从推断出的动态传播图加载 answer
@@ -184,82 +184,97 @@ class StaticAnswer:
                         self.cand_follow_edges.append(edge)
                         edge_set.add(edge)
 
-    def gen_features(self) -> list:
-        """
-        生成 features
-        :return: n_samples * n_features vector
-        """
-        return [
-            [self._feature_head_rank(edge),
-             *self._feature_node_type(edge),
-             self._feature_relative_order(edge)] for edge in self.cand_follow_edges
-            ]
-
-    def gen_features_without_isanswer(self):
+    def gen_features(self) -> np.ndarray:
+        """
+        一次遍历生成所有候选边的 features, 列顺序和 FeatureContainer.feature_types 一致
+        :return: n_samples * n_features ndarray, 可直接用于 model.predict
+        """
+        edges = self.cand_follow_edges
+        n = len(edges)
+        features = np.zeros((n, len(FeatureContainer.feature_types)),
+                            dtype=np.int64)
+        if n == 0:
+            return features
+
+        head_acttype = np.fromiter((edge.head.acttype for edge in edges),
+                                   dtype=np.int64, count=n)
+        tail_acttype = np.fromiter((edge.tail.acttype for edge in edges),
+                                   dtype=np.int64, count=n)
+        # 因为head不是 answer 就是upvote,所以 head 只需要提供 is_answer
+        head_is_answer = (head_acttype & ANSWER_QUESTION) != 0
+        tail_is_upvote = (tail_acttype & UPVOTE_ANSWER) != 0
+        features[:, 0] = self._feature_head_rank()
+        features[:, 1] = head_is_answer
+        features[:, 2] = tail_is_upvote
+        features[:, 3] = (tail_acttype & COMMENT_ANSWER) != 0
+        features[:, 4] = (tail_acttype & COLLECT_ANSWER) != 0
+        features[:, 5] = self._feature_relative_order(head_is_answer,
+                                                      tail_is_upvote)
+        return features
+
+    def gen_features_without_isanswer(self) -> np.ndarray:
         """
         :return: 除 is_answer 之外的 feature
         """
-        return [
-            [self._feature_head_rank(edge),
-             *self._feature_node_type(edge)[1:],
-             self._feature_relative_order(edge)] for edge in self.cand_follow_edges
-            ]
-
-    def _feature_head_rank(self, edge: FollowEdge) -> int:
-        """
-        head 在 tail 的候选中排第几
-        """
-        rank = 0
-        head, tail = edge.head, edge.tail
-        for cand in self.cand_follow_edges:
-            if cand.tail is tail:
-                if cand.head is head:
-                    return rank
-                else:
-                    rank += 1
-
-    @staticmethod
-    def _feature_node_type(edge: FollowEdge) -> list:
-        """
-        因为head不是 answer 就是upvote,所以其实特征只需要提供 is_answer
-        :return:
-        [head_is_answer, tail_is_upvote, tail_is_comment, tail_is_collect]
-        """
-        head, tail = edge.head, edge.tail
-        return [
-            is_answer(head),
-            is_upvote(tail),
-            is_comment(tail),
-            is_collect(tail)
-        ]
-
-    def _feature_relative_order(self, edge: FollowEdge) -> int:
+        return np.delete(self.gen_features(),
+                         FeatureContainer.feature_types.index('is_answer'),
+                         axis=1)
+
+    def _feature_head_rank(self) -> np.ndarray:
+        """
+        每条边的 head 在同一个 tail 的候选中排第几, 按 cand_follow_edges 中的顺序
+        """
+        edges = self.cand_follow_edges
+        n = len(edges)
+        tail_index = {}  # {tail uid: 编号}
+        tails = np.fromiter(
+            (tail_index.setdefault(edge.tail.uid, len(tail_index)) for edge in edges),
+            dtype=np.int64, count=n)
+        # 稳定排序后同一个 tail 的边相邻且保持原顺序, 组内下标即 rank
+        order = np.argsort(tails, kind='stable')
+        sorted_tails = tails[order]
+        is_group_start = np.ones(n, dtype=bool)
+        is_group_start[1:] = sorted_tails[1:] != sorted_tails[:-1]
+        group_start = np.maximum.accumulate(
+            np.where(is_group_start, np.arange(n), 0))
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n) - group_start
+        return rank
+
+    def _feature_relative_order(self, head_is_answer,
+                                tail_is_upvote) -> np.ndarray:
         """
         判断 edge.head, edge.tail 相对顺序
         head 只可能 answer or upvote
         time 可能是 None, datetime, TimeRange(start, end)
-        :return:
+        :return: 每条边一个值
             -1 if head.time < tail.time;
             1 if head.time >= tail.time;
             0 if unknown
         """
-        head, tail = edge.head, edge.tail
-
-        if is_answer(head):
-            return -1
-
-        # 当且仅当 head 是 upvote 时 tail 才可能是 upvote
-        if is_upvote(tail):
-            if self.upvote_ids.index(head.uid) < self.upvote_ids.index(tail.uid):
-                return -1
+        edges = self.cand_follow_edges
+        order = np.full(len(edges), -1, dtype=np.int64)  # head 是 answer 时为 -1
+
+        # 当且仅当 head 是 upvote 时 tail 才可能是 upvote, 比较点赞顺序
+        # position 记录 uid 第一次出现的位置, 和 upvote_ids.index 一致
+        position = {}
+        for i, uid in enumerate(self.upvote_ids):
+            position.setdefault(uid, i)
+        index = np.flatnonzero(~head_is_answer & tail_is_upvote)
+        head_pos = np.fromiter((position[edges[i].head.uid] for i in index),
+                               dtype=np.int64, count=len(index))
+        tail_pos = np.fromiter((position[edges[i].tail.uid] for i in index),
+                               dtype=np.int64, count=len(index))
+        order[index] = np.where(head_pos < tail_pos, -1, 1)
+
+        # 剩下的 tail 必然是 comment or collect, tail.time 只能是 datetime
+        for i in np.flatnonzero(~head_is_answer & ~tail_is_upvote):
+            head, tail = edges[i].head, edges[i].tail
+            if isinstance(head.time, datetime):
+                order[i] = -1 if head.time < tail.time else 1
             else:
-                return 1
-
-        # 现在 tail.time 只能是 datetime 了, 因为 tail 必然是 comment or collect
-        if isinstance(head.time, datetime):
-            return -1 if head.time < tail.time else 1
-        else:
-            return head.time - tail.time  # see TimeRange.__sub__
+                order[i] = head.time - tail.time  # see TimeRange.__sub__
+        return order
 
     def gen_target(self) -> list:
         """
@@ -362,9 +377,21 @@ class StaticAnswer:
 
     def infer(self, model, save_to_db=False, coll_name=None):
         """
-        :param coll_name: 写入的 collection name
+        :param coll_name: 写入的 collection name, 通过进程内共用的 BulkWriter 批量写入
         推断静态传播图
         """
+        tree_data = self.infer_tree(model)
+        if save_to_db:
+            writer = get_bulk_writer(db2.get_collection(coll_name))
+            writer.replace(self.aid, transform_incoming(tree_data))
+        else:
+            with open('data/%s.json' % self.aid, 'w') as f:
+                json.dump(tree_data, f, cls=MyEncoder, indent='\t')
+
+    def infer_tree(self, model):
+        """
+        推断静态传播图, 返回 tree_data, 不写入数据库
+        """
         # 用训练好的模型标注 follow 边, 把 follow 边加入图中
         if self.cand_follow_edges:
             features = self.gen_features_without_isanswer()
@@ -432,14 +459,7 @@ class StaticAnswer:
             ]
         tree_data['links'] = links
         tree_data['tid'] = self.tid
-
-        if save_to_db:
-            db2.get_collection(coll_name).replace_one({'aid': self.aid},
-                                            transform_incoming(tree_data),
-                                            upsert=True)
-        else:
-            with open('data/%s.json' % self.aid, 'w') as f:
-                json.dump(tree_data, f, cls=MyEncoder, indent='\t')
+        return tree_data
 
     def _infer_node(self, action):
         """
@@ -447,8 +467,6 @@ class StaticAnswer:
         """
         # user_manager 由外部加载
         from client_pool2 import get_client2 as get_client
-        followees = user_manager.get_user_followee(action.uid, action.time)
-        followees = set(followees) if followees is not None else None
         uid = action.uid
         action_time = action.time
         action_time_is_datetime = isinstance(action_time, datetime)
@@ -491,31 +509,16 @@ class StaticAnswer:
             elif action_time_is_timerange and action_time - cand.time < 0:
                 continue
 
-            # 逻辑和推断follow完全一样,为了不重复生成followees,不单独写成函数
-            followers = user_manager.get_user_follower(cand.uid, action.time)
-            if followees is not None:
-                if cand.uid in followees:
-                    # cand is action.uid's followee
-                    return Relation(self.root, action, RelationType.qlink)
-            elif followers is not None:
-                if action.uid in followers:
-                    # action.uid is cand's follower
-                    return Relation(self.root, action, RelationType.qlink)
-            else:
+            # 和推断 follow 一样, 优先用 action.uid 的 followee 判断
+            follows = user_manager.follows(action.uid, cand.uid, action.time,
+                                           prefer_followee=True)
+            if follows is None:
                 logger.warning("%s lacks follower,%s lacks followee" %
                                (cand.uid, action.uid))
-                u1 = get_client().author(USER_PREFIX + action.uid)
-                u2 = get_client().author(USER_PREFIX + cand.uid)
-                if u1.followee_num < u2.follower_num:
-                    followees = user_manager.fetch_user_followee(u1)
-                    if cand.uid in followees:
-                        # cand is action.uid's followee
-                        return Relation(self.root, action, RelationType.qlink)
-                else:
-                    followers = user_manager.fetch_user_follower(u2)
-                    if action.uid in followers:
-                        # action.uid is cand's follower
-                        return Relation(self.root, action, RelationType.qlink)
+                follows = user_manager.fetch_follows(action.uid, cand.uid, get_client,
+                                                     self.aid)
+            if follows:
+                return Relation(self.root, action, RelationType.qlink)
 
         # 之前都不是, 只能是 recommendation 了
         return Relation(self.root, action, RelationType.recommendation)
@@ -542,26 +545,15 @@ class StaticAnswer:
         """
         determine if tail user follows head user
         时间以 tail 的时间为准, 因为在传播发生在 tail.time
-        这里牺牲了性能因为每次都要扫 list,没有像 component 里使用set
         :return: bool
         """
-        action_time = tail.time
-        followers = user_manager.get_user_follower(head.uid, action_time)
-        followees = user_manager.get_user_followee(tail.uid, action_time)
-        if followers is not None:
-            return True if tail.uid in followers else False
-        elif followees is not None:
-            return True if head.uid in followees else False
+        follows = user_manager.follows(tail.uid, head.uid, tail.time)
+        if follows is not None:
+            return follows
         else:
             print("%s lacks follower,%s lacks followee" % (head.uid, tail.uid))
-            u1 = get_client().author(USER_PREFIX + tail.uid)
-            u2 = get_client().author(USER_PREFIX + head.uid)
-            if u1.followee_num < u2.follower_num:
-                followees = user_manager.fetch_user_followee(u1)
-                return True if head.uid in followees else False
-            else:
-                followers = user_manager.fetch_user_follower(u2)
-                return True if tail.uid in followers else False
+            return user_manager.fetch_follows(tail.uid, head.uid, get_client,
+                                              tail.aid)
 
 
 class StaticQuestionWithAnswer:
@@ -589,6 +581,17 @@ class StaticQuestionWithAnswer:
     def add_answer_propagator(self, propagators):
         self.propagators.extend(propagators)
 
+    def prefetch_users(self, answers):
+        """
+        在所有答案 load_from_raw 之后, infer_preparation 之前调用
+        一次性加载问题涉及的所有用户的 follower/followee
+        :param answers: [StaticAnswer]
+        """
+        uids = set(self.question_follower_dict)
+        for answer in answers:
+            uids.update(action.uid for action in answer.affecters)
+        return user_manager.prefetch(uids)
+
     def fill_question_follower_time(self):
         """
         在所有答案的 infer_preparation 调用完之后调用
@@ -649,7 +652,7 @@ class StaticQuestionWithAnswer:
             UserAction(q_doc['time'], '', asker, ASK_QUESTION)
         )
         # follower 是从老到新, 顺序遍历可保证 question_followers 从老到新
-        for f in q_doc['follower']:
+        for f in iter_question_followers(q_coll, q_doc):
             if f['uid'] != asker:
                 follow_action = UserAction(None, '', f['uid'], FOLLOW_QUESTION)
                 self.question_followers.append(follow_action)
@@ -661,43 +664,115 @@ class StaticQuestionWithAnswer:
 
 class FeatureContainer:
     """
-    feature 的容器, 可以选择性地返回 feature, 用 pickle 存储
-    每次添加新 feature 都重新计算 feature container
+    feature 的列式存储, 可以选择性地返回 feature
+    每个 feature 和 target 各存成 dirname 下的一个 int64 文件, meta.json 记录行数和
+    已经写入的 topic collection. load 时用 memmap 映射, 不把数据读进内存,
+    get_column 返回的就是 memmap 本身, 不复制
+    append 的数据先放在内存里, dump 时追加到文件末尾, 所以可以按 topic collection
+    分批生成, 中断后已经 dump 的 collection 不用重新生成
     需要保证 feature_types 的特征顺序和 gen_features 返回的顺序一致
     """
     feature_types = ('h_rank','is_answer','is_upvote','is_comment',
                      'is_collect', 'r_order')
+    dtype = np.int64
 
-    def __init__(self, ):
-        self.features = []  # [[f11, f12], [f21, f22], ...]
-        self.target = []  # [1, 0, 0, 1, ...]
+    def __init__(self, dirname=None):
+        self.dirname = dirname
+        self.columns = {name: np.empty(0, self.dtype) for name in self.feature_types}
+        self.target = np.empty(0, self.dtype)  # [1, 0, 0, 1, ...]
+        self.collections = []  # 已经 dump 的 topic collection
+        self.pending = []  # 还没有 dump 的 [(features, target)]
+
+    def __len__(self):
+        return len(self.target)
 
     def append(self, flist, target):
         """
-        :param flist: [[f11, f12], [f21, f22], ...]
+        :param flist: n_samples * n_features, list or ndarray
         """
-        self.features.extend(flist)
-        self.target.extend(target)
+        features = np.asarray(flist, dtype=self.dtype).reshape(
+            -1, len(self.feature_types))
+        target = np.asarray(target, dtype=self.dtype)
+        assert len(features) == len(target)
+        self.pending.append((features, target))
+
+    def get_column(self, feature_name) -> np.ndarray:
+        return self.columns[feature_name]
 
-    def get_features(self, feature_names):
-        choosen_index = [
-            i for i, ftype in enumerate(self.feature_types) if ftype in feature_names
+    def get_features(self, feature_names) -> np.ndarray:
+        """
+        :return: n_samples * len(feature_names), 列的顺序和 feature_types 一致
+        """
+        choosen = [
+            ftype for ftype in self.feature_types if ftype in feature_names
         ]
-        return [itemgetter(*choosen_index)(f) for f in self.features]
-
-    def dump(self, filename):
-        with open(filename, 'wb') as f:
-            pickle.dump({
-                'feature': self.features,
-                'target': self.target
-            }, f)
-
-    def load(self, filename):
-        if os.path.exists(filename):
-            with open(filename, 'rb') as f:
-                data = pickle.load(f)
-                self.features = data['feature']
-                self.target = data['target']
+        return np.column_stack([self.columns[ftype] for ftype in choosen])
+
+    def _path(self, name):
+        return os.path.join(self.dirname, name + '.bin')
+
+    def dump(self, dirname=None, collection=None):
+        """
+        把 append 的数据追加到文件末尾
+        :param collection: 这批数据所属的 topic collection, 记录到 meta.json
+        """
+        self.dirname = dirname or self.dirname
+        os.makedirs(self.dirname, exist_ok=True)
+        rows = self._read_meta()['rows']
+        if self.pending:
+            features = np.concatenate([f for f, _ in self.pending])
+            target = np.concatenate([t for _, t in self.pending])
+            names = self.feature_types + ('target',)
+            arrays = [features[:, i] for i in range(len(self.feature_types))]
+            for name, array in zip(names, arrays + [target]):
+                with open(self._path(name), 'ab') as f:
+                    # 截掉上次中断时写了一半的数据
+                    f.truncate(rows * array.itemsize)
+                    f.write(np.ascontiguousarray(array, self.dtype).tobytes())
+            rows += len(target)
+            self.pending = []
+
+        collections = self._read_meta()['collections']
+        if collection is not None and collection not in collections:
+            collections.append(collection)
+        with open(os.path.join(self.dirname, 'meta.json'), 'w') as f:
+            json.dump({'rows': rows, 'collections': collections}, f)
+        self.load()
+
+    def load(self, dirname=None):
+        self.dirname = dirname or self.dirname
+        meta = self._read_meta()
+        rows = meta['rows']
+        self.collections = meta['collections']
+        for name in self.feature_types + ('target',):
+            if rows == 0:
+                column = np.empty(0, self.dtype)
+            else:
+                column = np.memmap(self._path(name), dtype=self.dtype,
+                                   mode='r', shape=(rows,))
+            if name == 'target':
+                self.target = column
+            else:
+                self.columns[name] = column
+
+    def _read_meta(self):
+        meta_file = os.path.join(self.dirname, 'meta.json')
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                return json.load(f)
+        return {'rows': 0, 'collections': []}
+
+    @classmethod
+    def convert_pickle(cls, filename, dirname):
+        """
+        把之前用 pickle 存储的 {'feature': [], 'target': []} 转换成列式存储
+        """
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        fc = cls(dirname)
+        fc.append(data['feature'], data['target'])
+        fc.dump()
+        return fc
 
 
 if __name__ == '__main__':
@@ -63,6 +63,9 @@ logging_dir = os.path.join(ROOT, 'infer/logs')
 
 
 class UserAction:
+    # 大答案会生成几十万个 UserAction, 用 __slots__ 省掉每个对象的 __dict__
+    __slots__ = ('time', 'aid', 'uid', 'acttype')
+
     def __init__(self, time, aid, uid, acttype):
         self.time = time
         self.aid = aid
@@ -73,26 +76,34 @@ class UserAction:
         return self.time < other.time
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.dump())
 
     def __eq__(self, other):
-        for key in self.__dict__:
-            assert self.__dict__[key] == other.__dict__[key]
-        return self.__dict__ == other.__dict__
+        return self is other or (
+            self.uid == other.uid and self.aid == other.aid and
+            self.acttype == other.acttype and self.time == other.time)
+
+    def dump(self):
+        return {'time': self.time, 'aid': self.aid, 'uid': self.uid,
+                'acttype': self.acttype}
 
 Relation = namedtuple('Relation', ['head', 'tail', 'reltype'])
 
 
 class FollowEdge:
+    __slots__ = ('head', 'tail', '_hash')
+
     def __init__(self, head, tail):
         self.head = head
         self.tail = tail
+        # uid 不会改变, hash 只算一次
+        self._hash = hash((head.uid, tail.uid))
 
     def __eq__(self, other):
         return self.head == other.head and self.tail == other.tail
 
     def __hash__(self):
-        return hash(self.head.uid + self.tail.uid)
+        return self._hash
 
     def __repr__(self):
         return self.head.uid + ',' + self.tail.uid
@@ -127,6 +138,8 @@ class FetchTypeError(Exception):
 
 
 class TimeRange:
+    __slots__ = ('start', 'end')
+
     def __init__(self, start=None, end=None):
         self.start = start
         self.end = end
@@ -144,7 +157,7 @@ class TimeRange:
         return not self.__le__(other)
 
     def dump(self):
-        return self.__dict__
+        return {'start': self.start, 'end': self.end}
 
 
 def sub(self, other: Union[datetime, TimeRange]):
@@ -1,9 +1,16 @@
 import os
 import json
+import time
+import heapq
 from datetime import datetime, timedelta
 from pprint import pprint
+from operator import attrgetter
+from multiprocessing.util import Finalize
 
 import requests
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReplaceOne
 from pymongo.son_manipulator import SONManipulator
 
 from icommon import *
@@ -32,11 +39,23 @@ def a_to_q(collection_name):
     return collection_name[:-1] + 'q'
 
 
+def a_to_e(collection_name):
+    # answer collection 对应的 event bucket collection
+    assert collection_name.endswith('_a')
+    return collection_name[:-1] + 'e'
+
+
 def q_to_a(collection_name):
     assert collection_name.endswith('_q')
     return collection_name[:-1] + 'a'
 
 
+def q_to_e(collection_name):
+    # question collection 对应的 event bucket collection
+    assert collection_name.endswith('_q')
+    return collection_name[:-1] + 'e'
+
+
 def get_time_string(t):
     return t.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -156,6 +175,14 @@ def config_smtp_handler(smtp_handler):
                 smtp_config['username'], smtp_config['password']
 
 
+def merge_by_time(*action_lists):
+    """
+    把多个已按时间排序的 UserAction 序列归并成一个生成器
+    时间相同时按参数顺序, 同一序列内保持原顺序
+    """
+    return heapq.merge(*action_lists, key=attrgetter('time'))
+
+
 def interpolate(useraction_list):
     index = 0
     LEN = len(useraction_list)
@@ -259,6 +286,73 @@ def transform_outgoing(son):
     return son
 
 
+# 推断只需要这些字段, 不取 answer doc 中的其它内容
+ANSWER_PROJECTION = {
+    '_id': 0, 'time': 1, 'answerer': 1, 'bucketed': 1,
+    'upvoters.uid': 1, 'upvoters.time': 1,
+    'commenters.uid': 1, 'commenters.time': 1,
+    'collectors.uid': 1, 'collectors.time': 1,
+}
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def find_answer(collection, aid, upvote_time=True):
+    """
+    只取推断需要的字段, 返回 RawBSONDocument, 访问时才解码,
+    upvoters/commenters/collectors 中的每一项也是访问时才解码
+    bucket 存储的答案 (见 dynamic/db.py) 从 <tid>_e 读出 event 填入, 返回 dict
+    :param upvote_time: 为 False 时不取 upvoter 的时间
+    """
+    projection = ANSWER_PROJECTION
+    if not upvote_time:
+        projection = {k: v for k, v in projection.items() if k != 'upvoters.time'}
+    answer_doc = collection.with_options(codec_options=RAW_CODEC_OPTIONS) \
+        .find_one({'aid': aid}, projection)
+    if answer_doc is None or not answer_doc.get('bucketed'):
+        return answer_doc
+
+    answer_doc = dict(answer_doc.items())
+    events = collection.database[a_to_e(collection.name)] \
+        .with_options(codec_options=RAW_CODEC_OPTIONS)
+    for kind in ('upvoters', 'commenters', 'collectors'):
+        fields = {'_id': 0, 'events.uid': 1}
+        if kind != 'upvoters' or upvote_time:
+            fields['events.time'] = 1
+        answer_doc[kind] = [
+            event for bucket in
+            events.find({'aid': aid, 'kind': kind}, fields).sort('seq', 1)
+            for event in bucket['events']
+        ]
+    return answer_doc
+
+
+def iter_question_followers(collection, q_doc):
+    """
+    按从老到新的顺序返回问题的 follower, 和 q_doc['follower'] 相同
+    bucket 存储的问题 (见 dynamic/db.py) 从 <tid>_e 逐个 bucket 读取
+    :param collection: q_doc 所在的 question collection
+    """
+    if not q_doc.get('bucketed'):
+        return iter(q_doc['follower'])
+    cursor = collection.database[q_to_e(collection.name)].find(
+        {'qid': q_doc['qid'], 'kind': 'follower'}, {'_id': 0, 'events': 1}
+    ).sort('seq', 1)
+    return (follower for bucket in cursor for follower in bucket['events'])
+
+
+def load_actions(users, aid, acttype, time_factory=None) -> list:
+    """
+    把 answer doc 中的 upvoters/commenters/collectors 转成 UserAction list,
+    预先分配好长度, 逐个解码填入
+    :param time_factory: 不为 None 时不读 time, 用它生成时间, 如 TimeRange
+    """
+    actions = [None] * len(users)
+    for i, u in enumerate(users):
+        time = u['time'] if time_factory is None else time_factory()
+        actions[i] = UserAction(time, aid, u['uid'], acttype)
+    return actions
+
+
 def is_upvote(action: UserAction):
     acttype = action.acttype
     return True if acttype & 0b001000 else False
@@ -351,6 +445,58 @@ def timerange2datetime(t: Union[datetime, TimeRange]):
         return avg_time(t.start, t.end)
 
 
+class BulkWriter:
+    """
+    缓存推断结果的 replace 操作, 攒够 flush_size 个, 或者距离上次写入超过
+    flush_interval 秒时, 用一次 unordered bulk_write 写入
+    同一个 aid 在缓存中只保留最后一次的 doc
+    """
+    def __init__(self, collection, flush_size=500, flush_interval=10):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.docs = {}  # {aid: doc}
+        self.last_flush = time.time()
+        self.written = 0
+
+    def replace(self, aid, doc):
+        self.docs[aid] = doc
+        if len(self.docs) >= self.flush_size or \
+                time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.docs:
+            self.collection.bulk_write([
+                ReplaceOne({'aid': aid}, doc, upsert=True)
+                for aid, doc in self.docs.items()
+            ], ordered=False)
+            self.written += len(self.docs)
+            self.docs = {}
+        self.last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+_bulk_writers = {}  # {collection full name: BulkWriter}
+
+
+def get_bulk_writer(collection, **kwargs):
+    """
+    进程内每个 collection 共用一个 BulkWriter, 进程退出时(包括进程池的 worker)
+    自动 flush
+    """
+    key = collection.full_name
+    if key not in _bulk_writers:
+        writer = _bulk_writers[key] = BulkWriter(collection, **kwargs)
+        Finalize(writer, writer.flush, exitpriority=10)
+    return _bulk_writers[key]
+
+
 __all__ = [
     'a_col', 'q_col', 'get_time_string', 'now_string',
     'get_datetime_day_month_year', 'get_datetime_hour_min_sec',
@@ -358,5 +504,7 @@ __all__ = [
     'dict_equal', 'is_a_col', 'is_q_col', 'config_smtp_handler', 'interpolate',
     'acttype2str', 'MyEncoder', 'a_to_q', 'q_to_a', 'transform_incoming',
     'transform_outgoing', 'is_upvote', 'is_comment', 'is_collect', 'is_answer',
-    'longestIncreasingSubsequence', 'avg_time', 'timerange2datetime'
+    'longestIncreasingSubsequence', 'avg_time', 'timerange2datetime',
+    'BulkWriter', 'get_bulk_writer', 'merge_by_time', 'find_answer',
+    'load_actions', 'a_to_e', 'q_to_e', 'iter_question_followers'
 ]
\ No newline at end of file
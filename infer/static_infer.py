@@ -1,73 +1,173 @@
+"""
+静态传播网络推断
+按问题分片, 用进程池并行推断. 每个进程只建立一次数据库连接, 只加载一次模型
+每推断完一个问题就记录到 checkpoint 文件, 中断后重新运行会跳过已完成的问题
+"""
+import os
 import sys
 import pickle
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pymongo
 
 from iutils import *
+from icommon import db2
 from feature import StaticQuestionWithAnswer, StaticAnswer
-from user import UserManager
+from user import UserManager, FOLLOW_MEMO_FILE, DEFER_FETCH_FILE
 
-# load model
-model = pickle.load(open('data/model_0315.pkl', 'rb'))
-print(model)
+logger = logging.getLogger(__name__)
 
+MODEL_FILE = 'data/model_0315.pkl'
 
-def infer_test():
-    # set db, user_manager
-    db = pymongo.MongoClient('127.0.0.1', 27017, connect=False).get_database('test')
+# 以下由 init_worker 在每个进程中设置
+db = None
+model = None
+
+
+def init_worker(db_name, model_file=MODEL_FILE, defer_fetch=False,
+                defer_default=False):
+    """
+    ProcessPoolExecutor 的 initializer, 设置 db, user_manager, 加载模型
+    关注关系备忘表在进程退出时写回本进程的文件
+    :param defer_fetch: 离线模式, 缺少关注关系时不实时抓取, 记录到 DEFER_FETCH_FILE,
+                        当作 defer_default 处理
+    """
+    global db, model
+    db = pymongo.MongoClient('127.0.0.1', 27017).get_database(db_name)
+    kwargs = {'memo_file': FOLLOW_MEMO_FILE % db_name}
+    if defer_fetch:
+        kwargs.update(defer_file=DEFER_FETCH_FILE % db_name,
+                      defer_default=defer_default)
     sys.modules['feature'].__dict__['db'] = db
-    sys.modules['feature'].__dict__['user_manager'] = UserManager(db.user)
-    for collection_name in db.collection_names():
-        if not is_q_col(collection_name):
-            continue
-        q_collection = db[collection_name]
-        a_collection = db[q_to_a(collection_name)]
-        for q_doc in q_collection.find({}, {'qid':1, 'topic':1}):
-            qid = q_doc['qid']
-            tid = collection_name[:-2]
-            sqa = StaticQuestionWithAnswer(tid, qid)
-
-            # get answers, invoke answer.infer_preparation
-            answers = []
-            for answer_doc in a_collection.find({'qid': qid}, {'aid': 1}):
-                answer = StaticAnswer(tid, answer_doc['aid'])
-                # 如果没有侯选边,就不推断
-                answer.load_from_raw()
-                answer.infer_preparation(sqa)
-                answers.append(answer)
-
-            # fill follower
-            sqa.fill_question_follower_time()
-
-            # infer
-            for answer in answers:
-                answer.infer(model=model, save_to_db=True, coll_name='static_test')
+    sys.modules['feature'].__dict__['user_manager'] = UserManager(db.user, **kwargs)
+    with open(model_file, 'rb') as f:
+        model = pickle.load(f)
+
+
+def infer_question_task(tid, qid, q_coll_name, coll_name):
+    """
+    推断一个问题下的所有答案, 结果写入 coll_name
+    :return: 答案数量
+    """
+    a_coll_name = q_to_a(q_coll_name)
+    sqa = StaticQuestionWithAnswer(tid, qid, q_coll_name)
+
+    answers = []
+    for answer_doc in db[a_coll_name].find({'qid': qid}, {'aid': 1}):
+        answer = StaticAnswer(tid, answer_doc['aid'])
+        answer.load_from_raw(a_coll_name)
+        answers.append(answer)
+
+    # 先加载好所有用户, 再 infer_preparation
+    sqa.prefetch_users(answers)
+    for answer in answers:
+        answer.infer_preparation(sqa)
+
+    # fill follower
+    sqa.fill_question_follower_time()
+
+    # infer
+    for answer in answers:
+        answer.infer(model=model, save_to_db=True, coll_name=coll_name)
+    # 返回之前写完, 保证 checkpoint 中记录的问题都已经写入
+    get_bulk_writer(db2.get_collection(coll_name)).flush()
+    logger.debug("follow memo: %s" %
+                 sys.modules['feature'].user_manager.memo.stats())
+    return len(answers)
+
+
+def load_checkpoint(checkpoint):
+    """
+    :return: {(q_coll_name, qid)}
+    """
+    done = set()
+    if os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            for line in f:
+                q_coll_name, qid = line.strip().split(',')
+                done.add((q_coll_name, qid))
+    return done
+
+
+def infer_all(db_name, coll_name, q_colls=None, max_workers=8, checkpoint=None,
+              defer_fetch=False, defer_default=False):
+    """
+    :param coll_name: 写入的 collection name
+    :param q_colls: [(q_coll_name, tid)], 默认为 db 中所有 question collection
+    :param checkpoint: 记录已完成问题的文件, 每行 q_coll_name,qid
+    :param defer_fetch, defer_default: 见 init_worker
+    """
+    client = pymongo.MongoClient('127.0.0.1', 27017, connect=False)
+    source_db = client.get_database(db_name)
+    if q_colls is None:
+        q_colls = [
+            (collection_name, collection_name[:-2])
+            for collection_name in source_db.collection_names()
+            if is_q_col(collection_name)
+        ]
+    checkpoint = checkpoint or 'data/static_infer_%s.ckpt' % coll_name
+    done = load_checkpoint(checkpoint)
+
+    tasks = []
+    for q_coll_name, tid in q_colls:
+        for q_doc in source_db[q_coll_name].find({}, {'qid': 1}):
+            if (q_coll_name, q_doc['qid']) not in done:
+                tasks.append((tid, q_doc['qid'], q_coll_name, coll_name))
+    client.close()
+    logger.info("%d questions done, %d to infer" % (len(done), len(tasks)))
+    run_tasks(db_name, tasks, max_workers, checkpoint, defer_fetch, defer_default)
+
+
+def infer_many(db_name, coll_name, filename, max_workers=8,
+               defer_fetch=False, defer_default=False):
+    """
+    只重新推断文件中列出的问题, 每行 tid,qid,q_coll_name, 如 bin/fetch_fo.py
+    补抓之后生成的受影响问题列表. 不读 checkpoint, 已经推断过的会被覆盖
+    """
+    tasks = []
+    with open(filename) as f:
+        for line in f:
+            tid, qid, q_coll_name = line.strip().split(',')
+            tasks.append((tid, qid, q_coll_name, coll_name))
+    run_tasks(db_name, tasks, max_workers,
+              'data/static_infer_%s.ckpt' % coll_name, defer_fetch, defer_default)
+
+
+def run_tasks(db_name, tasks, max_workers, checkpoint, defer_fetch=False,
+              defer_default=False):
+    """
+    :param tasks: [(tid, qid, q_coll_name, coll_name)]
+    """
+    answer_count = 0
+    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                   initargs=(db_name, MODEL_FILE, defer_fetch,
+                                             defer_default))
+    with executor, open(checkpoint, 'a') as f:
+        futures = {executor.submit(infer_question_task, *task): task
+                   for task in tasks}
+        for future in as_completed(futures):
+            tid, qid, q_coll_name, _ = futures[future]
+            try:
+                answer_count += future.result()
+            except Exception:
+                logger.exception("fail to infer question %s in %s" %
+                                 (qid, q_coll_name))
+                continue
+            f.write('%s,%s\n' % (q_coll_name, qid))
+            f.flush()
+
+    logger.info("infer %d answers" % answer_count)
+
+
+def infer_test():
+    infer_all('test', 'static_test')
 
 
 def infer_water():
-    # set db, user_manager
-    db = pymongo.MongoClient('127.0.0.1', 27017, connect=False).\
-        get_database('analysis')
-    sys.modules['feature'].__dict__['db'] = db
-    sys.modules['feature'].__dict__['user_manager'] = UserManager(db.user)
-    q_collection = db['water_q']
-    a_collection = db['water_a']
-    for q_doc in q_collection.find({}, {'qid':1, 'topic':1}):
-        qid = q_doc['qid']
-        sqa = StaticQuestionWithAnswer(None, qid, 'water_q')
-        answers = []
-        for answer_doc in a_collection.find({'qid': qid}, {'aid': 1}):
-            answer = StaticAnswer(None, answer_doc['aid'])
-            # 如果没有侯选边,就不推断
-            answer.load_from_raw('water_a')
-            answer.infer_preparation(sqa)
-            answers.append(answer)
-
-        # fill follower
-        sqa.fill_question_follower_time()
-
-        # infer
-        for answer in answers:
-            answer.infer(model=model, save_to_db=True, coll_name='static_water')
-
-
-infer_water()
\ No newline at end of file
+    infer_all('analysis', 'static_water', q_colls=[('water_q', None)])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    infer_water()
@@ -18,7 +18,7 @@ db = pymongo.MongoClient('127.0.0.1', 27017).get_database('train')
 sys.modules['feature'].__dict__['db'] = db
 sys.modules['feature'].__dict__['user_manager'] = UserManager(db.user)
 
-pickle_filename = 'data/feature_0315.pkl'
+feature_dirname = 'data/feature_0315'
 
 
 def gen_traindata_selected():
@@ -56,12 +56,17 @@ def gen_traindata_selected():
 
 def gen_traindata_from_all():
     """
-    生成数据库中全部数据的 features, samples. 用于从无到有生成边,特征,所以只需调用一次
+    生成数据库中全部数据的 features, samples. 用于从无到有生成边,特征
+    每个 topic collection 生成完就追加到 feature_dirname, 已经生成的 collection 跳过
     """
-    fc = FeatureContainer()
+    fc = FeatureContainer(feature_dirname)
+    fc.load()
     a_colls = ["19550517_a", "19551147_a", "19561087_a", "19553298_a"]
     try:
         for a_coll in a_colls:
+            if a_coll in fc.collections:
+                print("skip " + a_coll)
+                continue
             count = 0
             print(a_coll)
             tid = a_coll[:-2]
@@ -72,27 +77,29 @@ def gen_traindata_from_all():
                 aid = adoc['aid']
                 answer = StaticAnswer(tid, aid)
                 answer.load_from_raw()
+                answer.prefetch_users()
                 answer.build_cand_edges()
                 fc.append(answer.gen_features(), answer.gen_target())
+            fc.dump(collection=a_coll)
     except:
         print(count)
         raise
-    fc.dump(pickle_filename)
-    print(len(fc.features))
+    print(len(fc))
 
 
 def feature_selection():
     import numpy as np
     from sklearn.cross_validation import cross_val_score
-    fc = FeatureContainer()
-    fc.load(pickle_filename)
+    fc = FeatureContainer(feature_dirname)
+    fc.load()
     clf = svm.SVC()
-    print("number of 0: %d" % fc.target.count(0))
-    print("number of 1: %d" % fc.target.count(1))
+    print("number of 0: %d" % np.count_nonzero(fc.target == 0))
+    print("number of 1: %d" % np.count_nonzero(fc.target == 1))
 
     # 值越小越好
     print("use all features")
-    print(np.sqrt(-cross_val_score(clf, fc.features, fc.target, cv=10,
+    print(np.sqrt(-cross_val_score(clf, fc.get_features(fc.feature_types),
+                                   fc.target, cv=10,
                                    scoring='mean_squared_error')).mean())
 
     # 每次排除一个特征
@@ -173,8 +180,8 @@ def param_tuning():
 
         clf = GridSearchCV(svm.SVC(C=1), tuned_parameters, cv=10,
                            scoring=score)
-        fc = FeatureContainer()
-        fc.load(pickle_filename)
+        fc = FeatureContainer(feature_dirname)
+        fc.load()
         F = fc.get_features(('h_rank','is_upvote','is_comment',
                              'is_collect', 'r_order'))
         print(len(F))
@@ -197,8 +204,8 @@ def train():
     clf = svm.SVC(**{'C': 1, 'kernel': 'rbf', 'gamma': 0.0001},
                   probability=True)
     print(clf.C, clf.kernel, clf.gamma)
-    fc = FeatureContainer()
-    fc.load(pickle_filename)
+    fc = FeatureContainer(feature_dirname)
+    fc.load()
     F = fc.get_features(('h_rank', 'is_upvote', 'is_comment',
                          'is_collect', 'r_order'))
     clf.fit(F, fc.target)
@@ -1,121 +1,604 @@
+import os
+import sys
+import glob
 import bisect
-from functools import reduce
-from typing import Union
+import heapq
+import pickle
+from array import array
+from operator import itemgetter
+from collections import OrderedDict
+from itertools import chain
+from typing import Optional
 from datetime import datetime
+from multiprocessing.util import Finalize
 
 from zhihu.author import ANONYMOUS
 
+from icommon import USER_PREFIX
+
+
+class UidInterner:
+    """
+    uid 字符串和 int id 一一对应, 同一个 uid 在进程内只存一份
+    id 只增不减, 占用的字节数计入 UserManager 的缓存上限, 过大时由 UserManager
+    在两个问题之间 reset, 之前分配的 id 全部作废, generation 加一
+    """
+    def __init__(self):
+        self.ids = {}  # {uid: id}
+        self.uids = []  # id -> uid
+        self.nbytes = 0  # uid 字符串和 dict/list 中的条目, 估算值
+        self.generation = 0
+
+    def intern(self, uid) -> int:
+        id_ = self.ids.get(uid)
+        if id_ is None:
+            id_ = self.ids[uid] = len(self.uids)
+            self.uids.append(uid)
+            self.nbytes += sys.getsizeof(uid) + INTERNER_ENTRY_BYTES
+        return id_
+
+    def get(self, uid) -> Optional[int]:
+        """
+        不存在返回 None, 不新增 id
+        """
+        return self.ids.get(uid)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def reset(self):
+        self.ids = {}
+        self.uids = []
+        self.nbytes = 0
+        self.generation += 1
+
+INTERNER_ENTRY_BYTES = 120  # dict 中一项加 list 中一个指针, 按扩容后的平均值估算
+interner = UidInterner()
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # 每个进程的 follower/followee 缓存上限
+PREFETCH_BATCH_SIZE = 500  # 每次 $in 查询的 uid 数量
+DEFAULT_MEMO_CAPACITY = 1000000  # 关注关系备忘表的条目数上限
+DEFAULT_MEMO_MAX_BYTES = 128 * 1024 * 1024  # 关注关系备忘表的字节数上限
+# % db_name, 不同数据库的 user 不同; 每个进程写自己的 <前缀>.<pid>.pkl
+FOLLOW_MEMO_FILE = 'data/follow_memo_%s'
+INTERNER_RESET_RATIO = 0.5  # interner 超过缓存上限的这个比例时 reset
+DEFER_FETCH_FILE = 'data/tobe_fetch_%s.txt'  # % db_name
+USER_SNAPSHOT_COLL = 'user_snapshot'  # 快照的 bucket, 见 dynamic/huey_tasks.py
+
+
+def snapshot_cutoff(times, time) -> int:
+    """
+    :param times: 各个快照的时间
+    :return: 截止到 time 需要累加的快照个数, 规则和 get_closest_users 相同
+    """
+    if len(times) <= 1 or None in times or not isinstance(time, datetime):
+        return len(times)
+    pos = bisect.bisect(times, time)
+    if pos == 0:
+        return 1
+    elif pos == len(times):
+        return pos
+    elif time - times[pos-1] < times[pos] - time:
+        return pos
+    else:
+        return pos + 1
+
+
+class FollowList:
+    """
+    一个用户的 follower 或 followee, 对应 user doc 中的
+    [{'time': t1, 'uids': [...]}, {'time': t2, 'uids': [...]}, ...]
+    所有 uid 转成 id 后排序存成一个 array, 另用平行的 array 记录每个 id
+    最早出现在第几个快照, 查询某时刻是否包含某 uid 只需一次二分查找
+    """
+    __slots__ = ('times', 'ids', 'snapshots', 'unknown_time')
+
+    def __init__(self, flist, uid_groups=None):
+        """
+        :param uid_groups: [(快照下标, uids)], 按下标排序, 同一快照可以分成多段,
+                           可以是边读边返回的迭代器. 不指定时用 flist 中的 uids
+        """
+        self.times = [fdict['time'] for fdict in flist]
+        self.unknown_time = None in self.times
+        if uid_groups is None:
+            uid_groups = enumerate(fdict['uids'] for fdict in flist)
+        first = {}  # {id: 最早出现的快照下标}
+        for i, uids in uid_groups:
+            for uid in uids:
+                first.setdefault(interner.intern(uid), i)
+        ids = sorted(first)
+        self.ids = array('i', ids)
+        self.snapshots = array('H', [first[id_] for id_ in ids])
+
+    def cutoff(self, time) -> int:
+        """
+        :return: 截止到 time 需要累加的快照个数
+        """
+        if self.unknown_time:
+            return len(self.times)
+        return snapshot_cutoff(self.times, time)
+
+    def first_snapshot(self, id_) -> int:
+        """
+        :return: id 最早出现在第几个快照, 不存在返回 -1
+        """
+        i = bisect.bisect_left(self.ids, id_)
+        if i < len(self.ids) and self.ids[i] == id_:
+            return self.snapshots[i]
+        return -1
+
+    def contains(self, id_, cutoff) -> bool:
+        i = bisect.bisect_left(self.ids, id_)
+        return i < len(self.ids) and self.ids[i] == id_ \
+            and self.snapshots[i] < cutoff
+
+    def count(self, cutoff) -> int:
+        if cutoff >= len(self.times):
+            return len(self.ids)
+        return sum(1 for s in self.snapshots if s < cutoff)
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.ids) + sys.getsizeof(self.snapshots) + \
+            sys.getsizeof(self.times) + \
+            sum(sys.getsizeof(t) for t in self.times)
+
+    def uids(self, cutoff) -> list:
+        uids = interner.uids
+        return [uids[id_] for id_, s in zip(self.ids, self.snapshots)
+                if s < cutoff]
+
+
+class FollowView:
+    """
+    FollowList 在某一时刻的视图, 支持 in, len, 迭代, 可以当作 uid 集合使用
+    """
+    __slots__ = ('flist', 'cutoff')
+
+    def __init__(self, flist: FollowList, time=None):
+        self.flist = flist
+        self.cutoff = flist.cutoff(time)
+
+    def __contains__(self, uid):
+        id_ = interner.get(uid)
+        return id_ is not None and self.flist.contains(id_, self.cutoff)
+
+    def __len__(self):
+        return self.flist.count(self.cutoff)
+
+    def __iter__(self):
+        return iter(self.flist.uids(self.cutoff))
+
+    def ids(self):
+        """
+        视图中所有 uid 的 int id, 从小到大
+        """
+        cutoff = self.cutoff
+        return (id_ for id_, s in zip(self.flist.ids, self.flist.snapshots)
+                if s < cutoff)
+
+    def intersect(self, ids) -> list:
+        """
+        :param ids: 从小到大排列的 id 序列
+        :return: 同时在 ids 和视图中的 id, 从小到大
+        """
+        flist, cutoff = self.flist, self.cutoff
+        own, snapshots = flist.ids, flist.snapshots
+        if len(ids) * 8 < len(own):
+            # ids 很短时逐个二分查找
+            return [id_ for id_ in ids if flist.contains(id_, cutoff)]
+        result = []
+        i = j = 0
+        while i < len(own) and j < len(ids):
+            if own[i] < ids[j]:
+                i += 1
+            elif own[i] > ids[j]:
+                j += 1
+            else:
+                if snapshots[i] < cutoff:
+                    result.append(own[i])
+                i += 1
+                j += 1
+        return result
+
+
+class FollowMemo:
+    """
+    关注关系备忘表, {(数据来源, follower uid, followee uid): (快照时间列表, 首次出现的快照下标)}
+    数据来源为 'follower' 或 'followee', 即查的是 followee 的 follower 还是
+    follower 的 followee, 两者分开记录, 结果和直接查对应的 FollowList 相同
+    下标为 -1 表示所有快照中都没有. 同一对用户在不同时刻的查询共用一项,
+    用 snapshot_cutoff 算出截止的快照个数再和下标比较
+    有自己的 LRU 上限, 和 FollowList 的缓存分开淘汰; 重新抓取某个用户后
+    用 invalidate 使以他为来源的记录失效
+    指定 prefix 时加载所有进程写的 <prefix>.*.pkl, 进程退出时只写自己的文件,
+    多个进程同时写不会互相覆盖. 合并时每个来源取最大的 generation, 旧的记录丢弃
+    """
+    def __init__(self, capacity=DEFAULT_MEMO_CAPACITY,
+                 max_bytes=DEFAULT_MEMO_MAX_BYTES, prefix=None):
+        self.lru = LRUCache(capacity, max_bytes)
+        self.generations = {}  # {(field, owner uid): 重新抓取的次数}
+        self.hits = self.misses = 0
+        self.prefix = prefix
+        self.filename = '%s.%d.pkl' % (prefix, os.getpid()) if prefix else None
+        self.loaded_files = []
+        if prefix:
+            self.load()
+
+    def __len__(self):
+        return len(self.lru)
+
+    def get(self, field, follower_uid, followee_uid, time,
+            snapshots=None) -> Optional[bool]:
+        """
+        :param snapshots: 来源当前的快照个数, 已知时和记录比较, 不同说明有新快照
+        :return: 没有记录或记录已失效返回 None
+        """
+        owner = followee_uid if field == 'follower' else follower_uid
+        entry = self.lru.get((field, follower_uid, followee_uid))
+        if entry is None or entry[2] != self.generations.get((field, owner), 0) \
+                or (snapshots is not None and snapshots != len(entry[0])):
+            self.misses += 1
+            return None
+        self.hits += 1
+        times, first, _ = entry
+        return 0 <= first < snapshot_cutoff(times, time)
+
+    def set(self, field, follower_uid, followee_uid, times, first):
+        owner = followee_uid if field == 'follower' else follower_uid
+        self.lru.set((field, follower_uid, followee_uid),
+                     (times, first, self.generations.get((field, owner), 0)),
+                     self._size(follower_uid, followee_uid))
+
+    @staticmethod
+    def _size(follower_uid, followee_uid) -> int:
+        # key 和 value 两个 tuple; times 和 FollowList 共用, 不计入
+        return 2 * sys.getsizeof((0, 0, 0)) + sys.getsizeof(follower_uid) + \
+            sys.getsizeof(followee_uid) + 64
+
+    def invalidate(self, field, owner):
+        """
+        owner 的 field 被重新抓取, 之前以它为来源的记录都失效
+        """
+        self.generations[(field, owner)] = self.generations.get((field, owner), 0) + 1
+
+    def load(self):
+        """
+        合并所有进程的文件, 先合并 generations, 再丢弃 generation 较旧的记录
+        """
+        tables = []
+        for filename in sorted(glob.glob(glob.escape(self.prefix) + '.*.pkl')):
+            try:
+                with open(filename, 'rb') as f:
+                    generations, entries = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue  # 被其他进程删除或写了一半
+            self.loaded_files.append(filename)
+            tables.append(entries)
+            for key, generation in generations.items():
+                if generation > self.generations.get(key, 0):
+                    self.generations[key] = generation
+        for entries in tables:
+            for (field, follower_uid, followee_uid), (times, first, generation) in entries:
+                owner = followee_uid if field == 'follower' else follower_uid
+                if generation == self.generations.get((field, owner), 0):
+                    self.lru.set((field, follower_uid, followee_uid),
+                                 (times, first, generation),
+                                 self._size(follower_uid, followee_uid))
+
+    def save(self):
+        """
+        写入本进程的文件, 再删掉加载时合并过的其他文件, 它们的记录已经在本进程中
+        """
+        filename = self.filename
+        if not filename:
+            return
+        entries = [(key, value) for key, (value, _) in self.lru.table.items()]
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump((self.generations, entries), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        for loaded in self.loaded_files:
+            if loaded != filename:
+                try:
+                    os.remove(loaded)
+                except OSError:
+                    pass
+        self.loaded_files = [filename]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.lru),
+            'nbytes': self.lru.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class DeferredFetch:
+    """
+    离线模式下代替实时抓取, 把缺少数据的用户对追加到文件, 然后返回 default
+    每行格式和推断时的日志相同, 最后加上 aid:
+    "<followee> lacks follower,<follower> lacks followee,<aid>"
+    之后用 bin/fetch_fo.py 补抓, 再只重新推断受影响的问题
+    """
+    def __init__(self, filename, default=False):
+        self.filename = filename
+        self.default = default
+        self.recorded = set()
+
+    def __len__(self):
+        return len(self.recorded)
+
+    def record(self, follower_uid, followee_uid, aid='') -> bool:
+        key = (follower_uid, followee_uid, aid)
+        if key not in self.recorded:
+            self.recorded.add(key)
+            with open(self.filename, 'a') as f:
+                f.write('%s lacks follower,%s lacks followee,%s\n' %
+                        (followee_uid, follower_uid, aid))
+        return self.default
+
 
 class UserManager:
     """
     管理 user
     """
-    def __init__(self, coll, capacity=1000):
+    def __init__(self, coll, capacity=100000, max_bytes=DEFAULT_MAX_BYTES,
+                 memo_capacity=DEFAULT_MEMO_CAPACITY,
+                 memo_max_bytes=DEFAULT_MEMO_MAX_BYTES, memo_file=None,
+                 defer_file=None, defer_default=False, snapshot_coll=None):
         self.coll = coll    # user collection
-        self.followers = {}  # user follower, {uid: []}
-        self.followees = {}  # user followee, {uid: []}
-        self.lru = LRUCache(capacity)  # followee 和 follower 共用
+        # 快照的 bucket collection, 默认为 coll 所在数据库的 USER_SNAPSHOT_COLL
+        self.snapshot_coll = snapshot_coll
+        # followee 和 follower 共用, {uid: {'follower': FollowList, 'followee': FollowList}}
+        # 淘汰一个 uid 时它的 follower 和 followee 一起释放
+        # interner 的字节数也计入 max_bytes, 见 release_interner
+        self.lru = LRUCache(capacity, max_bytes, reserved=lambda: interner.nbytes)
+        # 关注关系备忘表, 上限和 self.lru 分开, 指定 memo_file 时进程退出时写回
+        self.memo = FollowMemo(memo_capacity, memo_max_bytes, memo_file)
+        if memo_file:
+            Finalize(self, self.memo.save, exitpriority=10)
+        # 指定 defer_file 时不实时抓取, 见 DeferredFetch
+        self.deferred = DeferredFetch(defer_file, defer_default) \
+            if defer_file else None
 
     def shrink(self):
-        self.followers = {
-            node.key: self.followers[node.key] for node in self.lru.hashtable
-            if node.key in self.followers
-        }
-        self.followees = {
-            node.key: self.followees[node.key] for node in self.lru.hashtable
-            if node.key in self.followees
-        }
+        self.lru.evict()
 
-    def reset_capacity(self, new_capacity: int):
+    def reset_capacity(self, new_capacity: int, max_bytes=None):
         assert new_capacity > 0
-        self.lru.cap = new_capacity
+        self.lru.reset_capacity(new_capacity, max_bytes)
+
+    def cache_stats(self) -> dict:
+        stats = self.lru.stats()
+        stats['interner_nbytes'] = interner.nbytes
+        return stats
 
-    def get_user_follower(self, uid, time=None) -> Union[list, None]:
+    def release_interner(self) -> bool:
+        """
+        interner 只增不减, 缓存的 FollowList 被淘汰后其中的 uid 仍然留在 interner 中,
+        超过 max_bytes * INTERNER_RESET_RATIO 时 reset, 同时清空缓存的 FollowList.
+        只能在没有 FollowView/FollowerIndex 正在使用时调用, prefetch 开始时自动调用
+        FollowMemo 中记录的是 uid 和快照下标, 不受影响
+        :return: 是否 reset
+        """
+        max_bytes = self.lru.max_bytes
+        if max_bytes is None or interner.nbytes <= max_bytes * INTERNER_RESET_RATIO:
+            return False
+        interner.reset()
+        self.lru.clear()
+        return True
+
+    def get_user_follower(self, uid, time=None) -> Optional[FollowView]:
         """
         逻辑非常复杂
-        if uid in self.followers, 返回 self.followers[uid]
+        if uid 的 follower 在 self.lru 中, 直接返回
         else
-            if 数据库中有doc且有follower, 更新self.followers, 返回follower, 可为[]
-            if 数据库中有doc但不包含follower, 返回None, self.followers[uid]=None
-            if 数据库中没有doc, 返回None, self.followers[uid]=None
+            if 数据库中有doc且有follower, 存入self.lru, 返回follower, 可为空
+            if 数据库中有doc但不包含follower, 返回None, 缓存 None
+            if 数据库中没有doc, 返回None, 缓存 None
         time 指取到哪个时刻的follower
         """
-        self.lru.set(uid)
-        if uid in self.followers:
-            if self.followers[uid] is None:
-                return None
-            else:
-                return self.get_closest_users(self.followers[uid], time)
+        return self._get_users('follower', uid, time)
 
-        user_doc = self.coll.find_one({'uid': uid}, {'follower': 1, '_id': 0})
-        if user_doc is None:
-            self.followers[uid] = None
-            return None
-        else:
-            if 'follower' in user_doc:
-                self.followers[uid] = user_doc['follower']
-                return self.get_closest_users(user_doc['follower'], time)
-            else:
-                self.followers[uid] = None
-                return None
-
-    def fetch_user_follower(self, user) -> list:
+    def fetch_user_follower(self, user) -> FollowView:
         """
-        之前没有follower, 要重新抓取, 返回抓到的, 并更新 self.followers
+        之前没有follower, 要重新抓取, 返回抓到的, 并更新 self.lru
         """
-        self.lru.set(user.id)
         uids = [er.id for er in user.followers if er is not ANONYMOUS]
-        self.coll.update_one({
-            'uid': user.id,
-        }, {
-            "$set": {
-                "follower": [{
-                    'time': datetime.now(),
-                    'uids': uids
-                }]
+        return self._save_users('follower', user.id, uids)
+
+    def get_user_followee(self, uid, time=None) -> Optional[FollowView]:
+        """
+        逻辑同 get_user_follower
+        """
+        return self._get_users('followee', uid, time)
+
+    def fetch_user_followee(self, user) -> FollowView:
+        uids = [ee.id for ee in user.followees if ee is not ANONYMOUS]
+        return self._save_users('followee', user.id, uids)
+
+    def prefetch(self, uids, fields=('follower', 'followee')):
+        """
+        批量加载 uids 的 follower/followee, 用 $in 查询代替逐个 find_one
+        已经缓存的 uid 跳过, 数据库中没有的也缓存为 None, 之后不再查询
+        :return: 实际查询的 uid 数量
+        """
+        self.release_interner()
+        todo = []
+        for uid in set(uids):
+            if uid == '':  # 匿名用户
+                continue
+            entry = self.lru.peek(uid)
+            if entry is None or any(field not in entry for field in fields):
+                todo.append(uid)
+
+        projection = {field: 1 for field in fields}
+        projection.update({'uid': 1, '_id': 0})
+        for i in range(0, len(todo), PREFETCH_BATCH_SIZE):
+            batch = todo[i:i+PREFETCH_BATCH_SIZE]
+            docs = {
+                doc['uid']: doc for doc in
+                self.coll.find({'uid': {'$in': batch}}, projection)
             }
-        }, upsert=True)
-        self.followers[user.id] = [{'time': datetime.now(), 'uids': uids}]
-        return self.followers[user.id]
+            buckets = self._load_buckets(docs, fields)
+            for uid in batch:
+                doc = docs.get(uid, {})
+                for field in fields:
+                    flist = self._follow_list(uid, field, doc[field],
+                                              buckets.get((uid, field), [])) \
+                        if field in doc else None
+                    self._cache(uid, field, flist)
+
+        return len(todo)
 
-    def get_user_followee(self, uid, time=None) -> Union[list, None]:
+    def follows(self, follower_uid, followee_uid, time=None,
+                prefer_followee=False) -> Optional[bool]:
         """
-        逻辑同 get_user_followee
+        判断 time 时刻 follower_uid 是否关注了 followee_uid
+        优先查 followee_uid 的 follower, 没有再查 follower_uid 的 followee,
+        每种数据来源先查 self.memo 中同一来源的记录, 结果和查询顺序无关
+        :param prefer_followee: 优先查 follower_uid 的 followee
+        :return: 两者数据都没有时返回 None
         """
-        self.lru.set(uid)
-        if uid in self.followees:
-            if self.followees[uid] is None:
-                return None
-            else:
-                return self.get_closest_users(self.followees[uid], time)
+        sources = [('follower', followee_uid, follower_uid),
+                   ('followee', follower_uid, followee_uid)]
+        if prefer_followee:
+            sources.reverse()
+        for field, owner, target in sources:
+            # 来源已经缓存时顺便检查快照个数, 从文件加载的记录可能是旧数据
+            entry = self.lru.peek(owner)
+            flist = entry.get(field) if entry is not None else None
+            snapshots = len(flist.times) if flist is not None else None
+            follows = self.memo.get(field, follower_uid, followee_uid, time,
+                                    snapshots)
+            if follows is not None:
+                return follows
+            flist = self._get_list(field, owner)
+            if flist is not None:
+                id_ = interner.get(target)
+                first = flist.first_snapshot(id_) if id_ is not None else -1
+                self.memo.set(field, follower_uid, followee_uid, flist.times, first)
+                return 0 <= first < flist.cutoff(time)
+        return None
 
-        user_doc = self.coll.find_one({'uid': uid}, {'followee': 1, '_id': 0})
-        if user_doc is None:
-            self.followees[uid] = None
-            return None
+    def fetch_follows(self, follower_uid, followee_uid, get_client, aid='') -> bool:
+        """
+        数据库中两者的数据都没有时调用, 抓取 follower_uid 的 followee 和
+        followee_uid 的 follower 中较少的一个, 再判断关注关系
+        离线模式下只记录, 返回 self.deferred.default
+        :param get_client: 返回 ZhihuClient 的函数, 离线模式下不会调用
+        :param aid: 记录是哪个答案需要, 用于之后重新推断
+        """
+        if self.deferred is not None:
+            return self.deferred.record(follower_uid, followee_uid, aid)
+        client = get_client()
+        u1 = client.author(USER_PREFIX + follower_uid)
+        u2 = client.author(USER_PREFIX + followee_uid)
+        if u1.followee_num < u2.follower_num:
+            self.fetch_user_followee(u1)
+            return self.follows(follower_uid, followee_uid, prefer_followee=True)
         else:
-            if 'followee' in user_doc:
-                self.followees[uid] = user_doc['followee']
-                return self.get_closest_users(user_doc['followee'], time)
+            self.fetch_user_follower(u2)
+            return self.follows(follower_uid, followee_uid)
+
+    def _get_list(self, field, uid) -> Optional[FollowList]:
+        entry = self.lru.get(uid)
+        if entry is None or field not in entry:
+            user_doc = self.coll.find_one({'uid': uid}, {field: 1, '_id': 0})
+            if user_doc is None or field not in user_doc:
+                flist = None
             else:
-                self.followees[uid] = None
-                return None
+                flist = self._follow_list(uid, field, user_doc[field])
+            entry = self._cache(uid, field, flist)
+        return entry[field]
 
-    def fetch_user_followee(self, user) -> list:
-        self.lru.set(user.id)
-        uids = [ee.id for ee in user.followees if ee is not ANONYMOUS]
+    @staticmethod
+    def _bucketed(snapshots) -> bool:
+        return any(snapshot.get('bucketed') for snapshot in snapshots)
+
+    def _get_snapshot_coll(self):
+        if self.snapshot_coll is None:
+            self.snapshot_coll = self.coll.database[USER_SNAPSHOT_COLL]
+        return self.snapshot_coll
+
+    def _load_buckets(self, docs, fields) -> dict:
+        """
+        一次 $in 查询读出 docs 中所有 bucket 存储的快照
+        :param docs: {uid: user doc}
+        :return: {(uid, field): [(snap, uids)]}, 按 (snap, seq) 排序
+        """
+        uids = [uid for uid, doc in docs.items()
+                if any(field in doc and self._bucketed(doc[field])
+                       for field in fields)]
+        buckets = {}
+        if not uids:
+            return buckets
+        cursor = self._get_snapshot_coll().find(
+            {'uid': {'$in': uids}, 'kind': {'$in': list(fields)}},
+            {'uid': 1, 'kind': 1, 'snap': 1, 'uids': 1, '_id': 0}
+        ).sort([('uid', 1), ('kind', 1), ('snap', 1), ('seq', 1)])
+        for bucket in cursor:
+            # snap 超出快照个数的 bucket 是写到一半的, 忽略
+            if bucket['snap'] < len(docs[bucket['uid']].get(bucket['kind'], [])):
+                buckets.setdefault((bucket['uid'], bucket['kind']), []).append(
+                    (bucket['snap'], bucket['uids']))
+        return buckets
+
+    def _follow_list(self, uid, field, snapshots, buckets=None) -> FollowList:
+        """
+        :param snapshots: user doc 中的 follower 或 followee
+        :param buckets: 已经读出的 [(snap, uids)], 见 _load_buckets
+        存在 bucket 里的快照只有 time 和 count, 按 (snap, seq) 顺序读 bucket,
+        边读边建 FollowList, 不把整个快照读进内存
+        """
+        if not self._bucketed(snapshots):
+            return FollowList(snapshots)
+        inline = ((i, snapshot['uids']) for i, snapshot in enumerate(snapshots)
+                  if 'uids' in snapshot)
+        if buckets is None:
+            # snap 超出快照个数的 bucket 是写到一半的, 忽略
+            cursor = self._get_snapshot_coll().find(
+                {'uid': uid, 'kind': field, 'snap': {'$lt': len(snapshots)}},
+                {'snap': 1, 'uids': 1, '_id': 0}
+            ).sort([('snap', 1), ('seq', 1)])
+            buckets = ((bucket['snap'], bucket['uids']) for bucket in cursor)
+        return FollowList(snapshots,
+                          heapq.merge(inline, buckets, key=itemgetter(0)))
+
+    def _get_users(self, field, uid, time):
+        flist = self._get_list(field, uid)
+        if flist is None:
+            return None
+        return FollowView(flist, time)
+
+    def _save_users(self, field, uid, uids):
+        flist = [{'time': datetime.now(), 'uids': uids}]
         self.coll.update_one({
-            'uid': user.id,
+            'uid': uid,
         }, {
             "$set": {
-                "followee": [{
-                    'time': datetime.now(),
-                    'uids': uids
-                }]
+                field: flist
             }
         }, upsert=True)
-        self.followees[user.id] = [{'time': datetime.now(), 'uids': uids}]
-        return self.followees[user.id]
+        self.memo.invalidate(field, uid)
+        entry = self._cache(uid, field, FollowList(flist))
+        return FollowView(entry[field])
+
+    def _cache(self, uid, field, flist):
+        """
+        把 flist 存入 uid 对应的 entry, 并更新 entry 占用的字节数
+        """
+        entry = self.lru.peek(uid)
+        if entry is None:
+            entry = {}
+        entry[field] = flist
+        size = sys.getsizeof(entry) + sum(
+            f.nbytes for f in entry.values() if f is not None)
+        self.lru.set(uid, entry, size)
+        return entry
 
     @staticmethod
     def get_closest_users(flist, time) -> list:
@@ -136,59 +619,101 @@ class UserManager:
                 pos = len(times)
             else:
                 pos = bisect.bisect(times, time) if time else len(times)
-            merge = lambda x, y: x + y
+            accumulate = lambda fdicts: list(chain.from_iterable(
+                fdict['uids'] for fdict in fdicts))
             if pos == 0:
                 return flist[0]['uids']
             elif pos == len(times):
-                return reduce(merge, [fdict['uids'] for fdict in flist])
+                return accumulate(flist)
             else:
                 # 找到最接近time的那个时刻
                 if time - times[pos-1] < times[pos] - time:
-                    return reduce(merge, [fdict['uids'] for fdict in flist[:pos]])
+                    return accumulate(flist[:pos])
                 else:
-                    return reduce(merge, [fdict['uids'] for fdict in flist[:pos+1]])
-
-
-class Node():
-    def __init__(self, key=None, next=None, prev=None):
-        self.key = key
-        self.next = next
-        self.prev = prev    # time limit exceed if don't use prev
+                    return accumulate(flist[:pos+1])
 
 
 class LRUCache:
-    def __init__(self, capacity: int):
+    """
+    同时限制条目数 cap 和总字节数 max_bytes(None 表示不限)的 LRU cache
+    value 的字节数由调用方在 set 时给出
+    reserved 返回缓存之外但要计入 max_bytes 的字节数, 如 interner
+    """
+    def __init__(self, capacity: int, max_bytes=None, reserved=None):
         self.cap = capacity
-        self.hashtable = {}
-        self.head, self.tail = Node(-1), Node(-1)
-        self.head.next = self.tail
-        self.tail.prev = self.head
+        self.max_bytes = max_bytes
+        self.reserved = reserved
+        self.table = OrderedDict()  # {key: (value, size)}, 从旧到新
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def get(self, key):
+        """
+        :return: 命中返回 value 并移到末尾, 否则返回 None
+        """
+        if key in self.table:
+            self.hits += 1
+            self.table.move_to_end(key)
+            return self.table[key][0]
+        self.misses += 1
+        return None
+
+    def peek(self, key):
+        """
+        同 get, 但不改变顺序, 不计数
+        """
+        if key in self.table:
+            return self.table[key][0]
+        return None
+
+    def set(self, key, value, size=0):
+        if key in self.table:
+            self.nbytes -= self.table[key][1]
+        self.table[key] = (value, size)
+        self.table.move_to_end(key)
+        self.nbytes += size
+        self.evict()
 
     def pop_front(self):
-        del self.hashtable[self.head.next.key]
-        self.head.next = self.head.next.next
-        self.head.next.prev = self.head
-
-    def push_back(self, key):
-        new_node = Node(key)
-        self.hashtable[key] = new_node
-        self.move_to_tail(new_node)
-
-    def move_to_tail(self, node):
-        # key is to keep node a new node before invoking move_to_tail
-        prev = self.tail.prev
-        node.prev, node.next = prev, self.tail
-        prev.next = node
-        self.tail.prev = node
-
-    # TODO: 适应 reset cap
-    def set(self, key):
-        if key not in self.hashtable:
-            if len(self.hashtable) >= self.cap:
-                self.pop_front()
-            self.push_back(key)
-        else:
-            node = self.hashtable[key]
-            node.prev.next = node.next
-            node.next.prev = node.prev
-            self.move_to_tail(node)
\ No newline at end of file
+        _, (_, size) = self.table.popitem(last=False)
+        self.nbytes -= size
+        self.evictions += 1
+
+    def evict(self):
+        # 至少保留最新的一项, 否则单个超过 max_bytes 的 value 会被立即淘汰
+        max_bytes = self.max_bytes
+        if max_bytes is not None and self.reserved is not None:
+            max_bytes -= self.reserved()
+        while len(self.table) > self.cap or (
+                max_bytes is not None and self.nbytes > max_bytes
+                and len(self.table) > 1):
+            self.pop_front()
+
+    def clear(self):
+        self.evictions += len(self.table)
+        self.table.clear()
+        self.nbytes = 0
+
+    def reset_capacity(self, capacity=None, max_bytes=None):
+        if capacity is not None:
+            self.cap = capacity
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.evict()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.table),
+            'nbytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }